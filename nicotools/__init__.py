@@ -39,6 +39,24 @@ def main(arguments=None):
     parser_nd.add_argument("--smile", action="store_true", help=Msg.nd_help_smile)
     parser_nd.add_argument("--limit", type=int, help=Msg.nd_help_limit, default=4)
     parser_nd.add_argument("--nomulti", action="store_false", help=Msg.nd_help_nomulti, dest="nomulti")
+    parser_nd.add_argument("--pool-size", type=int, help=Msg.nd_help_pool_size, default=100)
+    parser_nd.add_argument("--pool-per-host", type=int, help=Msg.nd_help_pool_per_host, default=10)
+    parser_nd.add_argument("--parser", type=str.lower, help=Msg.nd_help_parser, default="thread",
+                           choices=["inline", "thread", "process"])
+    parser_nd.add_argument("--parser-workers", type=int, help=Msg.nd_help_parser_workers, default=None)
+    parser_nd.add_argument("--cache", action="store_true", help=Msg.nd_help_cache)
+    parser_nd.add_argument("--parts", action="store_false", help=Msg.nd_help_parts, dest="preallocate")
+    parser_nd.add_argument("--auto", action="store_true", help=Msg.nd_help_auto)
+    parser_nd.add_argument("--parallel", type=int, help=Msg.nd_help_parallel, default=1)
+    parser_nd.add_argument("--connections", type=int, help=Msg.nd_help_connections, default=None)
+    parser_nd.add_argument("--in-flight", type=int, help=Msg.nd_help_in_flight, default=None)
+    parser_nd.add_argument("--fsync", type=str.lower, help=Msg.nd_help_fsync, default="close",
+                           choices=["never", "close", "always"])
+    parser_nd.add_argument("--progress", type=str.lower, help=Msg.nd_help_progress, default="bar",
+                           choices=["bar", "log", "json", "none"])
+    parser_nd.add_argument("--progress-file", type=str, help=Msg.nd_help_progress_file, default=None)
+    parser_nd.add_argument("--stdout", action="store_true", help=Msg.nd_help_stdout)
+    parser_nd.add_argument("--window", type=int, help=Msg.nd_help_window, default=32)
 
 
     parser_ml = subparsers.add_parser("mylist", aliases=["m"], help=Msg.ml_description)
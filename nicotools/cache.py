@@ -0,0 +1,101 @@
+# coding: UTF-8
+import json
+import sqlite3
+import time
+from pathlib import Path
+from typing import Dict, Optional, Union
+
+from nicotools.utils import KeyDmc
+
+
+class InfoCache:
+    # すぐに古くなる項目。セッションの作成に使う署名や、視聴者ごとに変わるもの
+    VOLATILE = frozenset({
+        KeyDmc.VIDEO_URL_SM, KeyDmc.ECO, KeyDmc.IS_DELETED, KeyDmc.IS_PUBLIC, KeyDmc.IS_PREMIUM,
+        KeyDmc.USER_ID, KeyDmc.USER_KEY, KeyDmc.SVC_USER_ID,
+        KeyDmc.API_URL, KeyDmc.RECIPE_ID, KeyDmc.VIDEO_SRC_IDS, KeyDmc.AUDIO_SRC_IDS,
+        KeyDmc.HEARTBEAT, KeyDmc.TOKEN, KeyDmc.SIGNATURE, KeyDmc.AUTH_TYPE,
+        KeyDmc.C_K_TIMEOUT, KeyDmc.PLAYER_ID, KeyDmc.PRIORITY,
+    })
+
+    def __init__(self, path: Union[str, Path]=":memory:",
+                 stable_ttl: float=60 * 60 * 24 * 7,
+                 volatile_ttl: float=60 * 5):
+        """
+        Info が集めた動画の情報を SQLite に保存しておく。
+
+        タイトルやスレッドIDのように変わらない項目と、DMC の署名や userkey のように
+        すぐに古くなる項目 (VOLATILE) とで、別々に有効期限を持つ。
+
+        :param Union[str, Path] path: データベースのファイル。省略するとメモリ上に置く
+        :param float stable_ttl: 変わらない項目の有効期限 (秒)
+        :param float volatile_ttl: すぐに古くなる項目の有効期限 (秒)
+        """
+        self.stable_ttl = stable_ttl
+        self.volatile_ttl = volatile_ttl
+        self.__conn = sqlite3.connect(str(path))
+        with self.__conn:
+            self.__conn.execute(
+                "CREATE TABLE IF NOT EXISTS info ("
+                " video_id TEXT PRIMARY KEY,"
+                " stable TEXT NOT NULL, stable_at REAL NOT NULL,"
+                " volatile TEXT NOT NULL, volatile_at REAL NOT NULL)")
+        self.prune()
+
+    def get(self, video_id: str, volatile: bool=True) -> Optional[Dict]:
+        """
+        保存してある情報を返す。
+
+        :param str video_id:
+        :param bool volatile: すぐに古くなる項目も要るかどうか。
+            False なら、変わらない項目だけが有効期限内であればそれだけを返す。
+        :return: 必要な項目が期限切れか、保存していなければ None
+        :rtype: Optional[Dict]
+        """
+        row = self.__conn.execute(
+            "SELECT stable, stable_at, volatile, volatile_at FROM info WHERE video_id = ?",
+            (video_id,)).fetchone()
+        if row is None:
+            return None
+        stable, stable_at, volatile_part, volatile_at = row
+        now = time.time()
+        if now - stable_at > self.stable_ttl:
+            return None
+        result = json.loads(stable)
+        if volatile:
+            if now - volatile_at > self.volatile_ttl:
+                return None
+            result.update(json.loads(volatile_part))
+        return result
+
+    def put(self, video_id: str, info: Dict) -> None:
+        """
+        情報を保存する。前に保存したものは上書きする。
+
+        :param str video_id:
+        :param Dict info: Info が作った辞書
+        """
+        stable = {key: val for key, val in info.items() if key not in self.VOLATILE}
+        volatile = {key: val for key, val in info.items() if key in self.VOLATILE}
+        # ファイルサイズは動画をダウンロードするときに調べ直す
+        stable[KeyDmc.FILE_SIZE] = None
+        now = time.time()
+        with self.__conn:
+            self.__conn.execute(
+                "INSERT OR REPLACE INTO info VALUES (?, ?, ?, ?, ?)",
+                (video_id, json.dumps(stable), now, json.dumps(volatile), now))
+
+    def prune(self) -> int:
+        """
+        変わらない項目まで期限が切れたものを消す。
+
+        :return: 消した件数
+        :rtype: int
+        """
+        with self.__conn:
+            cursor = self.__conn.execute("DELETE FROM info WHERE stable_at < ?",
+                                         (time.time() - self.stable_ttl,))
+        return cursor.rowcount
+
+    def close(self) -> None:
+        self.__conn.close()
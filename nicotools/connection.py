@@ -0,0 +1,624 @@
+# coding: UTF-8
+import asyncio
+import logging
+import random
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Dict, List, Optional, Tuple, Union
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from nicotools.utils import Msg, Err, Endpoint
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: Optional[float]=None,
+                 loop: Optional[asyncio.AbstractEventLoop]=None):
+        """
+        毎秒 rate 個ずつ補充されるトークンのバケツ。
+
+        トークンがなければ補充されるまで待つ。待っている者は先着順に進む。
+
+        :param float rate: 一秒あたりに補充するトークンの数。0 以下なら制限しない。
+        :param Optional[float] capacity: 貯めておけるトークンの最大数 (瞬間的な連打の許容量)
+        :param Optional[asyncio.AbstractEventLoop] loop: イベントループ
+        """
+        self.loop = loop or asyncio.get_event_loop()  # type: asyncio.AbstractEventLoop
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.__tokens = self.capacity
+        self.__last = None  # type: Optional[float]
+        self.__lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = self.loop.time()
+        if self.__last is not None:
+            self.__tokens = min(self.capacity, self.__tokens + (now - self.__last) * self.rate)
+        self.__last = now
+
+    async def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        async with self.__lock:
+            while True:
+                self._refill()
+                if self.__tokens >= 1:
+                    self.__tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.__tokens) / self.rate)
+
+
+class HostLimiter:
+    def __init__(self, concurrency: int, rate: float, loop: Optional[asyncio.AbstractEventLoop]=None):
+        """
+        ひとつのホストに対する同時接続数と、毎秒のリクエスト数をまとめて制限する。
+
+        :param int concurrency: 同時に処理するリクエストの最大数。0 以下なら制限しない。
+        :param float rate: 一秒あたりに送るリクエストの最大数。0 以下なら制限しない。
+        :param Optional[asyncio.AbstractEventLoop] loop: イベントループ
+        """
+        self.concurrency = concurrency
+        self.rate = rate
+        self.__semaphore = asyncio.Semaphore(concurrency) if concurrency > 0 else None
+        self.__bucket = TokenBucket(rate, capacity=max(1, concurrency), loop=loop)
+
+    async def acquire(self, rated: bool=True) -> None:
+        """
+        枠を一つ確保する。
+
+        :param bool rated: 毎秒のリクエスト数にも数えるか。 False なら同時接続数だけを守る
+        """
+        if self.__semaphore is not None:
+            await self.__semaphore.acquire()
+        if not rated:
+            return
+        try:
+            await self.__bucket.acquire()
+        except BaseException:
+            self.release()
+            raise
+
+    def release(self) -> None:
+        if self.__semaphore is not None:
+            self.__semaphore.release()
+
+    async def __aenter__(self) -> "HostLimiter":
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        self.release()
+
+
+class RateLimiter:
+    # ホスト名の末尾 -> (同時接続数, 毎秒のリクエスト数)
+    # 複数に当てはまる場合は長いほうが優先される。
+    DEFAULT_RULES = {
+        "www.nicovideo.jp"  : (4, 2.0),     # 動画視聴ページとマイリストAPI
+        "ext.nicovideo.jp"  : (8, 5.0),     # getthumbinfo, getflv
+        "nmsg.nicovideo.jp" : (4, 3.0),     # コメントサーバー
+        "flapi.nicovideo.jp": (4, 3.0),     # getthreadkey, getwaybackkey
+        "nicovideo.jp"      : (16, 10.0),   # Smile サーバーなど
+        "smilevideo.jp"     : (8, 10.0),    # サムネイル
+        "dmc.nico"          : (16, 10.0),   # DMCサーバー(セッションAPIと動画本体)
+    }  # type: Dict[str, Tuple[int, float]]
+    DEFAULT_LIMIT = (8, 10.0)  # type: Tuple[int, float]
+
+    def __init__(self,
+                 rules: Optional[Dict[str, Tuple[int, float]]]=None,
+                 default: Optional[Tuple[int, float]]=None,
+                 loop: Optional[asyncio.AbstractEventLoop]=None,
+                 ):
+        """
+        通信先のホストごとに HostLimiter を割り当てる。
+
+        :param Optional[Dict[str, Tuple[int, float]]] rules:
+         ホスト名の末尾と (同時接続数, 毎秒のリクエスト数) の組。既定の設定を上書きする。
+        :param Optional[Tuple[int, float]] default: どの規則にも当てはまらないホストの設定
+        :param Optional[asyncio.AbstractEventLoop] loop: イベントループ
+        """
+        self.loop = loop
+        self.rules = dict(self.DEFAULT_RULES)
+        self.rules.update(rules or {})
+        self.default = default or self.DEFAULT_LIMIT
+        self.__limiters = {}  # type: Dict[str, HostLimiter]
+
+    def rule_for(self, host: str) -> Tuple[int, float]:
+        """
+        そのホストに当てはまる (同時接続数, 毎秒のリクエスト数) を返す。
+
+        :param str host: ホスト名
+        :rtype: Tuple[int, float]
+        """
+        host = host.lower()
+        matched = [suffix for suffix in self.rules
+                   if host == suffix or host.endswith("." + suffix)]
+        if matched:
+            return self.rules[max(matched, key=len)]
+        return self.default
+
+    def get(self, url: str) -> HostLimiter:
+        """
+        その URL のホストを受け持つ HostLimiter を返す。
+
+        :param str url:
+        :rtype: HostLimiter
+        """
+        host = urlsplit(str(url)).hostname or ""
+        limiter = self.__limiters.get(host)
+        if limiter is None:
+            concurrency, rate = self.rule_for(host)
+            limiter = HostLimiter(concurrency, rate, loop=self.loop)
+            self.__limiters[host] = limiter
+        return limiter
+
+
+class RetryPolicy:
+    # 待てば直る見込みのあるステータスコード
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    # サーバーがリクエストを処理せずに断ったことが確かなステータスコード
+    REFUSED_STATUSES = (429, 503)
+    IDEMPOTENT_METHODS = ("GET", "HEAD", "PUT", "DELETE", "OPTIONS")
+
+    def __init__(self,
+                 retries: int=3,
+                 base: Union[int, float]=1,
+                 factor: Union[int, float]=2,
+                 cap: Union[int, float]=60,
+                 budget: Optional[Union[int, float]]=300,
+                 idempotent: Optional[bool]=None,
+                 ):
+        """
+        再試行の方針。
+
+        待ち時間は「フルジッター」方式で、 0 から base * factor ** 試行回数 (最大 cap) までの
+        一様乱数にする。レスポンスに Retry-After があればそちらを優先する。
+
+        冪等でないリクエスト (マイリストの編集など) は、サーバーが処理せずに断ったことが
+        確かな場合 (接続の失敗、429、503) にだけ再試行する。
+
+        :param int retries: 再試行回数
+        :param Union[int, float] base: 最初の待ち時間の上限 (秒)
+        :param Union[int, float] factor: 待ち時間の増大倍率
+        :param Union[int, float] cap: 一回あたりの待ち時間の上限 (秒)
+        :param Optional[Union[int, float]] budget: 待ち時間の合計の上限 (秒)。None なら無制限。
+        :param Optional[bool] idempotent: 冪等かどうか。None ならメソッドから判断する。
+        """
+        self.retries = max(0, retries)
+        self.base = base
+        self.factor = factor
+        self.cap = cap
+        self.budget = budget
+        self.idempotent = idempotent
+
+    def is_idempotent(self, method: str) -> bool:
+        if self.idempotent is None:
+            return method.upper() in self.IDEMPOTENT_METHODS
+        return self.idempotent
+
+    def backoff(self, attempt: int) -> float:
+        """
+        attempt 回目の再試行の前に待つ秒数を返す。
+
+        :param int attempt: 0 から数えた再試行の回数
+        :rtype: float
+        """
+        return random.uniform(0, min(self.cap, self.base * self.factor ** attempt))
+
+    @classmethod
+    def retry_after(cls, headers) -> Optional[float]:
+        """
+        Retry-After ヘッダーの値を秒数にして返す。無いか読めない場合は None。
+
+        :param headers: レスポンスヘッダー
+        :rtype: Optional[float]
+        """
+        value = (headers or {}).get("Retry-After")
+        if not value:
+            return None
+        value = value.strip()
+        if value.isdigit():
+            return float(value)
+        try:
+            when = parsedate_to_datetime(value)
+        except (TypeError, ValueError, IndexError):
+            return None
+        if when is None:
+            return None
+        if when.tzinfo is None:
+            when = when.replace(tzinfo=timezone.utc)
+        return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+    def should_retry_status(self, method: str, status: int) -> bool:
+        if self.is_idempotent(method):
+            return status in self.RETRY_STATUSES
+        return status in self.REFUSED_STATUSES
+
+    def should_retry_error(self, method: str, error: BaseException) -> bool:
+        if self.is_idempotent(method):
+            return isinstance(error, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
+        # 接続すらできていなければ、サーバーには何も届いていない
+        return isinstance(error, aiohttp.ClientConnectorError)
+
+
+# 通信先ごとの再試行の方針
+RETRY_POLICIES = {
+    Endpoint.DEFAULT    : RetryPolicy(),
+    Endpoint.WATCH      : RetryPolicy(retries=3, base=5, factor=3),
+    Endpoint.THUMBINFO  : RetryPolicy(retries=3),
+    Endpoint.GETFLV     : RetryPolicy(retries=3),
+    Endpoint.THUMBNAIL  : RetryPolicy(retries=2),
+    # POST だが、コメントを読むだけなので送り直してよい
+    Endpoint.COMMENT    : RetryPolicy(retries=3, idempotent=True),
+    Endpoint.FLAPI      : RetryPolicy(retries=3),
+    Endpoint.DMC_SESSION: RetryPolicy(retries=3, idempotent=False),
+    # POST の _method=PUT で、同じセッションを延ばすだけなので送り直してよい
+    Endpoint.HEARTBEAT  : RetryPolicy(retries=5, base=0.5, cap=10, budget=30, idempotent=True),
+    Endpoint.VIDEO      : RetryPolicy(retries=5, cap=30),
+    Endpoint.MYLIST     : RetryPolicy(retries=3),
+    Endpoint.MYLIST_EDIT: RetryPolicy(retries=3, idempotent=False),
+}  # type: Dict[str, RetryPolicy]
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self,
+                 host: str="",
+                 threshold: int=5,
+                 window: Union[int, float]=10,
+                 cooldown: Union[int, float]=15,
+                 max_cooldown: Union[int, float]=300,
+                 loop: Optional[asyncio.AbstractEventLoop]=None,
+                 logger: Optional[logging.Logger]=None,
+                 ):
+        """
+        ひとつのホストに対するサーキットブレーカー。
+
+        window 秒の間に threshold 回 5xx や 429 が返ってきたら「開いた」状態になり、
+        そのホストへのリクエストを cooldown 秒間すべて待たせる。
+        時間が経ったら一つだけ試しに通し (半開き)、うまくいけば「閉じて」全員を通す。
+        だめなら待ち時間を倍にして (最大 max_cooldown 秒) また開く。
+
+        :param str host: ホスト名 (ログ用)
+        :param int threshold: 開くまでの失敗回数
+        :param Union[int, float] window: 失敗を数える期間 (秒)
+        :param Union[int, float] cooldown: 開いてから試しに通すまでの秒数
+        :param Union[int, float] max_cooldown: cooldown の上限
+        :param Optional[asyncio.AbstractEventLoop] loop: イベントループ
+        :param Optional[logging.Logger] logger: ロガー
+        """
+        self.host = host
+        self.threshold = threshold
+        self.window = window
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.loop = loop or asyncio.get_event_loop()  # type: asyncio.AbstractEventLoop
+        self.logger = logger or logging.getLogger(__name__)
+        self.state = self.CLOSED
+        self.__cooldown = cooldown
+        self.__opened_at = 0.0
+        self.__failures = []  # type: List[float]
+        # 状態が変わるたびに set して新しいものに取り替える
+        self.__changed = asyncio.Event()
+
+    @classmethod
+    def is_failure(cls, status: Optional[int]) -> bool:
+        return status is None or status == 429 or 500 <= status < 600
+
+    @property
+    def remaining(self) -> float:
+        """ 開いている場合に、試しに通すまでの残り秒数 """
+        if self.state != self.OPEN:
+            return 0.0
+        return max(0.0, self.__opened_at + self.__cooldown - self.loop.time())
+
+    def _notify(self) -> None:
+        self.__changed.set()
+        self.__changed = asyncio.Event()
+
+    def _open(self, cooldown: float) -> None:
+        self.state = self.OPEN
+        self.__cooldown = min(self.max_cooldown, cooldown)
+        self.__opened_at = self.loop.time()
+        self.__failures = []
+        self.logger.warning(Err.circuit_opened.format(host=self.host, cooldown=self.__cooldown))
+        self._notify()
+
+    def _close(self) -> None:
+        self.state = self.CLOSED
+        self.__cooldown = self.base_cooldown
+        self.__failures = []
+        self.logger.info(Msg.circuit_closed.format(host=self.host))
+        self._notify()
+
+    async def wait(self) -> bool:
+        """
+        リクエストを送ってよくなるまで待つ。
+
+        試しに通す一つに選ばれた場合は True を返す。その場合は必ず record か abandon を呼ぶこと。
+
+        :rtype: bool
+        """
+        while True:
+            if self.state == self.CLOSED:
+                return False
+            changed = self.__changed
+            if self.state == self.OPEN:
+                remaining = self.remaining
+                if remaining <= 0:
+                    self.state = self.HALF_OPEN
+                    return True
+                try:
+                    await asyncio.wait_for(changed.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                # 試しに通したものの結果を待つ
+                await changed.wait()
+
+    def record(self, status: Optional[int], is_probe: bool=False,
+               retry_after: Optional[float]=None) -> None:
+        """
+        リクエストの結果を記録する。
+
+        :param Optional[int] status: ステータスコード。接続に失敗した場合は None。
+        :param bool is_probe: 試しに通したリクエストかどうか
+        :param Optional[float] retry_after: サーバーに指示された待ち時間
+        """
+        failed = self.is_failure(status)
+        if is_probe:
+            if failed:
+                self._open(max(self.__cooldown * 2, retry_after or 0))
+            else:
+                self._close()
+            return
+        # 接続の失敗は混雑の印とは限らないので、試しに通したもの以外は数えない
+        if not failed or status is None or self.state != self.CLOSED:
+            return
+        now = self.loop.time()
+        self.__failures = [t for t in self.__failures if now - t < self.window] + [now]
+        if len(self.__failures) >= self.threshold:
+            self._open(max(self.base_cooldown, retry_after or 0))
+
+    def abandon(self) -> None:
+        """ 試しに通したリクエストが結果を出さずに終わった場合に、次の者に譲る。 """
+        if self.state == self.HALF_OPEN:
+            self.state = self.OPEN
+            self.__opened_at = self.loop.time() - self.__cooldown
+            self._notify()
+
+
+class _Request:
+    # 動画本体の範囲は一回が大きく、量は TransferBudget が抑えるので、回数では数えない
+    UNRATED = (Endpoint.VIDEO,)
+
+    def __init__(self, manager: "SessionManager", method: str, url: str, kwargs: Dict):
+        """
+        SessionManager.request の返り値。 async with で使う。
+
+        ホストのサーキットブレーカーが閉じるのを待ち、
+        ホストごとの制限の枠を確保してからリクエストを送り、
+        レスポンスを閉じるまで枠を持ち続ける。
+        一時的な失敗は RetryPolicy に従って再試行する。
+        再試行し尽くしても失敗したステータスのままなら、そのレスポンスを返す。
+        """
+        self.manager = manager
+        self.method = method.upper()
+        self.url = url
+        self.endpoint = kwargs.pop("endpoint", Endpoint.DEFAULT)  # type: str
+        self.policy = kwargs.pop("retry", None) or manager.retry_policy(self.endpoint)  # type: RetryPolicy
+        self.kwargs = kwargs
+        self.__slot = None  # type: Optional[HostLimiter]
+        self.__context = None
+
+    async def _send(self) -> aiohttp.ClientResponse:
+        breaker = self.manager.breaker(self.url)
+        self.__slot = self.manager.limiter.get(self.url)
+        while True:
+            is_probe = await breaker.wait()
+            try:
+                await self.__slot.acquire(rated=self.endpoint not in self.UNRATED)
+            except BaseException:
+                if is_probe:
+                    breaker.abandon()
+                raise
+            if is_probe or breaker.state == CircuitBreaker.CLOSED:
+                break
+            # 枠を待っている間にブレーカーが開いたので、枠を返して待ち直す
+            self.__slot.release()
+        try:
+            self.__context = self.manager.session.request(self.method, self.url, **self.kwargs)
+            response = await self.__context.__aenter__()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.__slot.release()
+            breaker.record(None, is_probe=is_probe)
+            raise
+        except BaseException:
+            self.__slot.release()
+            if is_probe:
+                breaker.abandon()
+            raise
+        breaker.record(response.status, is_probe=is_probe,
+                       retry_after=RetryPolicy.retry_after(response.headers))
+        return response
+
+    async def __aenter__(self) -> aiohttp.ClientResponse:
+        policy = self.policy
+        waited = 0.0
+        attempt = 0
+        while True:
+            try:
+                response = await self._send()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                if attempt >= policy.retries or not policy.should_retry_error(self.method, error):
+                    raise
+                reason = repr(error)
+                delay = policy.backoff(attempt)
+            else:
+                if attempt >= policy.retries or not policy.should_retry_status(self.method, response.status):
+                    return response
+                reason = response.status
+                delay = policy.retry_after(response.headers)
+                if delay is None:
+                    delay = policy.backoff(attempt)
+                await self.__aexit__(None, None, None)
+
+            if policy.budget is not None and waited + delay > policy.budget:
+                # 待ち時間の予算を使い切ったら、最後にもう一度だけ試して結果をそのまま返す
+                delay = max(0.0, policy.budget - waited)
+                attempt = policy.retries - 1
+            attempt += 1
+            waited += delay
+            self.manager.logger.warning(Err.retrying.format(
+                method=self.method, url=self.url, reason=reason,
+                delay=delay, now=attempt, all=policy.retries))
+            await asyncio.sleep(delay)
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        try:
+            await self.__context.__aexit__(exc_type, exc, tb)
+        finally:
+            self.__slot.release()
+
+
+class SessionManager:
+    def __init__(self,
+                 cookies: Optional[Dict[str, str]]=None,
+                 limit: int=100,
+                 limit_per_host: int=10,
+                 dns_cache_ttl: Optional[int]=300,
+                 keepalive_timeout: Union[int, float]=30,
+                 limiter: Optional[RateLimiter]=None,
+                 retry_policies: Optional[Dict[str, RetryPolicy]]=None,
+                 breaker_settings: Optional[Dict[str, Union[int, float]]]=None,
+                 session: Optional[aiohttp.ClientSession]=None,
+                 loop: Optional[asyncio.AbstractEventLoop]=None,
+                 logger: Optional[logging.Logger]=None,
+                 ):
+        """
+        一回の実行を通して使い回す aiohttp のセッションとコネクションプール。
+
+        Info, Thumbnail, Comment, Video, NicoMyList はこれを借りて通信する。
+        ClientSession と同じ get / post / head / put を持つので、
+        借りる側はセッションと同じように扱える。
+        閉じるのは作った側の役目で、借りた側は閉じない。
+
+        全てのリクエストは RateLimiter を通り、ホストごとの制限を受ける。
+        また、 endpoint 引数で指定した通信先ごとの RetryPolicy に従って再試行する。
+        (例: session.get(url, endpoint=Endpoint.WATCH))
+        サーバーが混み合ってきたら、ホストごとの CircuitBreaker が全員を一斉に待たせる。
+
+        :param Optional[Dict[str, str]] cookies: ログイン済みのクッキー
+        :param int limit: 全体で同時に張る接続の最大数
+        :param int limit_per_host: ホストごとに同時に張る接続の最大数
+        :param Optional[int] dns_cache_ttl: DNSの結果を覚えておく秒数。None なら無期限。
+        :param Union[int, float] keepalive_timeout: 使い終わった接続を保持しておく秒数
+        :param Optional[RateLimiter] limiter: ホストごとの制限。省略すると既定の設定で作る。
+        :param Optional[Dict[str, RetryPolicy]] retry_policies: 通信先ごとの再試行の方針。既定の設定を上書きする。
+        :param Optional[Dict[str, Union[int, float]]] breaker_settings: CircuitBreaker に渡す設定
+        :param Optional[aiohttp.ClientSession] session: 既存のセッションを包む場合に指定する
+        :param Optional[asyncio.AbstractEventLoop] loop: イベントループ
+        :param Optional[logging.Logger] logger: ロガー
+        """
+        self.loop = loop or asyncio.get_event_loop()  # type: asyncio.AbstractEventLoop
+        self.logger = logger or logging.getLogger(__name__)
+        self.cookies = cookies
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.limiter = limiter or RateLimiter(loop=self.loop)
+        self.retry_policies = dict(RETRY_POLICIES)
+        self.retry_policies.update(retry_policies or {})
+        self.breaker_settings = breaker_settings or {}
+        self.__breakers = {}  # type: Dict[str, CircuitBreaker]
+        self.__session = session  # type: Optional[aiohttp.ClientSession]
+        # 外から渡されたセッションは閉じない
+        self.__is_owner = session is None
+
+    def retry_policy(self, endpoint: str) -> RetryPolicy:
+        return self.retry_policies.get(endpoint) or self.retry_policies[Endpoint.DEFAULT]
+
+    def breaker(self, url: str) -> CircuitBreaker:
+        """
+        その URL のホストを受け持つ CircuitBreaker を返す。
+
+        :param str url:
+        :rtype: CircuitBreaker
+        """
+        host = urlsplit(str(url)).hostname or ""
+        breaker = self.__breakers.get(host)
+        if breaker is None:
+            breaker = CircuitBreaker(host=host, loop=self.loop, logger=self.logger, **self.breaker_settings)
+            self.__breakers[host] = breaker
+        return breaker
+
+    @classmethod
+    def wrap(cls, session: Union["SessionManager", aiohttp.ClientSession, None]) -> Optional["SessionManager"]:
+        """
+        引数に渡されたセッションを SessionManager として返す。
+
+        :param Union[SessionManager, aiohttp.ClientSession, None] session:
+        :rtype: Optional[SessionManager]
+        """
+        if session is None or isinstance(session, SessionManager):
+            return session
+        return cls(session=session)
+
+    async def open(self) -> "SessionManager":
+        """
+        コネクションプールとセッションを作る。すでにあれば何もしない。
+
+        :rtype: SessionManager
+        """
+        if self.__session is None or (self.__is_owner and self.__session.closed):
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                use_dns_cache=True,
+                ttl_dns_cache=self.dns_cache_ttl,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            self.__session = aiohttp.ClientSession(connector=connector, cookies=self.cookies)
+            self.__is_owner = True
+        return self
+
+    async def close(self) -> None:
+        if self.__is_owner and self.__session is not None and not self.__session.closed:
+            await self.__session.close()
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        return self.__session
+
+    @property
+    def closed(self) -> bool:
+        return self.__session is None or self.__session.closed
+
+    @property
+    def cookie_jar(self) -> aiohttp.client.AbstractCookieJar:
+        return self.__session.cookie_jar
+
+    def update_cookies(self, cookies) -> None:
+        self.__session.cookie_jar.update_cookies(cookies)
+
+    def request(self, method: str, url: str, **kwargs) -> _Request:
+        return _Request(self, method, url, kwargs)
+
+    def get(self, url: str, **kwargs) -> _Request:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> _Request:
+        return self.request("POST", url, **kwargs)
+
+    def head(self, url: str, **kwargs) -> _Request:
+        # ClientSession.head と同じく、既定ではリダイレクトを追わない
+        kwargs.setdefault("allow_redirects", False)
+        return self.request("HEAD", url, **kwargs)
+
+    def put(self, url: str, **kwargs) -> _Request:
+        return self.request("PUT", url, **kwargs)
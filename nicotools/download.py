@@ -1,5 +1,6 @@
 # coding: UTF-8
 import asyncio
+import codecs
 import functools
 import html
 import json
@@ -8,59 +9,107 @@ import re
 import sys
 from pathlib import Path
 from string import Template
-from typing import Dict, Union, Optional, List
+from typing import Dict, Union, Optional, List, Tuple, Iterable, AsyncIterator, Set, Callable, Awaitable
 from urllib.parse import parse_qs, unquote
 
 import aiohttp
 from bs4 import BeautifulSoup, Tag
-from tqdm import tqdm
 
-from nicotools import utils
-from nicotools.utils import Msg, Err, URL, KeyGetFlv, KeyGTI, KeyDmc, DataKey
+from nicotools import utils, watchpage, fileio
+from nicotools.cache import InfoCache
+from nicotools.connection import SessionManager, RetryPolicy
+from nicotools.executor import ParseExecutor
+from nicotools.heartbeat import Beat, HeartbeatManager, SessionLost
+from nicotools.manifest import RangeManifest
+from nicotools.progress import ProgressBus, TqdmSink, LogSink, JsonLinesSink
+from nicotools.segments import SegmentScheduler, ThroughputTuner, TransferBudget
+from nicotools.streaming import ReorderBuffer, write_to
+from nicotools.utils import Msg, Err, URL, KeyGetFlv, KeyGTI, KeyDmc, DataKey, Endpoint
+
+
+class InfoFailure(Exception):
+    """ Info.stream で情報を取れなかった動画を表す """
+    INVALID = "invalid"  # 動画IDの形式が正しくない
+    UNAVAILABLE = "unavailable"  # 削除済みか非公開
+    NOT_FOUND = "not_found"  # 視聴ページを取れなかった、または読めなかった
+    ERROR = "error"  # 通信エラー
+
+    def __init__(self, video_id: str, reason: str, error: Optional[BaseException]=None):
+        """
+        :param str video_id: 動画ID
+        :param str reason: 失敗の種類 (INVALID, UNAVAILABLE, NOT_FOUND, ERROR のいずれか)
+        :param Optional[BaseException] error: 元になった例外
+        """
+        super().__init__(video_id, reason, error)
+        self.video_id = video_id
+        self.reason = reason
+        self.error = error
 
 
 class Info(utils.Canopy):
+    # 情報の取り先。下ほど軽いが、分かることも少ない
+    WATCH = "watch"  # 視聴ページ: 全部分かる。DMC の動画には必須
+    GETFLV = "getflv"  # getthumbinfo と getflv: コメントと Smile サーバーの動画に足りる
+    THUMBINFO = "thumbinfo"  # getthumbinfo だけ: サムネイルに足りる
+
     def __init__(self,
-                 videoids: List,
+                 videoids: Optional[List],
                  mail: Optional[str]=None,
                  password: Optional[str]=None,
                  limit: int=4,
                  interval: Union[int, float]=5,
                  backoff: Union[int, float]=3,
                  retries: Union[int, float]=3,
+                 streaming: bool=True,
                  logger: Optional[utils.NTLogger]=None,
-                 session: Optional[aiohttp.ClientSession]=None,
+                 session: Union[SessionManager, aiohttp.ClientSession, None]=None,
                  loop: Optional[asyncio.AbstractEventLoop]=None,
+                 executor: Optional[ParseExecutor]=None,
+                 cache: Optional[InfoCache]=None,
+                 source: str=WATCH,
                  ):
         """
         動画視聴ページから様々なデータを集める。
 
-        :param List videoids:
+        :param Optional[List] videoids: None なら何も取りに行かない (後から一件ずつ取りに行く場合)
         :param Optional[str] mail: メールアドレス
         :param Optional[str] password: パスワード
         :param T <= logging.logger logger: ロガーのインスタンス
-        :param aiohttp.ClientSession session:
+        :param Union[SessionManager, aiohttp.ClientSession, None] session:
+         借りてくるセッション。指定した場合は閉じない。
         :param int limit: 同時にアクセスする最大数
         :param asyncio.AbstractEventLoop loop: イベントループ
         :param Union[int, float] interval: うまくいかなかった場合の待ち時間
         :param Union[int, float] backoff: 待ち時間の増大倍率
         :param Union[int,float] retries: 再試行回数
+        :param bool streaming: 視聴ページを少しずつ読み、必要な部分が揃ったら残りを読まずに閉じるかどうか
+        :param Optional[ParseExecutor] executor: 視聴ページの解析を実行する場所。省略するとスレッドプール
+        :param Optional[InfoCache] cache: 集めた情報を保存しておく場所。有効期限内なら視聴ページを取りに行かない
+        :param str source: 情報の取り先。 Info.plan で決める (WATCH, GETFLV, THUMBINFO のいずれか)
         """
         super().__init__(loop=loop, logger=logger)
         self.__mail = mail
         self.__password = password
-        self.aio_session = session or self.loop.run_until_complete(self.get_session())
-        self.__parallel_limit = limit
+        self.__is_borrowed = session is not None
+        self.aio_session = SessionManager.wrap(session) or self.loop.run_until_complete(self.get_session())
+        # 呼び出しごとに作ると何も制限しないので、一つだけ作って使い回す
+        self.__semaphore = asyncio.Semaphore(limit)
+        self.limit = limit
         self.interval = interval
         self.backoff = backoff
         self.retries = retries
-        self.videoinfo = self.get_data(videoids)
-
-    async def get_session(self) -> aiohttp.ClientSession:
+        self.streaming = streaming
+        self.executor = executor or ParseExecutor(loop=self.loop)
+        self.cache = cache
+        self.source = source
+        self.__retry = RetryPolicy(retries=retries, base=interval, factor=backoff)
+        self.videoinfo = {} if videoids is None else self.get_data(videoids)
+
+    async def get_session(self) -> SessionManager:
         """
         aiohttp のセッションを返す。
 
-        :rtype: aiohttp.ClientSession
+        :rtype: SessionManager
         """
         login = utils.LogIn(mail=self.__mail, password=self.__password)
         if login.is_login:
@@ -69,20 +118,20 @@ class Info(utils.Canopy):
             login.get_session(utils.LogIn.ask_credentials())
             cook = login.cookie
         self.logger.debug(f"Object ID of cookie (Info): {id(cook)}")
-        return aiohttp.ClientSession(cookies=cook)
+        return await SessionManager(cookies=cook, loop=self.loop, logger=self.logger).open()
 
     def close(self):
-        async def _close():
-            await self.session.close()
-
-        self.loop.run_until_complete(_close())
+        # 借りてきたセッションは持ち主が閉じる
+        if self.__is_borrowed:
+            return
+        self.loop.run_until_complete(self.session.close())
 
     @property
     def info(self) -> Dict:
         return self.videoinfo
 
     @property
-    def session(self) -> aiohttp.ClientSession:
+    def session(self) -> SessionManager:
         return self.aio_session
 
     def get_data(self, video_ids: List) -> Dict:
@@ -93,14 +142,86 @@ class Info(utils.Canopy):
         :rtype: Dict
         """
         video_ids = utils.validator(video_ids)
-        infos = self.loop.run_until_complete(
-            asyncio.gather(*[self._retrieve_info(_id) for _id in video_ids]))
-        result = {_id: _info for _id, _info in zip(video_ids, infos)}
+        result = self.loop.run_until_complete(self._collect(video_ids))
         sieved_result = self._sieve(result)
 
         self.close()
         return sieved_result
 
+    async def _collect(self, video_ids: List[str]) -> Dict[str, Union[Dict, InfoFailure]]:
+        return {video_id: info async for video_id, info in self.stream(video_ids)}
+
+    async def stream(self, video_ids: Iterable[str], window: Optional[int]=None
+                     ) -> AsyncIterator[Tuple[str, Union[Dict, InfoFailure]]]:
+        """
+        取れた順に動画の情報を一件ずつ返す。
+
+        async for video_id, info in Info(None).stream(ids): のように使う。
+        取れなかった動画には、辞書の代わりに InfoFailure を返す。
+        同時に取りに行くのは window 件までで、イテレーターは必要な分だけ読み進める。
+
+        :param Iterable[str] video_ids: 動画IDのイテラブル
+        :param Optional[int] window: 同時に取りに行く最大数。省略すると limit の2倍
+        :rtype: AsyncIterator[Tuple[str, Union[Dict, InfoFailure]]]
+        """
+        window = window or self.limit * 2
+        source = iter(video_ids)
+        pending = set()  # type: Set[asyncio.Future]
+
+        def admit():
+            while len(pending) < window:
+                video_id = next(source, None)
+                if video_id is None:
+                    return
+                pending.add(asyncio.ensure_future(self._fetch_one(video_id)))
+
+        admit()
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                pending.difference_update(done)
+                admit()
+                for task in done:
+                    yield task.result()
+        finally:
+            # 途中で読むのをやめられたら、取りに行っている分は諦める
+            for task in pending:
+                task.cancel()
+
+    async def _fetch_one(self, video_id: str) -> Tuple[str, Union[Dict, InfoFailure]]:
+        valid = utils.validator([video_id])
+        if not valid:
+            return video_id, InfoFailure(video_id, InfoFailure.INVALID)
+        video_id = valid[0]
+        if self.cache is not None:
+            # サムネイルだけなら、変わらない項目が残っていれば足りる
+            info = self.cache.get(video_id, volatile=self.source != self.THUMBINFO)
+            if info is not None:
+                self.logger.debug(f"Video ID: {video_id}, found in the cache")
+                # 保存してあるのは取れたものだけなので、公開中として扱う
+                info.setdefault(KeyDmc.IS_PUBLIC, True)
+                info.setdefault(KeyDmc.IS_DELETED, False)
+                return video_id, info
+        try:
+            info = await self._retrieve_info(video_id)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            self.logger.debug(f"Video ID: {video_id}, Error: {error!r}")
+            return video_id, InfoFailure(video_id, InfoFailure.ERROR, error)
+        except asyncio.CancelledError:
+            raise
+        except Exception as error:
+            # 読めないページが一件あっても、他の動画の情報は取り続ける
+            self.logger.debug(f"Video ID: {video_id}, Error: {error!r}")
+            return video_id, InfoFailure(video_id, InfoFailure.ERROR, error)
+        if info is None:
+            return video_id, InfoFailure(video_id, InfoFailure.NOT_FOUND)
+        if not self.is_available(info):
+            return video_id, InfoFailure(video_id, InfoFailure.UNAVAILABLE)
+        # 視聴ページ以外から取ったものは項目が足りないので保存しない
+        if self.cache is not None and self.source == self.WATCH:
+            self.cache.put(video_id, info)
+        return video_id, info
+
     def _sieve(self, infos: Dict) -> Dict:
         """
         非公開や削除済み動画をふるいにかける。
@@ -108,35 +229,163 @@ class Info(utils.Canopy):
         :param Dict infos:
         :rtype: Dict
         """
-        good = {_id: info for _id, info in infos.items()
-                  if isinstance(info, dict) and info[KeyDmc.IS_PUBLIC] and not info[KeyDmc.IS_DELETED]}
+        good = {_id: info for _id, info in infos.items() if self.is_available(info)}
         bad = list(set(infos) - set(good))
         if len(bad) > 0:
             self.logger.info(Msg.nd_deleted_or_private.format(bad))
         return good
 
+    @classmethod
+    def is_available(cls, info: Optional[Dict]) -> bool:
+        """
+        公開中で削除されていない動画の情報かどうか。
+
+        :param Optional[Dict] info:
+        :rtype: bool
+        """
+        return isinstance(info, dict) and info[KeyDmc.IS_PUBLIC] and not info[KeyDmc.IS_DELETED]
+
+    @classmethod
+    def plan(cls, thumbnail: bool=False, comment: bool=False, video: bool=False, smile: bool=False) -> str:
+        """
+        必要な段階に足りる中で、いちばん軽い情報の取り先を選ぶ。
+
+        DMC サーバーの動画かどうかは視聴ページを見ないと分からないので、
+        --smile なしで動画を落とすときは視聴ページが要る。
+
+        :param bool thumbnail: サムネイルを落とすかどうか
+        :param bool comment: コメントを落とすかどうか
+        :param bool video: 動画を落とすかどうか
+        :param bool smile: 動画を Smile サーバーから落とすかどうか
+        :rtype: str
+        """
+        if video and not smile:
+            return cls.WATCH
+        if video or comment:
+            return cls.GETFLV
+        return cls.THUMBINFO
+
     async def _retrieve_info(self, video_id: str) -> Dict:
-        interval = self.interval
-        backoff = self.backoff
-        attempt = max(0, self.retries) + 1
+        if self.source == self.THUMBINFO:
+            return await self._retrieve_thumbinfo(video_id)
+        if self.source == self.GETFLV:
+            thumbinfo, flvinfo = await asyncio.gather(
+                self._retrieve_thumbinfo(video_id), self._retrieve_getflv(video_id))
+            if not self.is_available(thumbinfo):
+                return thumbinfo
+            if flvinfo is not None:
+                thumbinfo.update(flvinfo)
+                return thumbinfo
+            # getflv で足りなければ視聴ページに頼る
+        return await self._retrieve_watch(video_id)
+
+    async def _retrieve_thumbinfo(self, video_id: str) -> Optional[Dict]:
+        async with self.__semaphore:
+            async with self.session.get(URL.URL_Info + video_id, endpoint=Endpoint.THUMBINFO) as response:
+                if response.status != 200:
+                    self.logger.debug(f"Video ID: {video_id}, Status: {response.status}")
+                    return None
+                content = await response.text()
+        info = await self.executor.run(self._read_from_thumbinfo, video_id, content)
+        if info is None:
+            # getthumbinfo は削除済みと非公開を区別しない
+            return {KeyDmc.VIDEO_ID: video_id, KeyDmc.IS_PUBLIC: False, KeyDmc.IS_DELETED: True}
+        return info
+
+    async def _retrieve_getflv(self, video_id: str) -> Optional[Dict]:
+        async with self.__semaphore:
+            async with self.session.get(URL.URL_GetFlv + video_id, endpoint=Endpoint.GETFLV) as response:
+                if response.status != 200:
+                    self.logger.debug(f"Video ID: {video_id}, Status: {response.status}")
+                    return None
+                content = await response.text()
+        return self._read_from_getflv(content)
+
+    @staticmethod
+    def _read_from_thumbinfo(video_id: str, content: str) -> Optional[Dict]:
+        """
+        getthumbinfo API の返事から情報を取り出す。
+
+        :param str video_id:
+        :param str content: APIの返事
+        :return: 動画が存在しなければ None
+        :rtype: Optional[Dict]
+        """
+        info = Thumbnail._parse_thumbinfo(video_id, content)
+        if info is None:
+            return None
+        info.update({
+            KeyDmc.FILE_SIZE : None,
+            KeyDmc.IS_DELETED: False,
+            KeyDmc.IS_PUBLIC : True,
+            KeyDmc.IS_DMC    : False,
+        })
+        return info
+
+    @staticmethod
+    def _read_from_getflv(content: str) -> Optional[Dict]:
+        """
+        getflv API の返事から、コメントと Smile サーバーの動画に要る情報を取り出す。
+
+        :param str content: APIの返事
+        :return: エラーが返ってきたら None
+        :rtype: Optional[Dict]
+        """
+        flvinfo = utils.extract_getflv(content)
+        if flvinfo is None:
+            return None
+        return {
+            KeyDmc.VIDEO_URL_SM : flvinfo[KeyGetFlv.VIDEO_URL],  # type: str
+            KeyDmc.IS_PREMIUM   : bool(flvinfo[KeyGetFlv.IS_PREMIUM]),  # type: bool
+            KeyDmc.USER_ID      : flvinfo[KeyGetFlv.USER_ID],  # type: int
+            KeyDmc.USER_KEY     : flvinfo[KeyGetFlv.USER_KEY],  # type: str
+            KeyDmc.MSG_SERVER   : flvinfo[KeyGetFlv.MSG_SERVER],  # type: str
+            KeyDmc.THREAD_ID    : flvinfo[KeyGetFlv.THREAD_ID],  # type: int
+            KeyDmc.OPT_THREAD_ID: flvinfo[KeyGetFlv.OPT_THREAD_ID],  # type: Optional[int]
+            KeyDmc.NEEDS_KEY    : flvinfo[KeyGetFlv.NEEDS_KEY],  # type: Optional[int]
+            # 公式動画にだけ optional_thread_id がある
+            KeyDmc.IS_OFFICIAL  : flvinfo[KeyGetFlv.OPT_THREAD_ID] is not None,  # type: bool
+        }
+
+    async def _retrieve_watch(self, video_id: str) -> Optional[Dict]:
         url = URL.URL_Watch + video_id
 
-        async with asyncio.Semaphore(self.__parallel_limit):
-            while attempt > 0:
-                attempt -= 1
-                async with self.session.get(url) as response:  # type: aiohttp.ClientResponse
-                    if response.status == 200:
-                        info_data = await response.text()
-                        return self._junction(info_data)
-                    elif 400 <= response.status < 500:
-                        break
-                    elif 500 <= response.status < 600:
-                        await asyncio.sleep(interval/2)
-                        print(Err.waiting_for_permission)
-                        await asyncio.sleep(interval/2)
-                        interval *= backoff
+        async with self.__semaphore:
+            # 5xx などの一時的な失敗は SessionManager が再試行する
+            async with self.session.get(url, endpoint=Endpoint.WATCH,
+                                        retry=self.__retry) as response:  # type: aiohttp.ClientResponse
+                if response.status == 200:
+                    content = None
+                    if self.streaming:
+                        kind, payload = await self._scan_streaming(response)
+                        # JSON の解析と辞書づくりはイベントループの外で行う
+                        info = await self.executor.run(self._parse, kind, payload)
                     else:
-                        break
+                        content = await response.text()
+                        kind, info = await self.executor.run(self._parse_page, content)
+                    return self._accept(kind, info, content)
+                self.logger.debug(f"Video ID: {video_id}, Status: {response.status}")
+
+    async def _scan_streaming(self, response: aiohttp.ClientResponse,
+                              chunk_size: int=1024*16) -> Tuple[Optional[str], Optional[str]]:
+        """
+        視聴ページを少しずつ読み、必要な部分が揃ったら残りは読まずに接続を閉じる。
+
+        :param aiohttp.ClientResponse response:
+        :param int chunk_size: 一度に読む大きさ
+        :rtype: Tuple[Optional[str], Optional[str]]
+        """
+        scanner = watchpage.Scanner()
+        decoder = codecs.getincrementaldecoder(response.get_encoding())(errors="replace")
+        async for chunk in response.content.iter_chunked(chunk_size):
+            if scanner.feed(decoder.decode(chunk)):
+                # 読み残しがあるので、接続はプールに返さずに切る
+                response.close()
+                break
+        else:
+            scanner.feed(decoder.decode(b"", final=True))
+        self.logger.debug(f"Scanned {scanner.received} characters of {response.url}")
+        return scanner.close()
 
     def _junction(self, content: str) -> Dict[str, Union[str, int, List[str], bool]]:
         """
@@ -147,25 +396,61 @@ class Info(utils.Canopy):
         :param str content:
         :rtype: Dict[str, Union[str, int, List[str], bool]]
         """
-        soup = BeautifulSoup(content, "html.parser")
-        if soup.select("#Login_nico"):
+        kind, info = self._parse_page(content)
+        return self._accept(kind, info, content)
+
+    @staticmethod
+    def _parse_page(content: str) -> Tuple[Optional[str], Optional[Dict]]:
+        """
+        視聴ページのHTMLを解析する。副作用がないので、別のプロセスでも実行できる。
+
+        :param str content:
+        :return: (watchpage.DATA_API などの種類, 動画の情報)
+        :rtype: Tuple[Optional[str], Optional[Dict]]
+        """
+        # ページ全体を BeautifulSoup にかけると遅いので、目印のタグを直接探す
+        kind, payload = watchpage.extract(content)
+        return kind, Info._parse(kind, payload)
+
+    @staticmethod
+    def _parse(kind: Optional[str], payload: Optional[str]) -> Optional[Dict]:
+        """
+        視聴ページから取り出したJSONを、種類に応じた担当者へ振り向ける。
+
+        :param Optional[str] kind: watchpage.DATA_API などの種類
+        :param Optional[str] payload: 取り出したJSONの文字列
+        :rtype: Optional[Dict]
+        """
+        if kind == watchpage.DATA_API:
+            return Info._read_from_data_api(payload)
+        elif kind == watchpage.WATCH_API:
+            return Info._read_from_watch_api(payload)
+
+    def _accept(self, kind: Optional[str], info: Optional[Dict],
+                content: Optional[str]=None) -> Optional[Dict[str, Union[str, int, List[str], bool]]]:
+        """
+        解析した結果を受け取る。ログインに失敗していれば終了する。
+
+        :param Optional[str] kind: watchpage.DATA_API などの種類
+        :param Optional[Dict] info: 動画の情報
+        :param Optional[str] content: 元のHTML (読み取れなかったときに書き出す)
+        :rtype: Optional[Dict[str, Union[str, int, List[str], bool]]]
+        """
+        if kind == watchpage.LOGIN:
             print("Login Failed", file=sys.stderr)
             sys.exit()
-        _data_api = soup.select("#js-initial-watch-data")
-        _watch_api = soup.select("#watchAPIDataContainer")
-        if _data_api:
-            return self._read_from_data_api(_data_api[0]["data-api-data"])
-        elif _watch_api:
-            return self._read_from_watch_api(_watch_api[0].text)
+        if info is not None:
+            return info
         else:
-            if self.logger.is_debug:
+            if self.logger.is_debug and content is not None:
                 file_name = "_#_niconico_#_.html"
                 with open(file_name, "w", encoding="utf-8") as fd:
                     fd.write(content)
                 print(f"Unknown HTML structure has been met."
                       f" It's exported for debugging at {Path.cwd()/file_name}.", file=sys.stderr)
 
-    def _read_from_data_api(self, content: str) -> Dict:
+    @staticmethod
+    def _read_from_data_api(content: str) -> Dict:
         """
         data-api-data 属性を持つタグがあるHTMLから情報を取り出す。
 
@@ -244,7 +529,8 @@ class Info(utils.Canopy):
             })
         return info
 
-    def _read_from_watch_api(self, content: str) -> Dict:
+    @staticmethod
+    def _read_from_watch_api(content: str) -> Dict:
         """
         watchAPIDataContainer を含む HTML から情報を取り出す。
 
@@ -328,8 +614,10 @@ class Thumbnail(utils.Canopy):
                  is_large: bool=True,
                  limit: int=8,
                  logger: Optional[utils.NTLogger]=None,
-                 session: Optional[aiohttp.ClientSession]=None,
+                 session: Union[SessionManager, aiohttp.ClientSession, None]=None,
                  loop: Optional[asyncio.AbstractEventLoop]=None,
+                 executor: Optional[ParseExecutor]=None,
+                 writer: Optional[fileio.DiskWriter]=None,
                  ):
         """
         サムネイル画像をダウンロードする。
@@ -340,15 +628,23 @@ class Thumbnail(utils.Canopy):
         :param bool is_large: 大きいサムネイルを取りに行くかどうか
         :param T<= logging.logger logger: ロガー
         :param int limit: 同時にアクセスする最大数
-        :param aiohttp.ClientSession session:
+        :param Union[SessionManager, aiohttp.ClientSession, None] session:
+         借りてくるセッション。指定した場合は閉じない。
         :param asyncio.AbstractEventLoop loop: イベントループ
+        :param Optional[ParseExecutor] executor: getthumbinfo の解析を実行する場所。省略するとスレッドプール
+        :param Optional[fileio.DiskWriter] writer: 画像を書き込む場所。省略すると自前で用意する
         """
         super().__init__(loop=loop, logger=logger)
+        self.executor = executor or ParseExecutor(loop=self.loop)
+        self.writer = writer or fileio.DiskWriter()
+        self.__owns_writer = writer is None
         self.undone = []
         self.done = []
         self.__bucket = {}
-        self.session = session or self.loop.run_until_complete(self.get_session())
-        self.__parallel_limit = limit
+        self.__is_borrowed = session is not None
+        self.session = SessionManager.wrap(session) or self.loop.run_until_complete(self.get_session())
+        self.__semaphore = asyncio.Semaphore(limit)
+        self.__limit = limit
         self.glossary = {}
         self.save_dir = utils.get_dir(save_dir)
         if isinstance(videoids, list):
@@ -357,14 +653,15 @@ class Thumbnail(utils.Canopy):
         self.glossary = videoids
         self.is_large = is_large
 
-    async def get_session(self) -> aiohttp.ClientSession:
-        return aiohttp.ClientSession()
+    async def get_session(self) -> SessionManager:
+        return await SessionManager(loop=self.loop, logger=self.logger).open()
 
     def close(self):
-        async def _close():
-            await self.session.close()
-
-        self.loop.run_until_complete(_close())
+        if self.__owns_writer:
+            self.writer.shutdown()
+        if self.__is_borrowed:
+            return
+        self.loop.run_until_complete(self.session.close())
 
     def start(self):
         """
@@ -376,29 +673,57 @@ class Thumbnail(utils.Canopy):
         if len(self.glossary) > 0:
             self.loop.run_until_complete(self._download(list(self.glossary), self.is_large))
             while len(self.undone) > 0:
-                self.loop.run_until_complete(self._download(self.undone, False))
+                # 処理中に書き換わるので写しを渡す
+                self.loop.run_until_complete(self._download(list(self.undone), False))
         self.close()
         return self.done
 
     async def _download(self, video_ids: list, islarge: bool=True) -> None:
-        urls = self._make_urls(video_ids, islarge)
+        # 一件ごとにタスクを作らず、決まった数の作業者が順に取りに行く
+        await utils.run_bounded(
+            ((idx, video_id, self._make_urls([video_id], islarge)[0])
+             for idx, video_id in enumerate(video_ids)),
+            self._download_one, self.__limit, self.logger)
+
+    async def _download_one(self, idx: int, video_id: str, url: str) -> None:
+        image_data = await self._worker(idx, video_id, url)
+        if image_data:
+            await self._write(video_id, image_data)
 
-        futures = []
-        for idx, video_id, _url in zip(range(len(video_ids)), video_ids, urls):
-            coro = self._worker(idx, video_id, _url)
-            f = asyncio.ensure_future(coro)
-            f.add_done_callback(functools.partial(self._saver, video_id))
-            futures.append(f)
-        await asyncio.wait(futures, loop=self.loop)
+    async def fetch(self, video_id: str, info: Dict, idx: int=0, total: Optional[int]=None) -> bool:
+        """
+        一件だけダウンロードする。パイプラインから情報が届くたびに呼ばれる。
 
-    async def _worker(self, idx: int, video_id: str, url: str) -> Optional[bytes]:
-        async with asyncio.Semaphore(self.__parallel_limit):
+        :param str video_id:
+        :param Dict info: 動画の情報
+        :param int idx: 何番目の動画か
+        :param Optional[int] total: 全体の件数
+        :rtype: bool
+        """
+        self.glossary[video_id] = info
+        try:
+            # 大きいサムネイルがなければ小さいほうを取りに行く
+            urls = self._make_urls([video_id], True) if self.is_large else []
+            urls += self._make_urls([video_id], False)
+            for url in urls:
+                image_data = await self._worker(idx, video_id, url, total)
+                if image_data:
+                    await self._write(video_id, image_data)
+                    return True
+            return False
+        finally:
+            # 終わった動画の情報は持ち続けない
+            del self.glossary[video_id]
+
+    async def _worker(self, idx: int, video_id: str, url: str,
+                      total: Optional[int]=None) -> Optional[bytes]:
+        async with self.__semaphore:
 
             self.logger.info(Msg.nd_download_pict.format(
-                idx + 1, len(self.glossary), video_id, self.glossary[video_id][KeyGTI.TITLE]))
+                idx + 1, total or len(self.glossary), video_id, self.glossary[video_id][KeyGTI.TITLE]))
 
             try:
-                async with self.session.get(url, timeout=10) as response:
+                async with self.session.get(url, timeout=10, endpoint=Endpoint.THUMBNAIL) as response:
                     if response.status == 200:
                         # ダウンロードに成功したら「未完了のリスト」から取り除く
                         if video_id in self.undone:
@@ -409,16 +734,13 @@ class Thumbnail(utils.Canopy):
             except asyncio.TimeoutError:
                 return None
 
-    def _saver(self, video_id: str, coroutine: asyncio.Task) -> None:
-        image_data = coroutine.result()
-        if image_data:
-            file_path = utils.make_name(self.glossary[video_id], self.save_dir, extention="jpg")
-            self.logger.debug(f"File Path: {file_path}")
+    async def _write(self, video_id: str, image_data: bytes) -> None:
+        file_path = utils.make_name(self.glossary[video_id], self.save_dir, extention="jpg")
+        self.logger.debug(f"File Path: {file_path}")
 
-            with file_path.open('wb') as f:
-                f.write(image_data)
-            self.logger.info(Msg.nd_download_done.format(path=file_path))
-            self.done.append(video_id)
+        await self.writer.write_file(file_path, image_data)
+        self.logger.info(Msg.nd_download_done.format(path=file_path))
+        self.done.append(video_id)
 
     def _make_urls(self, video_ids: list, is_large: bool=True) -> list:
         """
@@ -455,18 +777,33 @@ class Thumbnail(utils.Canopy):
         return result
 
     async def _get_infos_worker(self, video_id: str):
-        async with asyncio.Semaphore(self.__parallel_limit):
-            async with self.session.get(URL.URL_Info + video_id) as resp:
+        async with self.__semaphore:
+            async with self.session.get(URL.URL_Info + video_id, endpoint=Endpoint.THUMBINFO) as resp:
                 result = await resp.text()
 
-            soup = BeautifulSoup(result, "html.parser")
-            if soup.nicovideo_thumb_response["status"].lower() == "ok":
-                self.__bucket[video_id] = {
-                    KeyGTI.FILE_NAME    : utils.t2filename(soup.select(KeyGTI.TITLE)[0].text),
-                    KeyGTI.THUMBNAIL_URL: soup.select(KeyGTI.THUMBNAIL_URL)[0].text,
-                    KeyGTI.TITLE        : html.unescape(soup.select(KeyGTI.TITLE)[0].text),
-                    KeyGTI.VIDEO_ID     : video_id
-                }
+            info = await self.executor.run(self._parse_thumbinfo, video_id, result)
+            if info is not None:
+                self.__bucket[video_id] = info
+
+    @staticmethod
+    def _parse_thumbinfo(video_id: str, content: str) -> Optional[Dict]:
+        """
+        getthumbinfo API の返事を解析する。副作用がないので、別のプロセスでも実行できる。
+
+        :param str video_id:
+        :param str content: APIの返事
+        :return: 動画が存在しなければ None
+        :rtype: Optional[Dict]
+        """
+        soup = BeautifulSoup(content, "html.parser")
+        if soup.nicovideo_thumb_response["status"].lower() == "ok":
+            return {
+                KeyGTI.FILE_NAME    : utils.t2filename(soup.select(KeyGTI.TITLE)[0].text),
+                KeyGTI.THUMBNAIL_URL: soup.select(KeyGTI.THUMBNAIL_URL)[0].text,
+                KeyGTI.TITLE        : html.unescape(soup.select(KeyGTI.TITLE)[0].text),
+                KeyGTI.MOVIE_TYPE   : soup.select(KeyGTI.MOVIE_TYPE)[0].text,
+                KeyGTI.VIDEO_ID     : video_id
+            }
 
 
 class Video(utils.Canopy):
@@ -477,11 +814,20 @@ class Video(utils.Canopy):
                  save_dir: Union[str, Path]=None,
                  multiline: bool=True,
                  smile: bool=False,
-                 chunk_size: int=1024*50,
-                 division: int=4,
+                 chunk_size: int=1024*1024,
+                 division: Optional[int]=4,
                  logger: Optional[utils.NTLogger]=None,
                  loop: Optional[asyncio.AbstractEventLoop]=None,
-                 cookie_jar: Optional[aiohttp.client.AbstractCookieJar]=None
+                 cookie_jar: Optional[aiohttp.client.AbstractCookieJar]=None,
+                 session: Union[SessionManager, aiohttp.ClientSession, None]=None,
+                 preallocate: bool=True,
+                 parallel: int=1,
+                 connections: Optional[int]=None,
+                 in_flight: Optional[int]=None,
+                 writer: Optional[fileio.DiskWriter]=None,
+                 progress: Optional[ProgressBus]=None,
+                 stream: Optional[Callable[[str, bytes], Awaitable[None]]]=None,
+                 window: int=ReorderBuffer.WINDOW,
                  ):
         """
         動画をダウンロードする。
@@ -489,13 +835,25 @@ class Video(utils.Canopy):
         :param mail: メールアドレス
         :param password: パスワード
         :param logger: ロガー
-        :param division: いくつに分割するか
-        :param chunk_size: サーバーに一度に要求するデータ量
+        :param division: いくつの接続で手分けするか。 None なら速さを測りながら決める
+        :param chunk_size: 一度に受け取るデータ量の上限。 division が None なら最初の値
         :param multiline: プログレスバーを複数行で表示するか
         :param loop: イベントループ
+        :param session: 借りてくるセッション。指定した場合は閉じない。
+        :param preallocate: 完成品のファイルを先に作って直接書き込むかどうか。
+         False なら部分ファイルに書いてから結合する。
+        :param parallel: 何本の動画を並べてダウンロードするか
+        :param connections: smile と DMC を合わせて、同時に張る接続の数の上限
+        :param in_flight: 頼んだまま受け取っていないバイト数の上限
+        :param writer: 動画を書き込む場所。省略すると自前で用意する
+        :param progress: 進み具合の出し先。省略すると multiline に従ってプログレスバーを出す
+        :param stream: 指定すると、ファイルに保存せず、動画IDと中身を前から順にこれに渡す
+        :param window: stream に渡すために並べ直す間、持っておくバイト数の上限
         """
         super().__init__(loop=loop, logger=logger)
-        self.session = self.loop.run_until_complete(self.get_session(mail, password, cookie_jar))
+        self.__is_borrowed = session is not None
+        self.session = (SessionManager.wrap(session) or
+                        self.loop.run_until_complete(self.get_session(mail, password, cookie_jar)))
         self.commons = {
             DataKey.SESSION     : self.session,
             DataKey.LOGGER      : self.logger,
@@ -504,53 +862,153 @@ class Video(utils.Canopy):
             DataKey.IS_MULTILINE: multiline,
             DataKey.IS_SMILE    : smile,
             DataKey.DIVISION    : division,
-            DataKey.SAVE_DIR    : utils.get_dir(save_dir)
-        }  # type: Dict[str, Union[int, bool, Path, aiohttp.ClientSession, asyncio.AbstractEventLoop, utils.NTLogger]]
+            DataKey.SAVE_DIR    : utils.get_dir(save_dir),
+            DataKey.PREALLOCATE : preallocate,
+            DataKey.PARALLEL    : parallel,
+            DataKey.BUDGET      : TransferBudget(connections, in_flight),
+            DataKey.HEARTBEAT   : HeartbeatManager(self.session, self.logger, loop=self.loop),
+            DataKey.WRITER      : writer or fileio.DiskWriter(),
+            DataKey.PROGRESS    : progress or ProgressBus([TqdmSink(per_connection=multiline)]),
+            DataKey.STREAM      : stream,
+            DataKey.WINDOW      : window,
+        }  # type: Dict[str, Union[int, bool, Path, SessionManager, asyncio.AbstractEventLoop, utils.NTLogger]]
+        self.parallel = parallel
+        self.__owns_writer = writer is None
+        self.__owns_progress = progress is None
 
         self.glossary = videoids
         if isinstance(videoids, list):
-            info = Info(utils.validator(videoids), mail=mail, password=password, session=self.commons[DataKey.SESSION])
+            info = Info(utils.validator(videoids), mail=mail, password=password,
+                        session=self.session, logger=self.logger, loop=self.loop)
             self.glossary = info.info
-            self.commons[DataKey.SESSION] = info.session
-
+        # パイプラインから一件ずつ渡されるときに使い回す
+        self.__smile = None  # type: Optional[VideoSmile]
+        self.__dmc = None  # type: Optional[VideoDmc]
 
-    async def get_session(self, mail: str, password: str, cookie_jar: Optional[aiohttp.client.AbstractCookieJar]=None) -> aiohttp.ClientSession:
-        cook = utils.LogIn(mail=mail, password=password).cookie
+    async def get_session(self, mail: str, password: str,
+                          cookie_jar: Optional[aiohttp.client.AbstractCookieJar]=None) -> SessionManager:
+        cook = dict(utils.LogIn(mail=mail, password=password).cookie)
         if cookie_jar:
             for cookie in cookie_jar:
                 cook[cookie.key] = cookie.value
-        return aiohttp.ClientSession(cookies=cook)
+        return await SessionManager(cookies=cook, loop=self.loop, logger=self.logger).open()
 
     def start(self):
-        if self.commons[DataKey.IS_SMILE]:
-            VideoSmile(self.glossary, self.commons).callee()
-        else:
-            dmc_list = {key: val for key, val in self.glossary.items() if val[KeyDmc.IS_DMC] is True}
-            sml_list = {key: val for key, val in self.glossary.items() if val[KeyDmc.IS_DMC] is False}
-            if len(dmc_list) > 0:
-                VideoDmc(dmc_list, self.commons).callee()
-            if len(sml_list) > 0:
-                VideoSmile(sml_list, self.commons).callee()
-
+        self.loop.run_until_complete(self._broker())
         self.close()
         return True
 
-    def close(self):
-        async def _close():
-            await self.session.close()
+    async def _broker(self) -> None:
+        # smile と DMC を分けずに、同じ枠の中で parallel 本ずつ並べて取る
+        videos = list(self.glossary.items())
 
-        self.loop.run_until_complete(_close())
+        def source():
+            for idx, (video_id, info) in enumerate(videos):
+                # 後ろの DMC の動画のセッションを、前の動画を取っている間に作っておく
+                for ahead_id, ahead_info in videos[idx + 1:idx + 1 + self.parallel]:
+                    self.prepare(ahead_id, ahead_info)
+                yield video_id, info, idx, len(videos)
 
+        await utils.run_bounded(source(), self.fetch, self.parallel, self.logger)
 
+    def prepare(self, video_id: str, info: Dict) -> None:
+        """
+        もうすぐ fetch する動画を知らせる。 DMC ならセッションを先に作り始める。
 
-class VideoSmile:
-    def __init__(self,
-                 glossary: Dict[str, Union[str, int, bool, List]],
-                 common: Dict[str, Union[int, bool, Path, aiohttp.ClientSession,
-                         asyncio.AbstractEventLoop, utils.NTLogger]]):
+        :param str video_id:
+        :param Dict info: 動画の情報
         """
-        Smileサーバーから動画をダウンロードする。
+        if not info[KeyDmc.IS_DMC] or self.commons[DataKey.IS_SMILE]:
+            return
+        dmc = self._downloader(info)
+        if video_id not in dmc.glossary:
+            dmc.glossary[video_id] = info
+            if not dmc.prefetch(video_id):
+                del dmc.glossary[video_id]
+
+    def _downloader(self, info: Dict) -> Union["VideoSmile", "VideoDmc"]:
+        if info[KeyDmc.IS_DMC] and not self.commons[DataKey.IS_SMILE]:
+            if self.__dmc is None:
+                self.__dmc = VideoDmc({}, self.commons)
+            return self.__dmc
+        if self.__smile is None:
+            self.__smile = VideoSmile({}, self.commons)
+        return self.__smile
+
+    async def fetch(self, video_id: str, info: Dict, idx: int=0, total: Optional[int]=None) -> None:
+        """
+        一件だけダウンロードする。パイプラインから情報が届くたびに呼ばれる。
+
+        :param str video_id:
+        :param Dict info: 動画の情報
+        :param int idx: 何番目の動画か
+        :param Optional[int] total: 全体の件数
+        """
+        self.glossary[video_id] = info
+        worker = self._downloader(info)
+        worker.glossary[video_id] = info
+        try:
+            await worker.fetch(idx, video_id, total)
+        finally:
+            # 終わった動画の情報は持ち続けない
+            del worker.glossary[video_id]
+            del self.glossary[video_id]
+
+    async def discard_sessions(self) -> None:
+        """
+        先に作った DMC のセッションを捨て、 Heartbeat を止める。
 
+        借りてきたセッションや writer には触らないので、
+        パイプラインの途中で止めたときにも呼べる。
+        """
+        if self.__dmc is not None:
+            self.__dmc.discard_sessions()
+        await self.commons[DataKey.HEARTBEAT].close()
+
+    def close(self):
+        self.loop.run_until_complete(self.discard_sessions())
+        if self.__owns_writer:
+            self.commons[DataKey.WRITER].shutdown()
+        if self.__owns_progress:
+            self.loop.run_until_complete(self.commons[DataKey.PROGRESS].close())
+        if self.__is_borrowed:
+            return
+        self.loop.run_until_complete(self.session.close())
+
+
+class _Transfer:
+    def __init__(self, video_id: str, file_path: Path, video_url: str, manifest: RangeManifest,
+                 scheduler: SegmentScheduler, tuner: Optional[ThroughputTuner], workers: int,
+                 stream: Optional[ReorderBuffer]=None):
+        """
+        一本の動画のダウンロードに使うものをまとめておく。
+        同じ VideoDownloader で何本も並べて取るので、動画ごとの状態はこちらに持つ。
+        """
+        self.video_id = video_id
+        self.file_path = file_path
+        self.video_url = video_url
+        self.manifest = manifest
+        self.scheduler = scheduler
+        self.tuner = tuner
+        # ファイルに書かずに、前から順に渡していく先
+        self.stream = stream
+        # 接続ごとに取ってきたバイト数。プログレスバーと速さの計測に使う
+        self.downloaded = [0] * workers  # type: List[int]
+
+
+class VideoDownloader:
+    SEGMENT_SIZE = 4 * 1024 * 1024  # 最初に分ける範囲の大きさ
+    MIN_SPLIT = 512 * 1024  # 範囲を切り分けるときの、それぞれの残りの下限
+    STALL_TIMEOUT = 30  # これだけの秒数データが届かなければ接続し直す
+    STREAM_DIVISION = 4  # 流すときに division が決まっていなければ使う接続の数
+    EXPIRED_STATUSES = ()  # type: Tuple[int, ...]  # 動画のサーバーがこれを返したらセッションが切れている
+
+    def __init__(self,
+                 glossary: Dict[str, Dict[str, Union[str, int, bool, List]]],
+                 common: Dict[str, Union[int, bool, Path, SessionManager,
+                                         asyncio.AbstractEventLoop, utils.NTLogger]]):
+        """
+        動画を分割してダウンロードする。 VideoSmile と VideoDmc が共通して使う部分。
         """
         self.glossary = glossary
         self.session = common[DataKey.SESSION]
@@ -561,174 +1019,582 @@ class VideoSmile:
         self.multiline = common[DataKey.IS_MULTILINE]
         self.smile = common[DataKey.IS_SMILE]
         self.division = common[DataKey.DIVISION]
-        # (実際のダウンロード前のファイルサイズの確認で)同時にアクセスする最大数
-        self.__parallel_limit = 4
-        # 分割数と同じだけの要素を持つリストを作り、各要素にそれぞれが
-        # 保存したファイルサイズを記録する。プログレスバーに利用する。
-        self.__downloaded_size = [0] * common[DataKey.DIVISION]  # type: List[int]
-
-    def callee(self):
-        # まず各動画のファイルサイズを集める。
-        self.loop.run_until_complete(self._push_file_size())
-        self.loop.run_until_complete(self._broker())
-        return True
+        self.preallocate = common.get(DataKey.PREALLOCATE, True)
+        # 動画を何本並べて取るか。接続と頼む量の上限は budget が全体で受け持つ
+        self.parallel = common.get(DataKey.PARALLEL, 1)
+        self.budget = common.get(DataKey.BUDGET)  # type: Optional[TransferBudget]
+        self.writer = common.get(DataKey.WRITER) or fileio.DiskWriter()  # type: fileio.DiskWriter
+        self.progress = (common.get(DataKey.PROGRESS) or
+                         ProgressBus([TqdmSink(per_connection=self.multiline)]))  # type: ProgressBus
+        # これがあればファイルに保存せず、動画IDと中身を前から順に渡す
+        self.stream = common.get(DataKey.STREAM)  # type: Optional[Callable[[str, bytes], Awaitable[None]]]
+        self.window = common.get(DataKey.WINDOW) or ReorderBuffer.WINDOW  # type: int
+        # ストリームに流している途中の動画。セッションを作り直したらその続きから流す
+        self.__streams = {}  # type: Dict[str, Tuple[RangeManifest, ReorderBuffer]]
 
-    async def _push_file_size(self):
-        video_ids = sorted(self.glossary)
-        tasks = [self._get_file_size_worker(video_id) for video_id in video_ids]
-        async with asyncio.Semaphore(self.__parallel_limit):
-            result = await asyncio.gather(*tasks)
-        for _id, size in zip(video_ids, result):
-            self.glossary[_id][KeyDmc.FILE_SIZE] = size
-
-    async def _get_file_size_worker(self, video_id: str) -> int:
-        vid_url = self.glossary[video_id][KeyDmc.VIDEO_URL_SM]
-        self.logger.debug(f"Video ID: {video_id}, Video URL: {vid_url}")
-        async with self.session.head(vid_url) as resp:
+    async def _get_file_size(self, video_id: str, video_url: str) -> int:
+        self.logger.debug(f"Video ID: {video_id}, Video URL: {video_url}")
+        async with self.session.head(video_url, endpoint=Endpoint.VIDEO) as resp:
             headers = resp.headers
             self.logger.debug(f"Headers: {str(headers)}")
             return int(headers["content-length"])
 
-    async def _broker(self):
-        futures = []
-        for idx, video_id in enumerate(self.glossary):
-            coro = self._download(idx, video_id)
-            f = asyncio.ensure_future(coro)
-            f.add_done_callback(functools.partial(self._combiner, video_id))
-            futures.append(f)
-        await asyncio.wait(futures, loop=self.loop)
-
-    async def _download(self, idx: int, video_id: str):
-        division = self.division
+    async def _download_ranges(self, idx: int, video_id: str, video_url: str, file_size: int,
+                               total: Optional[int]=None) -> None:
+        """
+        動画を SEGMENT_SIZE ほどの小さな範囲に分け、 division 本の接続で手分けしてダウンロードする。
+
+        手の空いた接続は残りの多い範囲を切り分けて引き受け、止まった接続は範囲を手放して
+        繋ぎ直すので、一番遅い接続に全体が引きずられない。
+        preallocate なら最初に完成品の大きさのファイルを作り、それぞれが自分の位置に書き込む。
+        そうでなければ video.mp4.000 のような部分ファイルに書き、最後に結合する。
+        進み具合は video.mp4.ranges.json に記録し、前回の続きがあれば足りない部分だけを取ってくる。
+        stream があればファイルには書かず、並べ直して前から順に stream に渡す。
+
+        :param int idx: 何番目の動画か
+        :param str video_id:
+        :param str video_url: 動画本体のURL
+        :param int file_size: 動画の大きさ
+        :param Optional[int] total: 全体の件数
+        """
         file_path = utils.make_name(self.glossary[video_id], self.save_dir)
 
         self.logger.info(Msg.nd_download_video.format(
-            idx + 1, len(self.glossary), video_id, self.glossary[video_id][KeyDmc.TITLE]))
+            idx + 1, total or len(self.glossary), video_id, self.glossary[video_id][KeyDmc.TITLE]))
 
-        video_url = self.glossary[video_id][KeyDmc.VIDEO_URL_SM]
-        file_size = self.glossary[video_id][KeyDmc.FILE_SIZE]
-        headers = [{
-            "Range": f"bytes={int(file_size*order/division)}-{int((file_size*(order+1))/division-1)}"
-           } for order in range(division)]
-
-        for i, h in enumerate(headers):
-            self.logger.debug(f"Header {i}: {str(h)}")
-
-        if self.multiline:
-            progress_bars = [tqdm(total=int(file_size / division),
-                                  leave=False, position=order,
-                                  unit="B", unit_scale=True,
-                                  file=sys.stdout)
-                             for order in range(division)]  # type: List[tqdm]
-            tasks = [self._download_worker(file_path, video_url, header, order, pbar)
-                     for header, order, pbar
-                     in zip(headers, range(division), progress_bars)]
-            progress_bars = await asyncio.gather(*tasks)  # type: List[tqdm]
-            # ネストの「内側」から順に消さないと棒が画面に残る。
-            for pbar in reversed(progress_bars):
-                pbar.close()
+        stream = None
+        if self.stream is not None:
+            manifest, stream = self._open_stream(video_id, file_path, file_size)
         else:
-            tasks = [self._download_worker(file_path, video_url, header, order)
-                     for header, order
-                     in zip(headers, range(division))]
-            await asyncio.gather(*tasks, self._counter_whole(file_size))
-
-    async def _download_worker(self, file_path: Union[str, Path], video_url: str,
-                               header: dict, order: int, pbar: tqdm=None) -> tqdm:
-        file_path = Path(f"{file_path}.{order:03}")
-        # => video.mp4.000 ～ video.mp4.003 (4分割の場合)
-        with file_path.open("wb") as fd:
-            # Don't set timeout (default 5 min) for downloads
-            timeout = aiohttp.ClientTimeout(total=None, connect=60)
-            async with self.session.get(url=video_url, headers=header, timeout=timeout) as video_data:
-                self.logger.debug(f"Started! Header: {header}, Video URL: {video_url}")
-                while True:
-                    data = await video_data.content.read(self.chunk_size)
-                    if not data:
-                        break
-                    downloaded_size = fd.write(data)
-                    self.__downloaded_size[order] += downloaded_size
-                    if pbar:
-                        pbar.update(downloaded_size)
-        self.logger.debug(f"Order {order}: done!")
-        return pbar
-
-    async def _counter_whole(self, file_size: int, interval: int=1):
-        """
-        ダウンロード済みのファイルサイズを総合して一つのプログレスバーに表示する。
-
-        :param int file_size: 全体のファイルサイズ
-        :param int interval: ダウンロード率を更新する間隔
-        """
-        with tqdm(total=file_size, unit="B") as pbar:
-            oldsize = 0
+            manifest = self._resume(file_path, self._identity(video_id, video_url), file_size)
+        tuner = None
+        # 流すときは接続を減らさない。先頭の範囲を手放した接続が抜けると、後ろが window で止まったままになる
+        if not self.division and stream is None:
+            tuner = ThroughputTuner(file_size - manifest.committed, chunk_size=self.chunk_size)
+        workers = tuner.target if tuner else self.division or self.STREAM_DIVISION
+        scheduler = SegmentScheduler(manifest.segments, self.MIN_SPLIT)
+        transfer = _Transfer(video_id, file_path, video_url, manifest, scheduler,
+                             tuner, tuner.max_workers if tuner else workers, stream)
+        # 接続は transfer.downloaded を足すだけで、表示は progress がまとめて行う
+        progress = self.progress.track(video_id, file_size, manifest.committed, transfer.downloaded)
+
+        def spawn(worker: int) -> asyncio.Future:
+            return asyncio.ensure_future(self._download_worker(transfer, worker))
+
+        completed = False
+        try:
+            try:
+                await self._supervise(transfer, spawn, workers)
+                # 取りこぼした範囲があれば、完成品として扱わずに記録を残して続きから取れるようにする
+                missing = sum(end - start for _, start, end in manifest.missing())
+                if missing:
+                    raise IOError(Err.incomplete_download.format(video_id=video_id, missing=missing))
+                if stream is not None:
+                    await stream.finish()
+            except BaseException:
+                self.progress.finish(progress, succeeded=False)
+                raise
+            self.progress.finish(progress)
+
+            if stream is not None:
+                del self.__streams[video_id]
+            elif not self.preallocate:
+                # 中身のない範囲は部分ファイルを作っていない
+                orders = sorted((order for order, (start, end, _) in enumerate(manifest.segments)
+                                 if end > start), key=lambda order: manifest.segments[order][0])
+                await self._combine(file_path, orders)
+            completed = True
+        finally:
+            if stream is not None:
+                if not completed:
+                    # 渡し終えていないものは捨てて、やり直すときにそこから取り直す
+                    manifest.rewind(stream.position)
+                    stream.reset()
+            elif completed:
+                manifest.remove()
+            else:
+                manifest.save()
+        if stream is not None:
+            self.logger.info(Msg.nd_stream_done.format(video_id=video_id))
+        else:
+            self.logger.info(Msg.nd_download_done.format(path=file_path))
+
+    def _open_stream(self, video_id: str, file_path: Path,
+                     file_size: int) -> Tuple[RangeManifest, ReorderBuffer]:
+        """
+        流している途中ならその続きを、なければ新しく分け方を決めて流す先を用意する。
+
+        流すときは記録をファイルに残さないので、前回の続きはこのプロセスの中でしか使えない。
+
+        :param str video_id:
+        :param Path file_path: 保存するならこの名前になるファイル (ログにだけ使う)
+        :param int file_size: 動画の大きさ
+        :rtype: Tuple[RangeManifest, ReorderBuffer]
+        """
+        if video_id in self.__streams:
+            manifest, stream = self.__streams[video_id]
+            self.logger.info(Msg.nd_resume.format(path=file_path, done=stream.position, size=file_size))
+            return manifest, stream
+        count = max(self.division or self.STREAM_DIVISION, -(-file_size // self.SEGMENT_SIZE))
+        manifest = RangeManifest.plan(file_path, video_id, file_size, count, RangeManifest.PREALLOCATED)
+        stream = ReorderBuffer(functools.partial(self.stream, video_id), file_size, self.window)
+        self.__streams[video_id] = (manifest, stream)
+        return manifest, stream
+
+    async def _close_stream(self, video_id: str) -> None:
+        """
+        流している途中の動画を諦める。やり直さないことが決まったら呼ぶ。
+
+        :param str video_id:
+        """
+        manifest_stream = self.__streams.pop(video_id, None)
+        if manifest_stream is not None:
+            await manifest_stream[1].abort()
+
+    async def _supervise(self, transfer: "_Transfer", spawn, workers: int) -> None:
+        """
+        接続を走らせて、全部が終わるまで待つ。
+
+        transfer.tuner があれば interval ごとに速さを測り、接続を増やしたり減らしたりする。
+        減らすときは、番号の大きいものが今の読み込みを終えたところで範囲を手放して抜ける。
+        手放された範囲を拾う接続がもう抜けていれば、残っている番号の接続を走らせ直す。
+
+        :param _Transfer transfer: ダウンロード中の動画
+        :param spawn: 接続の番号を受け取ってタスクを返す関数
+        :param int workers: 最初の接続の数
+        """
+        tuner, scheduler = transfer.tuner, transfer.scheduler
+        tasks = {worker: spawn(worker) for worker in range(workers)}  # type: Dict[int, asyncio.Future]
+        running = workers
+        try:
             while True:
-                newsize = sum(self.__downloaded_size)
-                if newsize >= file_size:
-                    pbar.update(file_size - oldsize)
+                if tuner and scheduler.unclaimed():
+                    # 減らした接続が手放した範囲は、仕事がなくて抜けた接続には拾えない
+                    for worker in range(tuner.target):
+                        if worker not in tasks or tasks[worker].done():
+                            tasks[worker] = spawn(worker)
+                pending = [task for task in tasks.values() if not task.done()]
+                if not pending:
                     break
-                pbar.update(newsize - oldsize)
-                oldsize = newsize
-                await asyncio.sleep(interval)
+                await asyncio.wait(pending, timeout=tuner.interval if tuner else None,
+                                   return_when=asyncio.FIRST_EXCEPTION)
+                for task in tasks.values():
+                    if task.done() and not task.cancelled() and task.exception() is not None:
+                        raise task.exception()
+                if tuner:
+                    target = tuner.adjust(sum(transfer.downloaded))
+                    # 仕事がなくて抜けた接続は起こさず、増えた分だけ走らせる
+                    for worker in range(running, target):
+                        if worker not in tasks or tasks[worker].done():
+                            tasks[worker] = spawn(worker)
+                    running = target
+        finally:
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+    def _identity(self, video_id: str, video_url: str) -> str:
+        """
+        前回と同じものを取ってきているかを確かめるための文字列。
+
+        :param str video_id:
+        :param str video_url: 動画本体のURL
+        :rtype: str
+        """
+        return f"{video_id}:{video_url}"
+
+    def _part_path(self, file_path: Path, order: int) -> Path:
+        return Path(f"{file_path}.{order:03}")
+
+    def _resume(self, file_path: Path, identity: str, file_size: int) -> RangeManifest:
+        """
+        前回の記録があって手元のファイルと食い違っていなければそれを使い、
+        なければ新しく分け方を決めてファイルを用意する。
+
+        :param Path file_path: 完成品のファイル
+        :param str identity: 取ってくるものを表す文字列
+        :param int file_size: 動画の大きさ
+        :rtype: RangeManifest
+        """
+        layout = RangeManifest.PREALLOCATED if self.preallocate else RangeManifest.PARTS
+        manifest = RangeManifest.load(file_path, identity, file_size, layout)
+        if manifest is not None and self._check_resumable(manifest):
+            self.logger.info(Msg.nd_resume.format(
+                path=file_path, done=manifest.committed, size=file_size))
+            return manifest
+
+        count = max(self.division or 1, -(-file_size // self.SEGMENT_SIZE))
+        manifest = RangeManifest.plan(file_path, identity, file_size, count, layout)
+        if self.preallocate:
+            self._allocate(file_path, file_size)
+        manifest.save()
+        return manifest
+
+    @staticmethod
+    def _written(manifest: RangeManifest, order: int, length: int, future: asyncio.Future) -> None:
+        # 書き込みに失敗した分は記録に残さない (やり直すときに取り直す)
+        if not future.cancelled() and future.exception() is None:
+            manifest.commit(order, length)
+
+    def _check_resumable(self, manifest: RangeManifest) -> bool:
+        """
+        記録にある分だけのデータが本当にファイルに残っているかを確かめる。
+
+        :param RangeManifest manifest:
+        :rtype: bool
+        """
+        if manifest.layout == RangeManifest.PREALLOCATED:
+            try:
+                return manifest.file_path.stat().st_size == manifest.size
+            except OSError:
+                return False
+        for order, (_, _, done) in enumerate(manifest.segments):
+            if not done:
+                continue
+            part = self._part_path(manifest.file_path, order)
+            try:
+                if part.stat().st_size < done:
+                    return False
+            except OSError:
+                return False
+            # 記録より後ろに書かれた分は当てにならないので捨てる
+            with part.open("r+b") as fd:
+                fd.truncate(done)
+        return True
 
-    def _combiner(self, video_id: str, coroutine: asyncio.Task):
+    def _allocate(self, file_path: Path, file_size: int) -> None:
+        """
+        完成品と同じ大きさのファイルを先に作っておく。
+
+        :param Path file_path:
+        :param int file_size:
+        """
+        with file_path.open("wb") as fd:
+            fd.truncate(file_size)
+
+    async def _download_worker(self, transfer: "_Transfer", worker: int) -> None:
+        """
+        一本の接続として、範囲を引き受けてはダウンロードすることを、なくなるまで繰り返す。
+
+        :param _Transfer transfer: ダウンロード中の動画
+        :param int worker: 何本目の接続か
+        """
+        scheduler, tuner = transfer.scheduler, transfer.tuner
+        while tuner is None or worker < tuner.target:
+            order = scheduler.claim()
+            if order is None:
+                break
+            try:
+                await self._download_segment(transfer, worker, order)
+            finally:
+                scheduler.release(order)
+        self.logger.debug(f"Worker {worker}: done!")
+
+    async def _download_segment(self, transfer: "_Transfer", worker: int, order: int) -> None:
+        """
+        割り当てられた範囲の残りをダウンロードして書き込む。
+
+        budget があれば、接続と頼む量の枠を確保してから頼み、枠に収まる分だけを取ってくる。
+        途中で範囲が切り分けられたら新しい終わりで止める。
+        STALL_TIMEOUT 秒データが届かなければ、諦めて範囲を手放す。
+
+        :param _Transfer transfer: ダウンロード中の動画
+        :param int worker: 何本目の接続か
+        :param int order: 範囲の番号
+        """
+        scheduler, manifest, tuner = transfer.scheduler, transfer.manifest, transfer.tuner
+        granted = scheduler.remaining(order)
+        if self.budget:
+            granted = await self.budget.acquire(granted)
+        received = 0
+        try:
+            segment = manifest.segments[order]
+            start, end, done = segment
+            # 枠を待っている間に切り分けられたかもしれない
+            length = min(granted, scheduler.remaining(order))
+            if length <= 0:
+                return
+            header = {"Range": f"bytes={start + done}-{start + done + length - 1}"}
+            self.logger.debug(f"Worker {worker}, Order {order}: {header}")
+            if transfer.stream is not None:
+                # 流すときは、渡し終えた分だけを記録に残す
+                handle, offset = transfer.stream, start + done
+            else:
+                if self.preallocate:
+                    path, offset = transfer.file_path, start + done
+                else:
+                    # => video.mp4.000, video.mp4.001, ...
+                    path, offset = self._part_path(transfer.file_path, order), done
+                # 書き込みは writer のスレッドに任せ、書き終わった分だけを記録に残す
+                handle = await self.writer.open(path, truncate=not (self.preallocate or done))
+            try:
+                # Don't set timeout (default 5 min) for downloads
+                timeout = aiohttp.ClientTimeout(total=None, connect=60)
+                async with self.session.get(url=transfer.video_url, headers=header, timeout=timeout,
+                                            endpoint=Endpoint.VIDEO) as video_data:
+                    if video_data.status in self.EXPIRED_STATUSES:
+                        raise SessionLost(transfer.video_id, aiohttp.ClientResponseError(
+                            request_info=video_data.request_info, history=(), status=video_data.status))
+                    video_data.raise_for_status()
+                    self.logger.debug(f"Started! Header: {header}, Video URL: {transfer.video_url}")
+                    while received < length and scheduler.remaining(order) > 0:
+                        if tuner and worker >= tuner.target:
+                            # 接続を減らすことになったので、残りは他に任せる
+                            return
+                        chunk_size = tuner.chunk_size if tuner else self.chunk_size
+                        try:
+                            data = await asyncio.wait_for(video_data.content.read(
+                                min(chunk_size, length - received, scheduler.remaining(order))),
+                                self.STALL_TIMEOUT)
+                        except asyncio.TimeoutError:
+                            self.logger.warning(Msg.nd_segment_stalled.format(
+                                seconds=self.STALL_TIMEOUT, start=segment[0] + segment[2], end=segment[1] - 1))
+                            return
+                        if not data:
+                            break
+                        # 待っている間に後ろを切り分けられていれば、その分は捨てる
+                        data = data[:scheduler.remaining(order)]
+                        downloaded_size = len(data)
+                        # 書き込みを待つ間に切り分けられても重ならないよう、先に進めておく
+                        manifest.advance(order, downloaded_size, written=False)
+                        received += downloaded_size
+                        if self.budget:
+                            self.budget.consume(downloaded_size)
+                        transfer.downloaded[worker] += downloaded_size
+                        written = await handle.write(offset, data)
+                        written.add_done_callback(
+                            functools.partial(self._written, manifest, order, downloaded_size))
+                        offset += downloaded_size
+                        if transfer.stream is None:
+                            manifest.checkpoint()
+            finally:
+                await handle.close()
+        finally:
+            if self.budget:
+                self.budget.release(granted - received)
+
+    async def _combine(self, file_path: Path, orders: Iterable[int]):
         """
         ダウンロードが終わった後に分割したそれぞれを一つにまとめる関数。
 
-        :param asyncio.Task coroutine: 動画をダウンロードしたタスク
-        """
-        if coroutine.done() and not coroutine.cancelled():
-            file_path = utils.make_name(self.glossary[video_id], self.save_dir)
-            file_names = [f"{file_path}.{order:03}" for order in range(self.division)]
-            self.logger.debug(f"File names: {file_names}")
-            with file_path.open("wb") as fd:
-                for name in file_names:
-                    with open(name, "rb") as file:
-                        fd.write(file.read())
-                    os.remove(name)
-            self.logger.info(Msg.nd_download_done.format(path=file_path))
+        まとめている間も他のダウンロードが止まらないように、スレッドで実行する。
+
+        :param Path file_path: 完成品のファイル
+        :param Iterable[int] orders: まとめる部分ファイルの番号
+        """
+        file_names = [self._part_path(file_path, order) for order in orders]
+        self.logger.debug(f"File names: {file_names}")
+        await self.loop.run_in_executor(None, fileio.combine, file_path, file_names)
 
 
-class VideoDmc:
+class VideoSmile(VideoDownloader):
+    def __init__(self,
+                 glossary: Dict[str, Union[str, int, bool, List]],
+                 common: Dict[str, Union[int, bool, Path, SessionManager,
+                         asyncio.AbstractEventLoop, utils.NTLogger]]):
+        """
+        Smileサーバーから動画をダウンロードする。
+
+        """
+        super().__init__(glossary, common)
+        # (実際のダウンロード前のファイルサイズの確認で)同時にアクセスする最大数
+        self.__semaphore = asyncio.Semaphore(4)
+
+    def callee(self):
+        self.loop.run_until_complete(self._broker())
+        return True
+
+    async def _get_file_size_worker(self, video_id: str) -> int:
+        async with self.__semaphore:
+            return await self._get_file_size(video_id, self.glossary[video_id][KeyDmc.VIDEO_URL_SM])
+
+    async def _broker(self):
+        # 直前にファイルサイズを調べてからダウンロードする。
+        # 並べて走らせる本数は parallel で、接続の総数は budget で抑える。
+        await utils.run_bounded(enumerate(self.glossary), self.fetch, self.parallel, self.logger)
+
+    async def fetch(self, idx: int, video_id: str, total: Optional[int]=None) -> None:
+        """
+        一件だけファイルサイズを調べてダウンロードする。
+
+        :param int idx: 何番目の動画か
+        :param str video_id:
+        :param Optional[int] total: 全体の件数
+        """
+        if self.glossary[video_id][KeyDmc.FILE_SIZE] is None:
+            self.glossary[video_id][KeyDmc.FILE_SIZE] = await self._get_file_size_worker(video_id)
+        try:
+            await self._download(idx, video_id, total)
+        finally:
+            await self._close_stream(video_id)
+
+    async def _download(self, idx: int, video_id: str, total: Optional[int]=None):
+        video_url = self.glossary[video_id][KeyDmc.VIDEO_URL_SM]
+        file_size = self.glossary[video_id][KeyDmc.FILE_SIZE]
+        await self._download_ranges(idx, video_id, video_url, file_size, total)
+
+
+class VideoDmc(VideoDownloader):
+    EXPIRED_STATUSES = HeartbeatManager.DEAD  # 動画のサーバーがこれを返したらセッションが切れている
+    RENEGOTIATE = 3  # 一本の動画でセッションを作り直す回数の上限
+
     def __init__(self,
                  glossary: Dict[str, Dict[str, Union[str, int, bool, List]]],
-                 common: Dict[str, Union[int, bool, Path, aiohttp.ClientSession,
+                 common: Dict[str, Union[int, bool, Path, SessionManager,
                                          asyncio.AbstractEventLoop, utils.NTLogger]]):
         """
         DMCサーバーから動画をダウンロードする。
         """
-        self.glossary = glossary
-        self.session = common[DataKey.SESSION]
-        self.logger = common[DataKey.LOGGER]
-        self.loop = common[DataKey.LOOP]
-        self.save_dir = common[DataKey.SAVE_DIR]
-        self.chunk_size = common[DataKey.CHUNK_SIZE]
-        self.multiline = common[DataKey.IS_MULTILINE]
-        self.smile = common[DataKey.IS_SMILE]
-        self.division = common[DataKey.DIVISION]
-        self.__downloaded_size = [0] * common[DataKey.DIVISION]  # type: List[int]
+        super().__init__(glossary, common)
+        # 先にセッションを作っておく動画の数
+        self.prefetch_depth = common.get(DataKey.PREFETCH, self.parallel)  # type: int
+        # 先に作ったセッション。 (動画URL, Beat) を返す Future
+        self.__sessions = {}  # type: Dict[str, asyncio.Future]
+        self.heartbeats = (common.get(DataKey.HEARTBEAT) or
+                           HeartbeatManager(self.session, self.logger, loop=self.loop))  # type: HeartbeatManager
+        # セッションを作り直すときに情報を取り直すのに使う
+        self.__info = None  # type: Optional[Info]
 
     def callee(self, xml: bool=True):
         self.loop.run_until_complete(self._broker(xml))
         return True
 
     async def _broker(self, xml: bool=True) -> None:
-        for idx, video_id in enumerate(self.glossary):
-            if xml:
-                res_xml = await self._first_nego_xml(video_id)
-                video_url = self._extract_video_url_xml(res_xml)
-                coro_heartbeat = asyncio.ensure_future(self._heartbeat(video_id, res_xml))
+        video_ids = list(self.glossary)
+
+        def source():
+            for idx, video_id in enumerate(video_ids):
+                # 今から取る動画と、その後ろのセッションを作り始める。
+                # 後ろの分は前の動画を取っている間に出来上がる
+                for ahead in video_ids[idx:idx + 1 + self.prefetch_depth]:
+                    self.prefetch(ahead, xml)
+                yield idx, video_id
+
+        try:
+            await utils.run_bounded(source(), functools.partial(self.fetch, xml=xml), self.parallel,
+                                    self.logger)
+        finally:
+            self.discard_sessions()
+
+    def prefetch(self, video_id: str, xml: bool=True) -> bool:
+        """
+        後で取る動画のセッションを先に作り始める。 Heartbeat もすぐに始める。
+
+        作ったまま使われていないものが、今から取る一本と合わせて prefetch_depth + 1 個あれば何もしない。
+
+        :param str video_id: glossary に情報がある動画
+        :param bool xml: セッションの作成に XML を使うかどうか
+        :return: 作り始めたかどうか
+        :rtype: bool
+        """
+        if video_id in self.__sessions or len(self.__sessions) > self.prefetch_depth:
+            return False
+        self.__sessions[video_id] = asyncio.ensure_future(self._open_session(video_id, xml))
+        return True
+
+    def discard_sessions(self) -> None:
+        """ 先に作ったが使わなかったセッションを捨てる。 """
+        for future in self.__sessions.values():
+            if future.done() and not future.cancelled() and future.exception() is None:
+                self.heartbeats.unregister(future.result()[1])
             else:
-                res_json = await self._first_nego_json(video_id)
-                video_url = self._extract_video_url_json(res_json)
-                coro_heartbeat = asyncio.ensure_future(self._heartbeat(video_id, res_json))
+                future.cancel()
+        self.__sessions.clear()
 
-            self.logger.debug(f"動画URL: {video_url}")
-            coro_download = asyncio.ensure_future(self._download(idx, video_id, video_url))
-            coro_download.add_done_callback(functools.partial(self._canceler, coro_heartbeat))
-            coro_download.add_done_callback(functools.partial(self._combiner, video_id))
-            tasks = [coro_download, coro_heartbeat]
-            await asyncio.gather(*tasks)
+    async def _open_session(self, video_id: str, xml: bool=True) -> Tuple[str, Beat]:
+        """
+        セッションを作って、その Heartbeat を HeartbeatManager に任せる。
+
+        :param str video_id:
+        :param bool xml: セッションの作成に XML を使うかどうか
+        :return: 動画URL と、 HeartbeatManager に預けた Beat
+        :rtype: Tuple[str, Beat]
+        """
+        if xml:
+            res_xml = await self._first_nego_xml(video_id)
+            video_url = self._extract_video_url_xml(res_xml)
+        else:
+            res_json = await self._first_nego_json(video_id)
+            video_url = self._extract_video_url_json(res_json)
+        beat = self._make_beat(video_id, res_xml if xml else res_json, xml)
+        return video_url, self.heartbeats.register(beat)
+
+    async def fetch(self, idx: int, video_id: str, total: Optional[int]=None, xml: bool=True) -> None:
+        """
+        一件だけダウンロードする。先に作ったセッションがあればそれを使う。
+
+        ダウンロード中にセッションが切れたら SessionLost を送出する。
+
+        :param int idx: 何番目の動画か
+        :param str video_id:
+        :param Optional[int] total: 全体の件数
+        :param bool xml: セッションの作成に XML を使うかどうか
+        """
+        session = self.__sessions.pop(video_id, None)
+        if session is None:
+            session = asyncio.ensure_future(self._open_session(video_id, xml))
+        video_url, beat = await session
+        if beat.lost is not None:
+            # 先に作ったセッションが、使う前に切れていた
+            video_url, beat = await self._open_session(video_id, xml)
+
+        renegotiated = 0
+        try:
+            while True:
+                try:
+                    await self._download_with(idx, video_id, video_url, beat, total)
+                    return
+                except SessionLost:
+                    renegotiated += 1
+                    if renegotiated > self.RENEGOTIATE:
+                        raise
+                # 署名などが古くなっているので情報を取り直してセッションを作り直し、
+                # 記録してある続きから取る
+                self.logger.warning(Msg.nd_renegotiate.format(video_id=video_id, count=renegotiated))
+                await self._refresh(video_id)
+                video_url, beat = await self._open_session(video_id, xml)
+        finally:
+            await self._close_stream(video_id)
+
+    async def _download_with(self, idx: int, video_id: str, video_url: str, beat: Beat,
+                             total: Optional[int]=None) -> None:
+        """
+        一つのセッションでダウンロードする。
+
+        Heartbeat が通らなくなったり、動画のサーバーに断られたりしたら SessionLost を送出する。
+
+        :param int idx: 何番目の動画か
+        :param str video_id:
+        :param str video_url: 動画URL
+        :param Beat beat: このセッションの Heartbeat
+        :param Optional[int] total: 全体の件数
+        """
+        self.logger.debug(f"動画URL: {video_url}")
+        coro_download = asyncio.ensure_future(self._download(idx, video_id, video_url, total))
+        beat.on_lost = lambda lost: coro_download.cancel()
+        try:
+            await coro_download
+        except asyncio.CancelledError:
+            if beat.lost is not None:
+                raise beat.lost
+            raise
+        finally:
+            self.heartbeats.unregister(beat)
+
+    async def _refresh(self, video_id: str) -> None:
+        """
+        セッションを作り直すために、視聴ページから動画の情報を取り直す。
+
+        :param str video_id:
+        """
+        if self.__info is None:
+            self.__info = Info(None, session=self.session, logger=self.logger, loop=self.loop)
+        async for _, info in self.__info.stream([video_id]):
+            if isinstance(info, InfoFailure):
+                raise info
+            # ファイル名などは最初のものを使い続ける
+            info = {key: val for key, val in info.items() if key in InfoCache.VOLATILE}
+            self.glossary[video_id].update(info)
 
     async def _first_nego_xml(self, video_id: str) -> str:
         payload = self._make_param_xml(self.glossary[video_id])
@@ -736,6 +1602,7 @@ class VideoDmc:
                 url=self.glossary[video_id][KeyDmc.API_URL],
                 params={"_format": "xml"},
                 data=payload,
+                endpoint=Endpoint.DMC_SESSION,
         ) as response:  # type: aiohttp.ClientResponse
             return await response.text()
 
@@ -745,6 +1612,7 @@ class VideoDmc:
                 url=self.glossary[video_id][KeyDmc.API_URL],
                 params={"_format": "json"},
                 data=payload,
+                endpoint=Endpoint.DMC_SESSION,
         ) as response:  # type: aiohttp.ClientResponse
             return await response.text()
 
@@ -892,137 +1760,45 @@ class VideoDmc:
         soup = json.loads(text)
         id_tag = soup["data"]["session"]["id"]
         self.logger.debug(f"Session ID: {id_tag}")
-        return id_tag.text
+        return id_tag
+
+    def _extract_session_json(self, text: str) -> str:  # pragma: no cover
+        return json.dumps(json.loads(text)["data"])
 
     def _extract_session_tag(self, text: str) -> str:
         return re.sub(".+(<session>.+</session>).+", r"\1", text)
         # return xml_text[xml_text.find("<session>"): xml_text.find("</session>")+10]
 
-    async def _heartbeat(self, video_id: str, text: str) -> None:
+    def _make_beat(self, video_id: str, text: str, xml: bool=True) -> Beat:
         """
-        動画を視聴中に定期的に特定のデータを送信し続ける必要がある。そのための関数。
+        セッションを作ったときの返事から、 Heartbeat の送り先と中身を決める。
 
-        :param video_id:
-        :param text:
+        :param str video_id:
+        :param str text: セッションを作ったときの返事
+        :param bool xml: 返事が XML かどうか
+        :rtype: Beat
         """
-        try:
-            self.logger.debug(f"Returned XML: {text}")
-            api_url = self.glossary[video_id][KeyDmc.API_URL]  # type: str
-            # 1分ちょうどで送ると遅れるので、待ち時間を少し早める
-            waiting = (self.glossary[video_id][KeyDmc.HEARTBEAT] / 1000) - 5
-            companion = self._extract_session_tag(text)  # type: str
-            session_id = self._extract_session_id_xml(text)  # type: str
-            await asyncio.sleep(waiting)
-            async with self.session.post(
-                    url=api_url + "/" + session_id,
-                    params={"_format": "xml", "_method": "PUT"},
-                    data=companion
-            ) as response:  # type: aiohttp.ClientResponse
-                res_text = await response.text()
-            await self._heartbeat(video_id, res_text)
-        except asyncio.CancelledError:
-            pass
-
-    async def _get_file_size(self, video_id: str, video_url: str) -> int:
-        self.logger.debug(f"Video ID: {video_id}, Video URL: {video_url}")
-        async with self.session.head(video_url) as resp:
-            headers = resp.headers
-            self.logger.debug(str(headers))
-            return int(headers["content-length"])
-
-    async def _download(self, idx: int, video_id: str, video_url: str):
-        division = self.division
-        file_path = utils.make_name(self.glossary[video_id], self.save_dir)
-
-        self.logger.info(Msg.nd_download_video.format(
-            idx + 1, len(self.glossary), video_id, self.glossary[video_id][KeyDmc.TITLE]))
-
+        self.logger.debug(f"Returned session: {text}")
+        api_url = self.glossary[video_id][KeyDmc.API_URL]  # type: str
+        # 送り直しても期限に間に合うように、早めに送る
+        interval = self.heartbeats.interval_for(self.glossary[video_id][KeyDmc.HEARTBEAT] / 1000)
+        if xml:
+            session_id = self._extract_session_id_xml(text)
+            return Beat(video_id, api_url + "/" + session_id, self._extract_session_tag(text), interval,
+                        params={"_format": "xml", "_method": "PUT"}, renew=self._extract_session_tag)
+        session_id = self._extract_session_id_json(text)  # pragma: no cover
+        return Beat(video_id, api_url + "/" + session_id, self._extract_session_json(text), interval,
+                    params={"_format": "json", "_method": "PUT"}, renew=self._extract_session_json)
+
+    async def _download(self, idx: int, video_id: str, video_url: str, total: Optional[int]=None):
         file_size = await self._get_file_size(video_id, video_url)
-        headers = [{
-            "Range": f"bytes={int(file_size*order/division)}-{int((file_size*(order+1))/division-1)}"
-        } for order in range(division)]
-
-        for o, h in zip(range(division), headers):
-            self.logger.debug(f"Order {o}: {h}")
-
-        if self.multiline:
-            progress_bars = [tqdm(total=int(file_size / division),
-                                  leave=False, position=order,
-                                  unit="B", unit_scale=True,
-                                  file=sys.stdout)
-                             for order in range(division)]  # type: List[tqdm]
-            tasks = [self._download_worker(file_path, video_url, header, order, pbar)
-                     for header, order, pbar
-                     in zip(headers, range(division), progress_bars)]
-            progress_bars = await asyncio.gather(*tasks)  # type: List[tqdm]
-            # ネストの「内側」から順に消さないと棒が画面に残る。
-            for pbar in reversed(progress_bars):
-                pbar.close()
-        else:
-            tasks = [self._download_worker(file_path, video_url, header, order)
-                     for header, order
-                     in zip(headers, range(division))]
-            await asyncio.gather(*tasks, self._counter_whole(file_size))
-
-    async def _download_worker(self, file_path: Union[str, Path], video_url: str,
-                               header: dict, order: int, pbar: tqdm = None) -> tqdm:
-        file_path = Path(f"{file_path}.{order:03}")
-        # => video.mp4.000 ～ video.mp4.003 (4分割の場合)
-        self.logger.debug(file_path)
-        with file_path.open("wb") as fd:
-            # Don't set timeout (default 5 min) for downloads
-            timeout = aiohttp.ClientTimeout(total=None, connect=60)
-            async with self.session.get(url=video_url, headers=header, timeout=timeout) as video_data:
-                self.logger.debug(f"Started! Header: {header}, Video URL: {video_url}")
-                while True:
-                    data = await video_data.content.read(self.chunk_size)
-                    if not data:
-                        break
-                    downloaded_size = fd.write(data)
-                    self.__downloaded_size[order] += downloaded_size
-                    if pbar:
-                        pbar.update(downloaded_size)
-        self.logger.debug(f"Order {order}: done!")
-        return pbar
-
-    def _canceler(self, task_to_cancel: asyncio.Task, _: asyncio.Task) -> bool:
-        """
-        動画のダウンロードが終わった後にHeartbeatを止めるための関数。
-
-        :param asyncio.Task task_to_cancel:
-        :param asyncio.Task _:
-        :rtype: bool
-        """
-        return task_to_cancel.cancel()
-
-    async def _counter_whole(self, file_size: int, interval: int=1):
-        with tqdm(total=file_size, unit="B") as pbar:
-            oldsize = 0
-            while True:
-                newsize = sum(self.__downloaded_size)
-                if newsize >= file_size:
-                    pbar.update(file_size - oldsize)
-                    break
-                pbar.update(newsize - oldsize)
-                oldsize = newsize
-                await asyncio.sleep(interval)
+        await self._download_ranges(idx, video_id, video_url, file_size, total)
 
-    def _combiner(self, video_id: str, coroutine: asyncio.Task):
-        """
-        ダウンロードが終わった後に分割したそれぞれを一つにまとめる関数。
-
-        :param str video_id:
-        :param asyncio.Task coroutine:
-        """
-        if coroutine.done() and not coroutine.cancelled():
-            file_path = utils.make_name(self.glossary[video_id], self.save_dir)
-            file_names = [f"{file_path}.{order:03}" for order in range(self.division)]
-            with file_path.open("wb") as fd:
-                for name in file_names:
-                    with open(name, "rb") as file:
-                        fd.write(file.read())
-                    os.remove(name)
-            self.logger.info(Msg.nd_download_done.format(path=file_path))
+    def _identity(self, video_id: str, video_url: str) -> str:
+        # DMC の URL はセッションごとに変わるので、画質の候補で見分ける
+        info = self.glossary[video_id]
+        return (f"{video_id}:dmc:{','.join(info[KeyDmc.VIDEO_SRC_IDS] or [])}"
+                f":{','.join(info[KeyDmc.AUDIO_SRC_IDS] or [])}")
 
 
 class Comment(utils.Canopy):
@@ -1036,8 +1812,9 @@ class Comment(utils.Canopy):
                  limit: int=4,
                  wayback=False,
                  logger: utils.NTLogger=None,
-                 session: aiohttp.ClientSession=None,
+                 session: Union[SessionManager, aiohttp.ClientSession, None]=None,
                  loop: asyncio.AbstractEventLoop=None,
+                 writer: Optional[fileio.DiskWriter]=None,
                  ):
         """
         コメントをダウンロードする。
@@ -1049,17 +1826,23 @@ class Comment(utils.Canopy):
         :param password: パスワード
         :param str | Path save_dir:
         :param logger: ロガー
-        :param session: セッション
+        :param session: 借りてくるセッション。指定した場合は閉じない。
         :param limit: 同時にアクセスする最大数
         :param bool xml:
         :param str density: ダウンロードするコメントの密度。
         :param wayback: 過去ログを取りに行くかどうか
         :param loop: イベントループ
+        :param Optional[fileio.DiskWriter] writer: コメントを書き込む場所。省略すると自前で用意する
         """
         super().__init__(loop=loop, logger=logger)
+        self.writer = writer or fileio.DiskWriter()
+        self.__owns_writer = writer is None
         self.__downloaded_size = None  # type: List[int]
-        self.session = session or self.loop.run_until_complete(self.get_session(mail, password))
-        self.__parallel_limit = limit
+        self.__is_borrowed = session is not None
+        self.session = (SessionManager.wrap(session) or
+                        self.loop.run_until_complete(self.get_session(mail, password)))
+        self.__semaphore = asyncio.Semaphore(limit)
+        self.__limit = limit
         self.__wayback = wayback
         self.glossary = {}
         self.save_dir = utils.get_dir(save_dir)
@@ -1067,35 +1850,54 @@ class Comment(utils.Canopy):
         self.density = density
 
         if isinstance(videoids, list):
-            info = Info(utils.validator(videoids), mail=mail, password=password, session=self.session)
+            info = Info(utils.validator(videoids), mail=mail, password=password,
+                        session=self.session, logger=self.logger, loop=self.loop)
             videoids = info.info
-            self.session = info.session
         self.glossary = videoids
 
-    async def get_session(self, mail: str, password: str) -> aiohttp.ClientSession:
+    async def get_session(self, mail: str, password: str) -> SessionManager:
         cook = utils.LogIn(mail=mail, password=password).cookie
-        return aiohttp.ClientSession(cookies=cook)
+        return await SessionManager(cookies=cook, loop=self.loop, logger=self.logger).open()
 
     def close(self):
-        async def _close():
-            await self.session.close()
-
-        self.loop.run_until_complete(_close())
+        if self.__owns_writer:
+            self.writer.shutdown()
+        if self.__is_borrowed:
+            return
+        self.loop.run_until_complete(self.session.close())
 
     def start(self):
         """ ダウンロードを開始する。 """
-        futures = []
-        for idx, video_id in enumerate(self.glossary):
-            coro = self._download(idx, self.glossary[video_id], self.xml, self.density)
-            f = asyncio.ensure_future(coro)
-            f.add_done_callback(functools.partial(self.saver, video_id, self.xml))
-            futures.append(f)
-
-        self.loop.run_until_complete(asyncio.wait(futures, loop=self.loop))
+        # 一件ごとにタスクを作らず、決まった数の作業者が順に取りに行く
+        self.loop.run_until_complete(utils.run_bounded(
+            enumerate(self.glossary), self._download_one, self.__limit, self.logger))
         self.close()
         return True
 
-    async def _download(self, idx: int, info: dict, is_xml: bool, density: str) -> str:
+    async def _download_one(self, idx: int, video_id: str) -> bool:
+        comment_data = await self._download(idx, self.glossary[video_id], self.xml, self.density)
+        return await self._write(video_id, self.xml, comment_data)
+
+    async def fetch(self, video_id: str, info: Dict, idx: int=0, total: Optional[int]=None) -> bool:
+        """
+        一件だけダウンロードする。パイプラインから情報が届くたびに呼ばれる。
+
+        :param str video_id:
+        :param Dict info: 動画の情報
+        :param int idx: 何番目の動画か
+        :param Optional[int] total: 全体の件数
+        :rtype: bool
+        """
+        self.glossary[video_id] = info
+        try:
+            comment_data = await self._download(idx, info, self.xml, self.density, total)
+            return await self._write(video_id, self.xml, comment_data)
+        finally:
+            # 終わった動画の情報は持ち続けない
+            del self.glossary[video_id]
+
+    async def _download(self, idx: int, info: dict, is_xml: bool, density: str,
+                        total: Optional[int]=None) -> str:
         video_id        = info[KeyDmc.VIDEO_ID]
         thread_id       = info[KeyDmc.THREAD_ID]
         msg_server      = info[KeyDmc.MSG_SERVER]
@@ -1110,7 +1912,7 @@ class Comment(utils.Canopy):
         force_184       = None
 
         self.logger.info(Msg.nd_download_comment.format(
-            idx + 1, len(self.glossary), video_id, info[KeyGTI.TITLE]))
+            idx + 1, total or len(self.glossary), video_id, info[KeyGTI.TITLE]))
 
         if is_official:
             thread_key, force_184 = await self.get_thread_key(thread_id, needs_key)
@@ -1131,8 +1933,9 @@ class Comment(utils.Canopy):
         return self.postprocesser(is_xml, com_data)
 
     async def retriever(self, data: str, url: str) -> str:
-        async with asyncio.Semaphore(self.__parallel_limit):
-            async with self.session.post(url=url, data=data) as resp:  # type: aiohttp.ClientResponse
+        async with self.__semaphore:
+            async with self.session.post(url=url, data=data,
+                                         endpoint=Endpoint.COMMENT) as resp:  # type: aiohttp.ClientResponse
                 return await resp.text()
 
     def postprocesser(self, is_xml: bool, result: str):
@@ -1148,18 +1951,18 @@ class Comment(utils.Canopy):
         else:
             return result.replace("}, ", "},\n")
 
-    def saver(self, video_id: str, is_xml: bool, coroutine: asyncio.Task) -> bool:
-        comment_data = coroutine.result()
+    async def _write(self, video_id: str, is_xml: bool, comment_data: str) -> bool:
+        file_path = self._file_path(video_id, is_xml)
+        await self.writer.write_file(file_path, comment_data + "\n")
+        self.logger.info(Msg.nd_download_done.format(path=file_path))
+        return True
+
+    def _file_path(self, video_id: str, is_xml: bool) -> Path:
         if is_xml:
             extention = "xml"
         else:
             extention = "json"
-
-        file_path = utils.make_name(self.glossary[video_id], self.save_dir, extention=extention)
-        with file_path.open("w", encoding="utf-8") as f:
-            f.write(comment_data + "\n")
-        self.logger.info(Msg.nd_download_done.format(path=file_path))
-        return True
+        return utils.make_name(self.glossary[video_id], self.save_dir, extention=extention)
 
     async def get_thread_key(self, thread_id, needs_key):
         """
@@ -1173,7 +1976,8 @@ class Comment(utils.Canopy):
             self.logger.debug(f"needs_key is not 1. Video ID (or Thread ID): {thread_id},"
                               f" needs_key: {needs_key}")
             return "", "0"
-        async with self.session.get(URL.URL_GetThreadKey, params={"thread": thread_id}) as resp:
+        async with self.session.get(URL.URL_GetThreadKey, params={"thread": thread_id},
+                                    endpoint=Endpoint.FLAPI) as resp:
             response = await resp.text()
         self.logger.debug("Response from GetThreadKey API"
                           f" (thread id is {thread_id}): {response}")
@@ -1183,8 +1987,9 @@ class Comment(utils.Canopy):
         return threadkey, force_184
 
     async def get_wayback_key(self, thread_id: int):
-        async with asyncio.Semaphore(self.__parallel_limit):
-            async with self.session.get(URL.URL_WayBackKey, params={"thread", thread_id}) as resp:
+        async with self.__semaphore:
+            async with self.session.get(URL.URL_WayBackKey, params={"thread", thread_id},
+                                        endpoint=Endpoint.FLAPI) as resp:
                 response = await resp.text()
                 self.logger.debug(f"Waybackkey response: {response}")
             return parse_qs(response)["waybackkey"][0]
@@ -1318,6 +2123,108 @@ class Comment(utils.Canopy):
         return result
 
 
+class Pipeline(utils.Canopy):
+    def __init__(self,
+                 info: Info,
+                 thumbnail: Optional[Thumbnail]=None,
+                 comment: Optional[Comment]=None,
+                 video: Optional[Video]=None,
+                 info_workers: int=4,
+                 workers: int=4,
+                 queue_size: int=8,
+                 logger: Optional[utils.NTLogger]=None,
+                 loop: Optional[asyncio.AbstractEventLoop]=None,
+                 ):
+        """
+        動画の情報が届いたものから順に、サムネイル・コメント・動画の各段階へ流す。
+
+        全件の情報が揃うのを待たずに次の段階を始める。段階どうしは上限つきの
+        キューでつなぐので、後ろが詰まれば前の段階も待つ。
+
+        :param Info info: 情報を集める Info (videoids=None で作ったもの)
+        :param Optional[Thumbnail] thumbnail:
+        :param Optional[Comment] comment:
+        :param Optional[Video] video:
+        :param int info_workers: 視聴ページを同時に取りに行く数
+        :param int workers: サムネイルとコメントの段階で同時に処理する数
+        :param int queue_size: 各段階の待ち行列の長さ
+        :param T<= logging.logger logger: ロガー
+        :param asyncio.AbstractEventLoop loop: イベントループ
+        """
+        super().__init__(loop=loop, logger=logger)
+        self.info = info
+        self.info_workers = info_workers
+        self.queue_size = queue_size
+        self.stages = []  # type: List[Tuple[str, Union[Thumbnail, Comment, Video], int]]
+        if thumbnail:
+            self.stages.append(("thumbnail", thumbnail, workers))
+        if comment:
+            self.stages.append(("comment", comment, workers))
+        if video:
+            # 動画はそれ自体が分割して接続するので、並べる本数は Video に任せる
+            self.stages.append(("video", video, video.parallel))
+        self.done = {name: [] for name, _, _ in self.stages}  # type: Dict[str, List[str]]
+
+    def start(self, video_ids: List[str]) -> Dict[str, List[str]]:
+        """
+        パイプラインを動かす。
+
+        :param List[str] video_ids:
+        :return: 段階ごとに、処理し終えた動画IDのリスト
+        :rtype: Dict[str, List[str]]
+        """
+        return self.loop.run_until_complete(self.run(video_ids))
+
+    async def run(self, video_ids: List[str]) -> Dict[str, List[str]]:
+        video_ids = utils.validator(video_ids)
+        total = len(video_ids)
+        queues = [asyncio.Queue(self.queue_size) for _ in self.stages]
+        consumers = [asyncio.ensure_future(self._consume(name, stage, queue, total))
+                     for (name, stage, count), queue in zip(self.stages, queues)
+                     for _ in range(count)]
+        try:
+            await self._produce(video_ids, queues)
+        finally:
+            for (_, _, count), queue in zip(self.stages, queues):
+                for _ in range(count):
+                    await queue.put(None)
+            await asyncio.gather(*consumers)
+        return self.done
+
+    async def _produce(self, video_ids: List[str], queues: List[asyncio.Queue]) -> None:
+        idx = 0
+        async for video_id, info in self.info.stream(video_ids, window=self.info_workers):
+            if isinstance(info, InfoFailure):
+                if info.reason == InfoFailure.UNAVAILABLE:
+                    self.logger.info(Msg.nd_deleted_or_private.format([video_id]))
+                else:
+                    self.logger.error(Err.stage_failed.format(
+                        stage="info", video_id=video_id, reason=info.error or info.reason))
+                continue
+            # 番号は情報が届いた順につける
+            for (_, stage, _), queue in zip(self.stages, queues):
+                await queue.put((idx, video_id, info))
+                if isinstance(stage, Video):
+                    # 待ち行列に並んでいる間に DMC のセッションを作っておく
+                    stage.prepare(video_id, info)
+            idx += 1
+
+    async def _consume(self, name: str, stage: Union[Thumbnail, Comment, Video],
+                       queue: asyncio.Queue, total: int) -> None:
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            idx, video_id, info = item
+            try:
+                await stage.fetch(video_id, info, idx, total)
+            except Exception as error:
+                # 一件の失敗で段階全体を止めない
+                self.logger.error(Err.stage_failed.format(stage=name, video_id=video_id, reason=error))
+                continue
+            self.done[name].append(video_id)
+
+
 def main(args):
     """
     メイン。
@@ -1342,24 +2249,65 @@ def main(args):
     # 本筋
     #
     log_level = "DEBUG" if is_debug else args.loglevel
-    logger = utils.NTLogger(log_level=log_level)
+    # 動画を標準出力に流すときは、それ以外を全部標準エラー出力に出す
+    console = sys.stderr if args.stdout else sys.stdout
+    logger = utils.NTLogger(log_level=log_level, console=console)
     destination = utils.get_dir(args.dest[0])
 
-    video_info = Info(videoid, mail=mailadrs, password=password, logger=logger)
-    database = video_info.info
-    session = video_info.session
-
-    if len(database) == 0:
-        return True
-
-    if args.thumbnail:
-        Thumbnail(videoids=database, save_dir=destination, logger=logger).start()
-
-    if args.comment:
-        Comment(videoids=database, save_dir=destination, xml=args.xml, logger=logger).start()
-
-    if args.video:
-        Video(videoids=database, save_dir=destination,
-              logger=logger, division=args.limit, multiline=args.nomulti, smile=args.smile, cookie_jar=session.cookie_jar).start()
+    # 全ての段階で同じコネクションプールを使い回す
+    loop = asyncio.get_event_loop()
+    cook = utils.LogIn(mail=mailadrs, password=password).cookie
+    session = loop.run_until_complete(SessionManager(
+        cookies=cook, limit=args.pool_size, limit_per_host=args.pool_per_host,
+        loop=loop, logger=logger).open())
+    executor = ParseExecutor(kind=args.parser, workers=args.parser_workers, loop=loop)
+    # ディスクへの書き込みも全ての段階で一つにまとめ、イベントループの外で行う
+    writer = fileio.DiskWriter(fsync=args.fsync)
+    progress_file = None
+    if args.progress == "json" and args.progress_file:
+        progress_file = open(args.progress_file, "a", encoding="utf-8")
+    progress = ProgressBus({
+        "bar": lambda: [TqdmSink(per_connection=args.nomulti, file=console)],
+        "log": lambda: [LogSink(logger)],
+        "json": lambda: [JsonLinesSink(progress_file or console)],
+        "none": lambda: [],
+    }[args.progress]())
+    cache = InfoCache(Path.home() / utils.CACHE_FILE) if args.cache else None
+
+    thumbnail = comment = video = None
+    try:
+        # 情報が届いた動画から順に各段階へ流すので、全件の取得を待たない
+        if args.thumbnail:
+            thumbnail = Thumbnail(videoids={}, save_dir=destination, logger=logger,
+                                  session=session, loop=loop, executor=executor, writer=writer)
+        if args.comment:
+            comment = Comment(videoids={}, save_dir=destination, xml=args.xml, logger=logger,
+                              session=session, loop=loop, writer=writer)
+        if args.video:
+            video = Video(videoids={}, save_dir=destination, logger=logger, division=None if args.auto else args.limit,
+                          multiline=args.nomulti, smile=args.smile, session=session, loop=loop,
+                          preallocate=args.preallocate, parallel=1 if args.stdout else args.parallel,
+                          connections=args.connections, writer=writer, progress=progress,
+                          in_flight=args.in_flight * 1024 * 1024 if args.in_flight else None,
+                          stream=write_to(sys.stdout.buffer) if args.stdout else None,
+                          window=args.window * 1024 * 1024)
+        # 段階に足りる中でいちばん軽い取り先を使う
+        source = Info.plan(thumbnail=args.thumbnail, comment=args.comment, video=args.video, smile=args.smile)
+        info = Info(None, logger=logger, session=session, loop=loop, executor=executor, cache=cache,
+                    source=source)
+        Pipeline(info, thumbnail=thumbnail, comment=comment, video=video,
+                 logger=logger, loop=loop).start(videoid)
+    finally:
+        if video is not None:
+            # 先に作ったセッションの Heartbeat が、閉じたセッションで送られないように止める
+            loop.run_until_complete(video.discard_sessions())
+        loop.run_until_complete(session.close())
+        loop.run_until_complete(progress.close())
+        executor.shutdown()
+        writer.shutdown()
+        if progress_file is not None:
+            progress_file.close()
+        if cache is not None:
+            cache.close()
 
     return True
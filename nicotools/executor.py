@@ -0,0 +1,57 @@
+# coding: UTF-8
+import asyncio
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from nicotools.utils import Err
+
+
+class ParseExecutor:
+    INLINE = "inline"  # イベントループの上でそのまま実行する
+    THREAD = "thread"  # スレッドプールで実行する
+    PROCESS = "process"  # プロセスプールで実行する (複数のコアを使える)
+    KINDS = (INLINE, THREAD, PROCESS)
+
+    def __init__(self, kind: str=THREAD, workers: Optional[int]=None,
+                 loop: Optional[asyncio.AbstractEventLoop]=None):
+        """
+        HTMLやJSONの解析のような、CPUを使う処理をイベントループの外で実行する。
+
+        解析している間もダウンロードや Heartbeat が止まらないようにするためのもの。
+        PROCESS で実行する関数と引数は pickle できなければならない。
+
+        :param str kind: INLINE, THREAD, PROCESS のいずれか
+        :param Optional[int] workers: 作業者の数。THREAD で省略するとイベントループ既定のプールを使う
+        :param Optional[asyncio.AbstractEventLoop] loop: イベントループ
+        """
+        if kind not in self.KINDS:
+            raise ValueError(Err.invalid_executor.format(kind=kind, kinds=", ".join(self.KINDS)))
+        self.kind = kind
+        self.loop = loop or asyncio.get_event_loop()  # type: asyncio.AbstractEventLoop
+        self.__pool = None  # type: Optional[Executor]
+        if kind == self.PROCESS:
+            self.__pool = ProcessPoolExecutor(max_workers=workers)
+        elif kind == self.THREAD and workers:
+            self.__pool = ThreadPoolExecutor(max_workers=workers)
+
+    async def run(self, func: Callable, *args) -> Any:
+        """
+        func(*args) を実行して結果を返す。
+
+        :param Callable func: 実行する関数
+        :param args: 引数
+        :rtype: Any
+        """
+        if self.kind == self.INLINE:
+            return func(*args)
+        return await self.loop.run_in_executor(self.__pool, func, *args)
+
+    def shutdown(self, wait: bool=True) -> None:
+        """
+        自分で作ったプールを閉じる。
+
+        :param bool wait: 実行中の処理が終わるのを待つかどうか
+        """
+        if self.__pool is not None:
+            self.__pool.shutdown(wait=wait)
+            self.__pool = None
@@ -0,0 +1,368 @@
+# coding: UTF-8
+import asyncio
+import errno
+import os
+import queue
+import sys
+import threading
+from pathlib import Path
+from typing import List, Optional, Set, Union
+
+from nicotools.utils import Err
+
+# 一度にカーネルに頼む量の上限 (sendfile は 2GB を超えると失敗する環境がある)
+MAX_KERNEL_COPY = 1 << 30
+# カーネル内コピーが使えないときの読み書きの単位
+BUFFER_SIZE = 1024 * 1024
+
+# これらの失敗なら、コピーの方法を変えれば続けられる
+_UNSUPPORTED = {errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EBADF,
+                errno.EOPNOTSUPP, errno.ENOTSUP, errno.EPERM, errno.ETXTBSY}
+
+
+def combine(destination: Union[str, Path], sources: List[Union[str, Path]],
+            remove: bool=True, zero_copy: bool=True, buffer_size: int=BUFFER_SIZE) -> int:
+    """
+    部分ファイルを順につなげて一つのファイルにする。
+
+    できるだけカーネルの中でコピーし (copy_file_range, sendfile)、
+    使えなければ buffer_size ずつ読み書きする。どちらでも使うメモリは一定。
+    ブロックするので、イベントループからは run_in_executor を通して呼ぶ。
+
+    :param Union[str, Path] destination: 完成品のファイル
+    :param List[Union[str, Path]] sources: 部分ファイルのリスト
+    :param bool remove: つなげ終えた部分ファイルを消すかどうか
+    :param bool zero_copy: カーネル内コピーを試すかどうか
+    :param int buffer_size: 読み書きの単位
+    :return: 書き込んだバイト数
+    :rtype: int
+    """
+    written = 0
+    out_fd = os.open(str(destination), os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0))
+    try:
+        for source in sources:
+            in_fd = os.open(str(source), os.O_RDONLY | getattr(os, "O_BINARY", 0))
+            try:
+                size = os.fstat(in_fd).st_size
+                written += copy_range(in_fd, out_fd, size, zero_copy, buffer_size)
+            finally:
+                os.close(in_fd)
+    finally:
+        os.close(out_fd)
+    if remove:
+        for source in sources:
+            os.remove(str(source))
+    return written
+
+
+def copy_range(in_fd: int, out_fd: int, size: int, zero_copy: bool=True, buffer_size: int=BUFFER_SIZE) -> int:
+    """
+    in_fd の先頭から size バイトを、out_fd の今の位置へ書き込む。
+
+    :param int in_fd: 読み込み元のファイル記述子
+    :param int out_fd: 書き込み先のファイル記述子
+    :param int size: コピーする大きさ
+    :param bool zero_copy: カーネル内コピーを試すかどうか
+    :param int buffer_size: 読み書きの単位
+    :return: コピーしたバイト数
+    :rtype: int
+    """
+    offset = 0
+    if zero_copy and hasattr(os, "copy_file_range"):
+        offset = _kernel_copy(lambda count, pos: os.copy_file_range(in_fd, out_fd, count, pos),
+                              offset, size)
+    # ファイルどうしの sendfile は Linux でしか使えない
+    if zero_copy and offset < size and hasattr(os, "sendfile") and sys.platform.startswith("linux"):
+        offset = _kernel_copy(lambda count, pos: os.sendfile(out_fd, in_fd, pos, count), offset, size)
+    if offset < size:
+        os.lseek(in_fd, offset, os.SEEK_SET)
+        while offset < size:
+            chunk = os.read(in_fd, min(buffer_size, size - offset))
+            if not chunk:
+                break
+            view = memoryview(chunk)
+            while view:
+                view = view[os.write(out_fd, view):]
+            offset += len(chunk)
+    return offset
+
+
+def _kernel_copy(copier, offset: int, size: int) -> int:
+    """
+    copier(count, offset) を、終わるか使えないと分かるまで繰り返す。
+
+    :return: どこまでコピーできたか
+    :rtype: int
+    """
+    try:
+        while offset < size:
+            copied = copier(min(MAX_KERNEL_COPY, size - offset), offset)
+            if copied == 0:
+                break
+            offset += copied
+    except OSError as error:
+        if error.errno not in _UNSUPPORTED:
+            raise
+    return offset
+
+
+def write_file(path: Union[str, Path], data: Union[bytes, str], fsync: bool=False) -> None:
+    """
+    ファイルを丸ごと書く。文字列なら UTF-8 にする。ブロックする。
+
+    :param Union[str, Path] path:
+    :param Union[bytes, str] data:
+    :param bool fsync: 閉じる前にディスクに同期するか
+    """
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    with open(str(path), "wb") as fd:
+        fd.write(data)
+        if fsync:
+            fd.flush()
+            os.fsync(fd.fileno())
+
+
+def _pwrite(fd: int, buffers: List[bytes], offset: int) -> None:
+    """ buffers を offset から順に全部書く。 """
+    if hasattr(os, "pwritev"):
+        views = [memoryview(buffer) for buffer in buffers]
+        while views:
+            written = os.pwritev(fd, views, offset)
+            offset += written
+            # 書き切れなかった分から続ける
+            while views and written >= len(views[0]):
+                written -= len(views[0])
+                views.pop(0)
+            if views:
+                views[0] = views[0][written:]
+    elif hasattr(os, "pwrite"):
+        view = memoryview(b"".join(buffers))
+        while view:
+            written = os.pwrite(fd, view, offset)
+            offset += written
+            view = view[written:]
+    else:  # pragma: no cover
+        # Windows には pwrite がない。同じファイルは同じスレッドが書くので位置がずれない
+        os.lseek(fd, offset, os.SEEK_SET)
+        view = memoryview(b"".join(buffers))
+        while view:
+            view = view[os.write(fd, view):]
+
+
+class WriteHandle:
+    def __init__(self, writer: "DiskWriter", fd: int):
+        """
+        DiskWriter に書き込みを頼むためのファイル一つ分。 DiskWriter.open で作る。
+        """
+        self.writer = writer
+        self.fd = fd
+        self.__pending = set()  # type: Set[asyncio.Future]
+
+    async def write(self, offset: int, data: bytes) -> asyncio.Future:
+        """
+        offset の位置に data を書くよう頼む。
+
+        書き込みの待ちが多ければ、減るまで待ってから頼む (backpressure)。
+        同じファイルへの書き込みは頼んだ順に行う。
+
+        :param int offset: 書く位置
+        :param bytes data: 書く中身
+        :return: 書き終わったら結果が入る Future
+        :rtype: asyncio.Future
+        """
+        future = await self.writer.submit(self.fd, DiskWriter.WRITE, self.fd, offset, data)
+        self.__pending.add(future)
+        future.add_done_callback(self.__pending.discard)
+        return future
+
+    async def close(self) -> None:
+        """ 頼んだ書き込みが終わるのを待ち、方針に従って fsync してから閉じる。 """
+        results = await asyncio.gather(*self.__pending, return_exceptions=True)
+        await (await self.writer.submit(self.fd, DiskWriter.CLOSE, self.fd))
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+
+class DiskWriter:
+    WRITE = "write"
+    CLOSE = "close"
+    FILE = "file"
+    FSYNC_NEVER = "never"  # fsync しない (OS に任せる)
+    FSYNC_CLOSE = "close"  # ファイルを閉じるときに fsync する
+    FSYNC_ALWAYS = "always"  # まとめて書くたびに fsync する
+    FSYNC_POLICIES = (FSYNC_NEVER, FSYNC_CLOSE, FSYNC_ALWAYS)
+
+    def __init__(self, threads: int=1, max_pending: int=16 * 1024 * 1024,
+                 fsync: str=FSYNC_CLOSE, batch_size: int=4 * 1024 * 1024):
+        """
+        ダウンロードしたデータを、イベントループの外のスレッドでディスクに書く。
+
+        書き込みは上限つきの待ち行列に入れ、スレッドが続いている分をまとめて
+        一度に書く。待ちが max_pending バイトを超えたら、頼む側を待たせる。
+        同じファイルはいつも同じスレッドが書くので、頼んだ順に書き終わる。
+
+        :param int threads: 書き込むスレッドの数
+        :param int max_pending: 書き終わっていないバイト数の上限
+        :param str fsync: FSYNC_NEVER, FSYNC_CLOSE, FSYNC_ALWAYS のいずれか
+        :param int batch_size: 一度にまとめて書くバイト数の上限
+        """
+        if fsync not in self.FSYNC_POLICIES:
+            raise ValueError(Err.invalid_fsync.format(policy=fsync, policies=", ".join(self.FSYNC_POLICIES)))
+        self.threads = max(1, threads)
+        self.max_pending = max_pending
+        self.fsync = fsync
+        self.batch_size = batch_size
+        self.pending = 0
+        self.__queues = []  # type: List[queue.Queue]
+        self.__workers = []  # type: List[threading.Thread]
+        self.__waiters = []  # type: List[asyncio.Future]
+        self.__lock = threading.Lock()
+
+    async def open(self, path: Union[str, Path], truncate: bool=False) -> WriteHandle:
+        """
+        書き込むファイルを開く。なければ作る。
+
+        :param Union[str, Path] path:
+        :param bool truncate: 中身を空にするかどうか
+        :rtype: WriteHandle
+        """
+        flags = os.O_WRONLY | os.O_CREAT | getattr(os, "O_BINARY", 0)
+        if truncate:
+            flags |= os.O_TRUNC
+        fd = await asyncio.get_event_loop().run_in_executor(None, os.open, str(path), flags)
+        return WriteHandle(self, fd)
+
+    async def write_file(self, path: Union[str, Path], data: Union[bytes, str]) -> None:
+        """
+        ファイルを丸ごと書く。サムネイルやコメントのような小さなもの向け。
+
+        :param Union[str, Path] path:
+        :param Union[bytes, str] data: 文字列なら UTF-8 にする
+        """
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        await (await self.submit(hash(str(path)), self.FILE, path, data))
+
+    async def submit(self, key: int, kind: str, *args) -> asyncio.Future:
+        """
+        書き込みスレッドに仕事を頼む。
+
+        :param int key: どのスレッドに頼むかを決める値 (ファイル記述子など)
+        :param str kind: WRITE, CLOSE, FILE のいずれか
+        :return: 終わったら結果が入る Future
+        :rtype: asyncio.Future
+        """
+        loop = asyncio.get_event_loop()
+        size = len(args[-1]) if kind != self.CLOSE else 0
+        # 何も待っていなければ大きくても通す (でないと永久に待つ)
+        while self.pending and self.pending + size > self.max_pending:
+            waiter = loop.create_future()
+            self.__waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self.__waiters:
+                    self.__waiters.remove(waiter)
+        self.pending += size
+        future = loop.create_future()
+        future.add_done_callback(lambda _: self.__done(size))
+        self.__queue(key).put((kind, args, future, loop))
+        return future
+
+    def shutdown(self) -> None:
+        """ スレッドを止める。頼まれている分は書き終えてから止まる。 """
+        with self.__lock:
+            for work in self.__queues:
+                work.put(None)
+            for worker in self.__workers:
+                worker.join()
+            self.__queues = []
+            self.__workers = []
+
+    def __done(self, size: int) -> None:
+        self.pending -= size
+        for waiter in self.__waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def __queue(self, key: int) -> queue.Queue:
+        with self.__lock:
+            if not self.__queues:
+                for number in range(self.threads):
+                    work = queue.Queue()  # type: queue.Queue
+                    worker = threading.Thread(target=self._work, args=(work,),
+                                              name=f"nicotools-writer-{number}", daemon=True)
+                    worker.start()
+                    self.__queues.append(work)
+                    self.__workers.append(worker)
+            return self.__queues[key % len(self.__queues)]
+
+    def _work(self, work: queue.Queue) -> None:
+        backlog = []  # type: List[Optional[tuple]]  # まとめようとして取り出した続きでない仕事
+        while True:
+            job = backlog.pop(0) if backlog else work.get()
+            if job is None:
+                return
+            kind, args, future, loop = job
+            if kind != self.WRITE:
+                self.__finish(self.__run(kind, args), future, loop)
+                continue
+            # 同じファイルの続いている書き込みを、まとめて一度に書く
+            fd, offset, data = args
+            batch = [(future, loop)]
+            buffers = [data]
+            size = len(data)
+            while size < self.batch_size and not backlog:
+                try:
+                    following = work.get_nowait()
+                except queue.Empty:
+                    break
+                if (following is not None and following[0] == self.WRITE
+                        and following[1][0] == fd and following[1][1] == offset + size):
+                    batch.append((following[2], following[3]))
+                    buffers.append(following[1][2])
+                    size += len(following[1][2])
+                else:
+                    backlog.append(following)
+            outcome = self.__run(self.WRITE, (fd, offset, buffers))
+            for _future, _loop in batch:
+                self.__finish(outcome, _future, _loop)
+
+    def __run(self, kind: str, args: tuple):
+        try:
+            if kind == self.WRITE:
+                fd, offset, buffers = args
+                _pwrite(fd, buffers, offset)
+                if self.fsync == self.FSYNC_ALWAYS:
+                    os.fsync(fd)
+            elif kind == self.CLOSE:
+                fd, = args
+                try:
+                    if self.fsync != self.FSYNC_NEVER:
+                        os.fsync(fd)
+                finally:
+                    os.close(fd)
+            else:
+                path, data = args
+                # 丸ごと書くものは書いてすぐ閉じるので、 close と always は同じ
+                write_file(path, data, fsync=self.fsync != self.FSYNC_NEVER)
+            return None
+        except BaseException as error:
+            return error
+
+    @staticmethod
+    def __finish(outcome, future: asyncio.Future, loop: asyncio.AbstractEventLoop) -> None:
+        def _set():
+            if future.done():
+                return
+            if isinstance(outcome, BaseException):
+                future.set_exception(outcome)
+            else:
+                future.set_result(None)
+        try:
+            loop.call_soon_threadsafe(_set)
+        except RuntimeError:
+            # ループがもう閉じている
+            pass
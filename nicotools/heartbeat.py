@@ -0,0 +1,222 @@
+# coding: UTF-8
+import asyncio
+import heapq
+import itertools
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import aiohttp
+
+from nicotools import utils
+from nicotools.connection import RetryPolicy
+from nicotools.utils import Endpoint, Err
+
+
+class SessionLost(Exception):
+    def __init__(self, key: str, reason: Optional[BaseException]=None):
+        """
+        Heartbeat が通らなくなり、DMC のセッションが切れた。
+
+        :param str key: セッションを表す名前 (ふつうは動画ID)
+        :param Optional[BaseException] reason: 最後の失敗
+        """
+        super().__init__(Err.session_lost.format(key=key, reason=reason))
+        self.key = key
+        self.reason = reason
+
+
+class Beat:
+    def __init__(self, key: str, url: str, data: str, interval: float,
+                 params: Optional[Dict[str, str]]=None,
+                 renew: Optional[Callable[[str], str]]=None):
+        """
+        HeartbeatManager が受け持つセッション一つ分。
+
+        :param str key: セッションを表す名前
+        :param str url: Heartbeat を送る先
+        :param str data: 送る中身
+        :param float interval: 送る間隔 (秒)
+        :param Optional[Dict[str, str]] params: クエリ
+        :param Optional[Callable[[str], str]] renew: 返事から次に送る中身を作る関数
+        """
+        self.key = key
+        self.url = url
+        self.data = data
+        self.interval = interval
+        self.params = params
+        self.renew = renew
+        self.due = 0.0
+        self.active = True
+        self.lost = None  # type: Optional[SessionLost]
+        # セッションが切れたときに呼ぶ。持ち主が後から差し替えてよい
+        self.on_lost = None  # type: Optional[Callable[[SessionLost], None]]
+
+
+class HeartbeatManager:
+    DEAD = (403, 404, 410)  # セッションがもうない (送り直しても無駄)
+    # 送り直しはここで数えるので、 SessionManager には送り直させない
+    RETRY = RetryPolicy(retries=0, idempotent=True)
+
+    def __init__(self, session, logger: Optional[utils.NTLogger]=None,
+                 retries: int=3, retry_interval: float=2.0, timeout: float=5.0,
+                 loop: Optional[asyncio.AbstractEventLoop]=None):
+        """
+        すべての DMC セッションの Heartbeat を、一つのタスクとタイマーのヒープで送る。
+
+        それぞれのセッションの期限が来る前に PUT を送り、失敗すれば
+        retry_interval 秒おきに retries 回まで送り直す。それでも通らなければ
+        持ち主に on_lost で知らせる。
+        送り直しが期限に間に合うよう、送る間隔は interval_for で決める。
+
+        :param SessionManager session: 送るのに使うセッション
+        :param Optional[utils.NTLogger] logger: ロガー
+        :param int retries: 失敗したときに送り直す回数
+        :param float retry_interval: 送り直すまでの秒数
+        :param float timeout: 一回送るときに返事を待つ秒数
+        :param Optional[asyncio.AbstractEventLoop] loop: イベントループ
+        """
+        self.session = session
+        self.logger = logger or utils.NTLogger()
+        self.retries = retries
+        self.retry_interval = retry_interval
+        self.timeout = timeout
+        self.loop = loop or asyncio.get_event_loop()  # type: asyncio.AbstractEventLoop
+        self.__heap = []  # type: List[Tuple[float, int, Beat]]
+        self.__counter = itertools.count()
+        self.__beats = {}  # type: Dict[str, Beat]
+        self.__sending = set()  # type: Set[asyncio.Future]
+        self.__wakeup = None  # type: Optional[asyncio.Event]
+        self.__task = None  # type: Optional[asyncio.Future]
+
+    def __len__(self) -> int:
+        return len(self.__beats)
+
+    @property
+    def retry_window(self) -> float:
+        """ 一回の Heartbeat を送り直し終えるまでに、最も長くかかる秒数 """
+        return (self.retries + 1) * self.timeout + self.retries * self.retry_interval
+
+    def interval_for(self, lifetime: float, margin: float=5.0) -> float:
+        """
+        寿命が lifetime 秒のセッションに、 Heartbeat を送る間隔を決める。
+
+        送り直しを全部終えてもまだ margin 秒残るように送る。
+        寿命が短くて収まらないときだけ、半分が過ぎたところで送る。
+
+        :param float lifetime: セッションの寿命 (秒)
+        :param float margin: 期限までに残しておく秒数
+        :rtype: float
+        """
+        interval = lifetime - self.retry_window - margin
+        if interval <= 0:
+            interval = lifetime / 2
+        return max(1.0, interval)
+
+    def register(self, beat: Beat) -> Beat:
+        """
+        セッションを受け持つ。最初の Heartbeat は interval 秒後に送る。
+
+        :param Beat beat:
+        :rtype: Beat
+        """
+        old = self.__beats.get(beat.key)
+        if old is not None:
+            old.active = False
+        self.__beats[beat.key] = beat
+        self.__schedule(beat, beat.interval)
+        if self.__task is None or self.__task.done():
+            self.__task = asyncio.ensure_future(self._run())
+        return beat
+
+    def unregister(self, beat: Beat) -> None:
+        """
+        セッションを手放す。ダウンロードが終わったら呼ぶ。
+
+        :param Beat beat:
+        """
+        beat.active = False
+        if self.__beats.get(beat.key) is beat:
+            del self.__beats[beat.key]
+        if self.__wakeup is not None:
+            self.__wakeup.set()
+
+    async def close(self) -> None:
+        """ 送っている途中のものも含めて止める。 """
+        for beat in list(self.__beats.values()):
+            self.unregister(beat)
+        tasks = list(self.__sending)
+        if self.__task is not None:
+            tasks.append(self.__task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.__task = None
+
+    def __schedule(self, beat: Beat, delay: float) -> None:
+        beat.due = self.loop.time() + max(0.0, delay)
+        heapq.heappush(self.__heap, (beat.due, next(self.__counter), beat))
+        if self.__wakeup is not None:
+            self.__wakeup.set()
+
+    async def _run(self) -> None:
+        self.__wakeup = asyncio.Event()
+        while self.__beats:
+            self.__wakeup.clear()
+            # 手放したものや、予定が変わったものは捨てる
+            while self.__heap and (not self.__heap[0][2].active or self.__heap[0][2].due != self.__heap[0][0]):
+                heapq.heappop(self.__heap)
+            if not self.__heap:
+                # 送っている途中のものが終われば、また予定が入る
+                await self.__wakeup.wait()
+                continue
+            delay = self.__heap[0][0] - self.loop.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.__wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, _, beat = heapq.heappop(self.__heap)
+            # 遅い返事に他のセッションが待たされないよう、送るのは別のタスクで
+            task = asyncio.ensure_future(self._send(beat))
+            self.__sending.add(task)
+            task.add_done_callback(self.__sending.discard)
+
+    async def _send(self, beat: Beat) -> None:
+        error = None  # type: Optional[BaseException]
+        for attempt in range(self.retries + 1):
+            if not beat.active:
+                return
+            if attempt:
+                await asyncio.sleep(self.retry_interval)
+            try:
+                # ブレーカーや枠を待つ時間も含めて timeout 秒で打ち切る
+                text, status = await asyncio.wait_for(self._post(beat), self.timeout)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                error = exc
+                self.logger.warning(Err.heartbeat_failed.format(key=beat.key, reason=repr(exc)))
+                continue
+            if status < 400:
+                if beat.renew:
+                    beat.data = beat.renew(text)
+                if beat.active:
+                    self.__schedule(beat, beat.interval)
+                return
+            error = aiohttp.ClientResponseError(request_info=None, history=(), status=status)
+            self.logger.warning(Err.heartbeat_failed.format(key=beat.key, reason=status))
+            if status in self.DEAD:
+                break
+        self._lose(beat, error)
+
+    async def _post(self, beat: Beat) -> Tuple[str, int]:
+        async with self.session.post(url=beat.url, params=beat.params, data=beat.data,
+                                     endpoint=Endpoint.HEARTBEAT, retry=self.RETRY) as response:
+            return await response.text(), response.status
+
+    def _lose(self, beat: Beat, error: Optional[BaseException]) -> None:
+        if not beat.active:
+            return
+        self.unregister(beat)
+        beat.lost = SessionLost(beat.key, error)
+        self.logger.error(str(beat.lost))
+        if beat.on_lost:
+            beat.on_lost(beat.lost)
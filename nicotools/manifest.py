@@ -0,0 +1,165 @@
+# coding: UTF-8
+import json
+import os
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+
+class RangeManifest:
+    SUFFIX = ".ranges.json"
+    VERSION = 1
+    PREALLOCATED = "preallocated"  # 完成品のファイルにそれぞれの位置で書き込む
+    PARTS = "parts"  # video.mp4.000 のような部分ファイルに書き込む
+
+    def __init__(self, file_path: Union[str, Path], identity: str, size: int,
+                 layout: str, segments: List[List[int]]):
+        """
+        途中まで進んだ分割ダウンロードの記録。完成品の隣に JSON として置く。
+
+        どの動画の何を取ってきたか (identity)、全体の大きさ、それぞれの範囲と
+        そのうち書き込み済みのバイト数を持つ。中断した後はこれを読んで、
+        足りない部分だけを Range で取り直す。
+
+        :param Union[str, Path] file_path: 完成品のファイル
+        :param str identity: 同じものを取ってきているかを確かめる文字列
+        :param int size: 全体の大きさ
+        :param str layout: PREALLOCATED か PARTS
+        :param List[List[int]] segments: [始まり, 終わりの次, 書き込み済みのバイト数] のリスト
+        """
+        self.file_path = Path(file_path)
+        self.path = self.path_for(file_path)
+        self.identity = identity
+        self.size = size
+        self.layout = layout
+        self.segments = segments
+        self.__pending = {}  # type: Dict[int, int]
+        self.__saved_at = 0.0
+
+    @classmethod
+    def path_for(cls, file_path: Union[str, Path]) -> Path:
+        return Path(f"{file_path}{cls.SUFFIX}")
+
+    @classmethod
+    def plan(cls, file_path: Union[str, Path], identity: str, size: int,
+             division: int, layout: str) -> "RangeManifest":
+        """
+        新しく division 個に分けた記録を作る。
+
+        :rtype: RangeManifest
+        """
+        bounds = [int(size * order / division) for order in range(division + 1)]
+        segments = [[start, end, 0] for start, end in zip(bounds, bounds[1:])]
+        return cls(file_path, identity, size, layout, segments)
+
+    @classmethod
+    def load(cls, file_path: Union[str, Path], identity: str, size: int,
+             layout: str) -> Optional["RangeManifest"]:
+        """
+        保存してある記録を読む。
+
+        別の動画や画質のものだったり、大きさや書き込み方が違ったり、
+        壊れていたりしたら使えないので None を返す。
+
+        :rtype: Optional[RangeManifest]
+        """
+        try:
+            with cls.path_for(file_path).open(encoding="utf-8") as fd:
+                data = json.load(fd)
+            if (data["version"] != cls.VERSION or data["identity"] != identity
+                    or data["size"] != size or data["layout"] != layout):
+                return None
+            segments = [[int(start), int(end), int(done)] for start, end, done in data["segments"]]
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        if any(not 0 <= done <= end - start for start, end, done in segments):
+            return None
+        return cls(file_path, identity, size, layout, segments)
+
+    @property
+    def committed(self) -> int:
+        """ 書き込み済みのバイト数の合計 (書き込みを頼んだだけの分は含めない) """
+        return sum(done for _, _, done in self.segments) - sum(self.__pending.values())
+
+    def missing(self) -> List[Tuple[int, int, int]]:
+        """
+        まだ取ってきていない範囲。
+
+        :return: (何番目の範囲か, 始まり, 終わりの次) のリスト
+        :rtype: List[Tuple[int, int, int]]
+        """
+        return [(order, start + done, end)
+                for order, (start, end, done) in enumerate(self.segments)
+                if start + done < end]
+
+    def advance(self, order: int, length: int, written: bool=True) -> None:
+        """
+        受け取った分を記録する。
+
+        書き込みを頼んだだけでまだ書き終わっていなければ written を False にし、
+        書き終わったら commit を呼ぶ。それまでその分は保存しない。
+
+        :param int order: 何番目の範囲か
+        :param int length: 受け取ったバイト数
+        :param bool written: 実際にファイルへ書き込み済みかどうか
+        """
+        self.segments[order][2] += length
+        if not written:
+            self.__pending[order] = self.__pending.get(order, 0) + length
+
+    def commit(self, order: int, length: int) -> None:
+        """
+        advance(written=False) で記録した分が、ファイルに書き終わった。
+
+        :param int order: 何番目の範囲か
+        :param int length: 書き終わったバイト数
+        """
+        pending = self.__pending.get(order, 0) - length
+        if pending > 0:
+            self.__pending[order] = pending
+        else:
+            self.__pending.pop(order, None)
+
+    def rewind(self, position: int) -> None:
+        """
+        position より後ろは、受け取っていなかったことにする。
+
+        ストリームに流すときは、先頭から position までを渡し終えたら、
+        残りは捨ててやり直すので、それに合わせる。
+
+        :param int position: 全体の中で、ここまでは受け取ったとする位置
+        """
+        for segment in self.segments:
+            start, end, done = segment
+            segment[2] = min(done, max(0, min(end, position) - start))
+        self.__pending.clear()
+
+    def checkpoint(self, interval: float=1.0) -> None:
+        """
+        前に保存してから interval 秒以上経っていれば保存する。
+
+        :param float interval: 保存する間隔 (秒)
+        """
+        if time.monotonic() - self.__saved_at >= interval:
+            self.save()
+
+    def save(self) -> None:
+        """ 書きかけの記録が残らないように、別名で書いてから置き換える。 """
+        temp = Path(f"{self.path}.tmp")
+        with temp.open("w", encoding="utf-8") as fd:
+            json.dump({"version": self.VERSION, "identity": self.identity, "size": self.size,
+                       "layout": self.layout, "segments": self.__durable()}, fd)
+        os.replace(str(temp), str(self.path))
+        self.__saved_at = time.monotonic()
+
+    def __durable(self) -> List[List[int]]:
+        # 書き終わっていない分は、やり直したときに取り直す
+        return [[start, end, done - self.__pending.get(order, 0)]
+                for order, (start, end, done) in enumerate(self.segments)]
+
+    def remove(self) -> None:
+        """ ダウンロードが終わったら記録を消す。 """
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
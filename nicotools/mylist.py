@@ -18,7 +18,9 @@ except ImportError:
     PrettyTable = False
 
 from nicotools import utils
-from nicotools.utils import Msg, Err, URL, KeyGTI, MKey, MylistAPIError
+from nicotools.connection import SessionManager
+from nicotools.executor import ParseExecutor
+from nicotools.utils import Msg, Err, URL, KeyGTI, MKey, MylistAPIError, Endpoint
 
 
 class NicoMyList(utils.Canopy):
@@ -30,7 +32,9 @@ class NicoMyList(utils.Canopy):
         "8": "非公開",
     }
 
-    def __init__(self, mail: str=None, password: str=None, logger: utils.NTLogger=None):
+    def __init__(self, mail: str=None, password: str=None, logger: utils.NTLogger=None,
+                 session: Union[SessionManager, aiohttp.ClientSession, None]=None,
+                 executor: Optional[ParseExecutor]=None):
         """
         使い方:
 
@@ -93,28 +97,37 @@ class NicoMyList(utils.Canopy):
         :param str | None mail: メールアドレス
         :param str | None password: パスワードの組
         :param NTLogger logger:
+        :param Union[SessionManager, aiohttp.ClientSession, None] session:
+         借りてくるセッション。指定した場合は閉じない。
+        :param Optional[ParseExecutor] executor: getthumbinfo の解析を実行する場所。省略するとスレッドプール
         :rtype: None
         """
         super().__init__(logger=logger)
+        self.executor = executor or ParseExecutor(loop=self.loop)
         self.token = None  # type: str
-        self.session = self.get_session(mail, password)  # type: aiohttp.ClientSession
+        self.__is_borrowed = session is not None
+        if self.__is_borrowed:
+            self.token = utils.LogIn(mail=mail, password=password).token
+            self.session = SessionManager.wrap(session)  # type: SessionManager
+        else:
+            self.session = self.get_session(mail, password)  # type: SessionManager
         self.mylists = self.get_mylists_info()  # type: Dict[int, Dict]
 
-    def get_session(self, mail: str, password: str) -> aiohttp.ClientSession:
+    def get_session(self, mail: str, password: str) -> SessionManager:
         return self.loop.run_until_complete(self._get_session(mail, password))
 
-    async def _get_session(self, mail: str, password: str) -> aiohttp.ClientSession:
+    async def _get_session(self, mail: str, password: str) -> SessionManager:
         login = utils.LogIn(mail=mail, password=password)
         cook = login.cookie
         self.token = login.token
         self.logger.debug(f"cookie (nicoml_async): {id(cook)}")
-        return aiohttp.ClientSession(cookies=cook)
+        return await SessionManager(cookies=cook, loop=self.loop, logger=self.logger).open()
 
     def close(self):
-        async def _close():
-            await self.session.close()
-
-        self.loop.run_until_complete(_close())
+        # 借りてきたセッションは持ち主が閉じる
+        if self.__is_borrowed:
+            return
+        self.loop.run_until_complete(self.session.close())
 
     @classmethod
     def _confirmation(cls, mode, list_name, contents_to_be_deleted=None):
@@ -219,7 +232,7 @@ class NicoMyList(utils.Canopy):
 
         :rtype: dict[int, dict[str, int | str | bool]]
         """
-        async with self.session.get(URL.URL_ListAll) as resp:  # type: aiohttp.ClientResponse
+        async with self.session.get(URL.URL_ListAll, endpoint=Endpoint.MYLIST) as resp:  # type: aiohttp.ClientResponse
             jtext = json.loads(await resp.text())
 
         candidate = {}
@@ -348,10 +361,11 @@ class NicoMyList(utils.Canopy):
         self.logger.debug(f"Is in whole mode?: {whole}")
 
         if list_id == utils.DEFAULT_ID:
-            async with self.session.get(URL.URL_ListDef) as resp:
+            async with self.session.get(URL.URL_ListDef, endpoint=Endpoint.MYLIST) as resp:
                 jtext = json.loads(await resp.text())
         else:
-            async with self.session.get(URL.URL_ListOne, params={"group_id": list_id}) as resp:
+            async with self.session.get(URL.URL_ListOne, params={"group_id": list_id},
+                                        endpoint=Endpoint.MYLIST) as resp:
                 jtext = json.loads(await resp.text())
         self.logger.debug(f"Response: {jtext}")
 
@@ -375,14 +389,29 @@ class NicoMyList(utils.Canopy):
         :param str video_id: 動画ID
         :rtype:str
         """
-        async with self.session.get(URL.URL_Info + video_id) as resp:
-            soup = BeautifulSoup(await resp.text(), "html.parser")
-        # 「status="ok"」 なら動画は生存 / 存在しない動画には「status="fail"」が返る
-        if not soup.nicovideo_thumb_response["status"].lower() == "ok":
+        async with self.session.get(URL.URL_Info + video_id, endpoint=Endpoint.THUMBINFO) as resp:
+            text = await resp.text()
+        # 解析はイベントループの外で行う
+        title = await self.executor.run(self._parse_title, text)
+        if title is None:
             self.logger.error(Msg.nd_deleted_or_private.format(video_id))
             return ""
-        else:
-            return html.unescape(soup.select("title")[0].text)
+        return title
+
+    @staticmethod
+    def _parse_title(content: str) -> Optional[str]:
+        """
+        getthumbinfo API の返事からタイトルを取り出す。
+
+        :param str content: APIの返事
+        :return: 動画が存在しなければ None
+        :rtype: Optional[str]
+        """
+        soup = BeautifulSoup(content, "html.parser")
+        # 「status="ok"」 なら動画は生存 / 存在しない動画には「status="fail"」が返る
+        if not soup.nicovideo_thumb_response["status"].lower() == "ok":
+            return None
+        return html.unescape(soup.select("title")[0].text)
 
     async def get_response(self, mode, **kwargs):
         """
@@ -499,7 +528,8 @@ class NicoMyList(utils.Canopy):
 
         self.logger.debug(f"URL: {url}")
         self.logger.debug(f"Query to post: {payload}")
-        async with self.session.get(url, params=payload) as resp:
+        # 追加や削除は冪等でないので、サーバーが処理していないことが確かな場合にだけ再試行する
+        async with self.session.get(url, params=payload, endpoint=Endpoint.MYLIST_EDIT) as resp:
             res = json.loads(await resp.text())
         self.logger.debug(f"Response: {res}")
         return res
@@ -1002,7 +1032,7 @@ class NicoMyList(utils.Canopy):
         return container
 
     async def _fetch_meta_worker_def(self):
-        async with self.session.get(URL.URL_ListDef) as resp:
+        async with self.session.get(URL.URL_ListDef, endpoint=Endpoint.MYLIST) as resp:
             counts = json.loads(await resp.text())["mylistitem"]
         container = [
             utils.DEFAULT_ID, utils.DEFAULT_NAME, counts, "非公開", "--", ""
@@ -1010,7 +1040,8 @@ class NicoMyList(utils.Canopy):
         return container
 
     async def _fetch_meta_worker(self, item: dict):
-        async with self.session.get(URL.URL_ListOne, params={"group_id": item["id"]}) as resp:
+        async with self.session.get(URL.URL_ListOne, params={"group_id": item["id"]},
+                                    endpoint=Endpoint.MYLIST) as resp:
             response = json.loads(await resp.text())
         counts = len(response["mylistitem"])
 
@@ -1038,10 +1069,11 @@ class NicoMyList(utils.Canopy):
 
         self.logger.info(Msg.ml_showing_mylist.format(list_name))
         if list_id == utils.DEFAULT_ID:
-            async with self.session.get(URL.URL_ListDef) as resp:
+            async with self.session.get(URL.URL_ListDef, endpoint=Endpoint.MYLIST) as resp:
                 jtext = json.loads(await resp.text())
         else:
-            async with self.session.get(URL.URL_ListOne, params={"group_id": list_id}) as resp:
+            async with self.session.get(URL.URL_ListOne, params={"group_id": list_id},
+                                        endpoint=Endpoint.MYLIST) as resp:
                 jtext = json.loads(await resp.text())
         self.logger.debug(f"Returned: {jtext}")
 
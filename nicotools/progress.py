@@ -0,0 +1,280 @@
+# coding: UTF-8
+import asyncio
+import json
+import sys
+import time
+from typing import Dict, IO, List, Optional, Tuple
+
+from tqdm import tqdm
+
+from nicotools import utils
+from nicotools.utils import Msg
+
+
+class Progress:
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self, key: str, total: int, initial: int=0, parts: Optional[List[int]]=None):
+        """
+        一本のダウンロードの進み具合。
+
+        取ってくる側は parts の自分の要素に受け取ったバイト数を足すだけでよい。
+        それを数えて表示するのは ProgressBus の仕事。
+
+        :param str key: 何のダウンロードか (ふつうは動画ID)
+        :param int total: 全体のバイト数
+        :param int initial: 前回までに取ってきてあったバイト数
+        :param Optional[List[int]] parts: 接続ごとに取ってきたバイト数
+        """
+        self.key = key
+        self.total = total
+        self.initial = initial
+        self.parts = parts if parts is not None else [0]
+        self.rate = 0.0
+        self.state = self.RUNNING
+
+    @property
+    def done(self) -> int:
+        """ これまでに取ってきたバイト数 """
+        return self.initial + sum(self.parts)
+
+    @property
+    def connections(self) -> int:
+        """ これまでにデータを受け取った接続の数 """
+        return sum(1 for part in self.parts if part)
+
+    def advance(self, length: int, part: int=0) -> None:
+        """
+        受け取った分を数える。
+
+        :param int length: 受け取ったバイト数
+        :param int part: 何本目の接続か
+        """
+        self.parts[part] += length
+
+
+class ProgressSink:
+    """ ProgressBus が集めた進み具合をどこかへ出すもの。使う分だけ上書きする。 """
+
+    def start(self, progress: Progress) -> None:
+        pass
+
+    def update(self, progresses: List[Progress]) -> None:
+        pass
+
+    def finish(self, progress: Progress) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class TqdmSink(ProgressSink):
+    def __init__(self, per_connection: bool=True, file: Optional[IO]=None):
+        """
+        tqdm のプログレスバーで表示する。
+
+        :param bool per_connection: 接続ごとに一本ずつ出すか。 False なら動画ごとに一本
+        :param Optional[IO] file: 出力先。省略すると標準出力
+        """
+        self.per_connection = per_connection
+        self.file = file or sys.stdout
+        self.__bars = {}  # type: Dict[Tuple[str, int], tqdm]
+        self.__positions = {}  # type: Dict[Tuple[str, int], int]
+
+    def start(self, progress: Progress) -> None:
+        if not self.per_connection:
+            self.__open((progress.key, -1), total=progress.total, initial=progress.initial)
+
+    def update(self, progresses: List[Progress]) -> None:
+        for progress in progresses:
+            if not self.per_connection:
+                self.__show((progress.key, -1), progress.done)
+                continue
+            for part, length in enumerate(progress.parts):
+                # まだ何も受け取っていない接続は出さない
+                if length or (progress.key, part) in self.__bars:
+                    self.__show((progress.key, part), length)
+
+    def finish(self, progress: Progress) -> None:
+        self.update([progress])
+        # ネストの「内側」から順に消さないと棒が画面に残る。
+        for name in sorted((name for name in self.__bars if name[0] == progress.key),
+                           key=self.__positions.get, reverse=True):
+            self.__bars.pop(name).close()
+            del self.__positions[name]
+
+    def close(self) -> None:
+        for name in sorted(self.__bars, key=self.__positions.get, reverse=True):
+            self.__bars.pop(name).close()
+        self.__positions.clear()
+
+    def __open(self, name: Tuple[str, int], **kwargs) -> tqdm:
+        # 並べて走らせている動画のプログレスバーが重ならないように、空いている行を選ぶ
+        position = 0
+        while position in self.__positions.values():
+            position += 1
+        self.__positions[name] = position
+        self.__bars[name] = tqdm(leave=False, position=position, unit="B", unit_scale=True,
+                                 file=self.file, **kwargs)
+        return self.__bars[name]
+
+    def __show(self, name: Tuple[str, int], value: int) -> None:
+        # 大きさの分からない tqdm は bool() で例外になるので is None で確かめる
+        bar = self.__bars.get(name)
+        if bar is None:
+            bar = self.__open(name)
+        if value > bar.n:
+            bar.update(value - bar.n)
+
+
+class LogSink(ProgressSink):
+    def __init__(self, logger: Optional[utils.NTLogger]=None, every: float=10.0):
+        """
+        ふつうのログとして一行ずつ出す。
+
+        :param Optional[utils.NTLogger] logger: ロガー
+        :param float every: 出す間隔 (秒)
+        """
+        self.logger = logger or utils.NTLogger()
+        self.every = every
+        self.__logged_at = 0.0
+
+    def update(self, progresses: List[Progress]) -> None:
+        now = time.monotonic()
+        if now - self.__logged_at < self.every:
+            return
+        self.__logged_at = now
+        for progress in progresses:
+            self.logger.info(Msg.nd_progress.format(
+                key=progress.key, percent=progress.done * 100 / max(1, progress.total),
+                done=tqdm.format_sizeof(progress.done, "B", 1024),
+                total=tqdm.format_sizeof(progress.total, "B", 1024),
+                rate=tqdm.format_sizeof(progress.rate, "B/s", 1024),
+                connections=progress.connections))
+
+
+class JsonLinesSink(ProgressSink):
+    def __init__(self, stream: Optional[IO]=None):
+        """
+        機械で読むために、一件ずつ JSON を一行にして書く。
+
+        event は start, progress, done, failed のいずれか。
+
+        :param Optional[IO] stream: 書き込む先。省略すると標準出力
+        """
+        self.stream = stream or sys.stdout
+
+    def start(self, progress: Progress) -> None:
+        self.__write([self.__record("start", progress)])
+
+    def update(self, progresses: List[Progress]) -> None:
+        self.__write([self.__record("progress", progress) for progress in progresses])
+
+    def finish(self, progress: Progress) -> None:
+        self.__write([self.__record(progress.state, progress)])
+
+    def close(self) -> None:
+        self.stream.flush()
+
+    @staticmethod
+    def __record(event: str, progress: Progress) -> Dict:
+        return {"event": event, "time": round(time.time(), 3), "key": progress.key,
+                "done": progress.done, "total": progress.total, "rate": round(progress.rate),
+                "connections": progress.connections}
+
+    def __write(self, records: List[Dict]) -> None:
+        self.stream.write("".join(json.dumps(record) + "\n" for record in records))
+        self.stream.flush()
+
+
+class ProgressBus:
+    def __init__(self, sinks: Optional[List[ProgressSink]]=None, interval: float=0.5):
+        """
+        ダウンロードの進み具合を集めて、決まった間隔で sinks に渡す。
+
+        取ってくる側は Progress の数を足すだけで、表示はここの一つのタスクが
+        interval 秒おきにまとめて行う。 sinks が空なら何もしない (タスクも作らない)。
+
+        :param Optional[List[ProgressSink]] sinks: 出力先
+        :param float interval: 出力する間隔 (秒)
+        """
+        self.sinks = list(sinks or [])
+        self.interval = interval
+        self.__tracked = {}  # type: Dict[str, Progress]
+        self.__sampled = {}  # type: Dict[str, Tuple[float, int]]
+        self.__task = None  # type: Optional[asyncio.Future]
+
+    def track(self, key: str, total: int, initial: int=0, parts: Optional[List[int]]=None) -> Progress:
+        """
+        ダウンロードを一本受け持つ。終わったら finish を呼ぶ。
+
+        :param str key: 何のダウンロードか
+        :param int total: 全体のバイト数
+        :param int initial: 前回までに取ってきてあったバイト数
+        :param Optional[List[int]] parts: 接続ごとに取ってきたバイト数
+        :rtype: Progress
+        """
+        progress = Progress(key, total, initial, parts)
+        if not self.sinks:
+            return progress
+        self.__tracked[key] = progress
+        self.__sampled[key] = (time.monotonic(), progress.done)
+        for sink in self.sinks:
+            sink.start(progress)
+        if self.__task is None or self.__task.done():
+            self.__task = asyncio.ensure_future(self._run())
+        return progress
+
+    def finish(self, progress: Progress, succeeded: bool=True) -> None:
+        """
+        ダウンロードが終わった。
+
+        :param Progress progress:
+        :param bool succeeded: うまくいったかどうか
+        """
+        progress.state = Progress.DONE if succeeded else Progress.FAILED
+        if self.__tracked.get(progress.key) is not progress:
+            return
+        self.__sample(progress, time.monotonic())
+        del self.__tracked[progress.key]
+        del self.__sampled[progress.key]
+        for sink in self.sinks:
+            sink.finish(progress)
+        if not self.__tracked and self.__task is not None:
+            # 出すものがなくなったので止める。次に track されたらまた動かす
+            self.__task.cancel()
+            self.__task = None
+
+    def tick(self) -> None:
+        """ 今の進み具合を sinks に渡す。ふつうは interval 秒おきに自分で呼ぶ。 """
+        now = time.monotonic()
+        progresses = list(self.__tracked.values())
+        for progress in progresses:
+            self.__sample(progress, now)
+        if progresses:
+            for sink in self.sinks:
+                sink.update(progresses)
+
+    async def close(self) -> None:
+        """ 止めて、 sinks を閉じる。 """
+        if self.__task is not None:
+            self.__task.cancel()
+            await asyncio.gather(self.__task, return_exceptions=True)
+            self.__task = None
+        for sink in self.sinks:
+            sink.close()
+
+    async def _run(self) -> None:
+        while self.__tracked:
+            await asyncio.sleep(self.interval)
+            self.tick()
+
+    def __sample(self, progress: Progress, now: float) -> None:
+        last_time, last_done = self.__sampled[progress.key]
+        done = progress.done
+        if now > last_time:
+            progress.rate = (done - last_done) / (now - last_time)
+            self.__sampled[progress.key] = (now, done)
@@ -0,0 +1,226 @@
+# coding: UTF-8
+import asyncio
+import time
+from typing import List, Optional, Set, Tuple
+
+
+class SegmentScheduler:
+    def __init__(self, segments: List[List[int]], min_split: int):
+        """
+        小さく分けた範囲を、手の空いた接続に順に割り当てる。
+
+        割り当てる範囲がなくなったら、まだ残りの多い範囲を後ろ半分で切り分けて
+        そちらを引き受ける (work stealing)。切られた側は新しい終わりで止まる。
+        segments は RangeManifest.segments をそのまま渡す。切り分けた範囲は
+        そこに書き足すので、記録にもそのまま残る。
+
+        :param List[List[int]] segments: [始まり, 終わりの次, 書き込み済みのバイト数] のリスト
+        :param int min_split: 切り分けた後のそれぞれの残りがこれより小さくなるなら切らない
+        """
+        self.segments = segments
+        self.min_split = min_split
+        self.__active = set()  # type: Set[int]
+
+    def remaining(self, order: int) -> int:
+        """ その範囲でまだ書き込んでいないバイト数 """
+        start, end, done = self.segments[order]
+        return end - start - done
+
+    def unclaimed(self) -> int:
+        """ 誰も引き受けていない範囲の、残りのバイト数の合計 """
+        return sum(self.remaining(order) for order in range(len(self.segments))
+                   if order not in self.__active)
+
+    def claim(self) -> Optional[int]:
+        """
+        次に取ってくる範囲を一つ引き受ける。
+
+        :return: 範囲の番号。もう引き受けるものがなければ None
+        :rtype: Optional[int]
+        """
+        waiting = [order for order in range(len(self.segments))
+                   if order not in self.__active and self.remaining(order) > 0]
+        if waiting:
+            # 前から順に埋めていく
+            order = min(waiting, key=lambda _order: self.segments[_order][0])
+            self.__active.add(order)
+            return order
+        return self.steal()
+
+    def steal(self) -> Optional[int]:
+        """
+        取ってきている途中で一番残りの多い範囲を二つに分け、後ろ半分を引き受ける。
+
+        :return: 新しい範囲の番号。分けるほど残っていなければ None
+        :rtype: Optional[int]
+        """
+        if not self.__active:
+            return None
+        victim = max(self.__active, key=self.remaining)
+        remaining = self.remaining(victim)
+        if remaining < self.min_split * 2:
+            return None
+        segment = self.segments[victim]
+        middle = segment[0] + segment[2] + remaining // 2
+        self.segments.append([middle, segment[1], 0])
+        segment[1] = middle
+        order = len(self.segments) - 1
+        self.__active.add(order)
+        return order
+
+    def release(self, order: int) -> None:
+        """
+        範囲を手放す。終わっていなければ、また誰かが引き受ける。
+
+        :param int order: 範囲の番号
+        """
+        self.__active.discard(order)
+
+
+class ThroughputTuner:
+    SMALL_FILE = 4 * 1024 * 1024  # これより小さければ一本の接続で取る
+
+    def __init__(self, size: int, max_workers: int=8, start_workers: int=2,
+                 chunk_size: int=1024 * 50, min_chunk: int=16 * 1024, max_chunk: int=1024 * 1024,
+                 interval: float=1.0, gain: float=0.1, read_time: float=0.05):
+        """
+        測った速さを見ながら、接続の数と一度に読む大きさを決める。
+
+        数本から始めて、一本増やすごとに全体の速さが gain の割合以上伸びたかを確かめる。
+        伸びなければ (一本あたりの速さが落ちただけなら) その一本を減らして増やすのをやめる。
+        落ち着いた後に全体の速さが大きく落ちたら、また増やしてみる。
+
+        :param int size: これから取ってくるバイト数
+        :param int max_workers: 接続の数の上限
+        :param int start_workers: 最初の接続の数
+        :param int chunk_size: 最初に一度に読む大きさ
+        :param int min_chunk: 一度に読む大きさの下限
+        :param int max_chunk: 一度に読む大きさの上限
+        :param float interval: adjust を呼ぶ間隔 (秒)
+        :param float gain: 増やした甲斐があったとみなす伸びの割合
+        :param float read_time: 一度の読み込みで待つくらいの時間 (秒)
+        """
+        self.max_workers = max_workers
+        self.min_chunk = min_chunk
+        self.max_chunk = max_chunk
+        self.interval = interval
+        self.gain = gain
+        self.read_time = read_time
+        self.chunk_size = chunk_size
+        self.rate = 0.0
+        self.small = size < self.SMALL_FILE
+        self.target = 1 if self.small else max(1, min(start_workers, max_workers))
+        self.__growing = not self.small
+        self.__base_rate = None  # type: Optional[float]
+        self.__last = None  # type: Optional[Tuple[float, int]]
+
+    def adjust(self, total: int, now: Optional[float]=None) -> int:
+        """
+        これまでに取ってきたバイト数から速さを測り、接続の数と読む大きさを決め直す。
+
+        :param int total: これまでに取ってきたバイト数の合計
+        :param Optional[float] now: 今の時刻 (time.monotonic)
+        :return: これからの接続の数
+        :rtype: int
+        """
+        now = time.monotonic() if now is None else now
+        if self.__last is None or now <= self.__last[0]:
+            self.__last = (now, total)
+            return self.target
+        last_time, last_total = self.__last
+        self.__last = (now, total)
+        self.rate = (total - last_total) / (now - last_time)
+        per_connection = self.rate / self.target
+        self.chunk_size = int(min(self.max_chunk, max(self.min_chunk, per_connection * self.read_time)))
+        if self.small:
+            return self.target
+
+        if self.__growing:
+            if self.__base_rate is not None and self.rate < self.__base_rate * (1 + self.gain):
+                # 増やしても全体が速くならなかったので、一本戻して落ち着く
+                self.target = max(1, self.target - 1)
+                self.__growing = False
+            elif self.target < self.max_workers:
+                self.__base_rate = self.rate
+                self.target += 1
+            else:
+                self.__growing = False
+        elif self.__base_rate is not None and self.rate < self.__base_rate * (1 - self.gain * 2):
+            # 回線の具合が変わったようなので、もう一度増やしてみる
+            self.__base_rate = None
+            self.__growing = True
+        elif self.__base_rate is None or self.rate > self.__base_rate:
+            self.__base_rate = self.rate
+        return self.target
+
+
+class TransferBudget:
+    def __init__(self, connections: Optional[int]=None, bytes_in_flight: Optional[int]=None):
+        """
+        動画のダウンロード全体で、同時に張る接続の数と、頼んだがまだ受け取っていない
+        バイト数 (bytes in flight) に上限を設ける。
+
+        smile と DMC、それに並べて走らせている動画のすべてで一つを共有する。
+        範囲を頼む前に acquire し、受け取るたびに consume し、終わったら release する。
+
+        :param Optional[int] connections: 接続の数の上限。 None なら制限しない
+        :param Optional[int] bytes_in_flight: 頼んだまま受け取っていないバイト数の上限。 None なら制限しない
+        """
+        self.connections = connections
+        self.bytes_in_flight = bytes_in_flight
+        self.open = 0
+        self.reserved = 0
+        self.__waiters = []  # type: List[asyncio.Future]
+
+    async def acquire(self, wanted: int) -> int:
+        """
+        接続一本分と、wanted バイトまでの枠を確保する。
+
+        :param int wanted: 頼みたいバイト数
+        :return: 頼んでよいバイト数。 bytes_in_flight より大きくは頼めない
+        :rtype: int
+        """
+        granted = wanted if self.bytes_in_flight is None else min(wanted, self.bytes_in_flight)
+        while not self.__fits(granted):
+            waiter = asyncio.get_event_loop().create_future()
+            self.__waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self.__waiters:
+                    self.__waiters.remove(waiter)
+        self.open += 1
+        self.reserved += granted
+        return granted
+
+    def consume(self, length: int) -> None:
+        """
+        確保した枠のうち length バイトを受け取った。
+
+        :param int length: 受け取ったバイト数
+        """
+        self.reserved -= length
+        self.__wake()
+
+    def release(self, unused: int=0) -> None:
+        """
+        接続を閉じて、受け取らずに終わった分の枠を返す。
+
+        :param int unused: 確保したが受け取らなかったバイト数
+        """
+        self.open -= 1
+        self.reserved -= unused
+        self.__wake()
+
+    def __fits(self, granted: int) -> bool:
+        if self.connections is not None and self.open >= self.connections:
+            return False
+        # 何も頼んでいなければ、大きくても通す (でないと永久に待つ)
+        return (self.bytes_in_flight is None or self.reserved == 0
+                or self.reserved + granted <= self.bytes_in_flight)
+
+    def __wake(self) -> None:
+        # 待っている全員に確かめ直させる
+        for waiter in self.__waiters:
+            if not waiter.done():
+                waiter.set_result(None)
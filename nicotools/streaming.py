@@ -0,0 +1,143 @@
+# coding: UTF-8
+import asyncio
+from typing import Awaitable, Callable, Dict, IO, List, Optional, Tuple
+
+
+def write_to(stream: IO[bytes]) -> Callable[[str, bytes], Awaitable[None]]:
+    """
+    受け取ったものをそのまま stream (標準出力やパイプ) に書く consumer を作る。
+
+    書き込みはブロックするので、スレッドで行う。
+
+    :param IO[bytes] stream: バイナリで開いた書き込み先
+    :rtype: Callable[[str, bytes], Awaitable[None]]
+    """
+    def _write(data: bytes) -> None:
+        stream.write(data)
+        stream.flush()
+
+    async def consumer(video_id: str, data: bytes) -> None:
+        await asyncio.get_event_loop().run_in_executor(None, _write, data)
+    return consumer
+
+
+class ReorderBuffer:
+    WINDOW = 32 * 1024 * 1024
+
+    def __init__(self, consumer: Callable[[bytes], Awaitable[None]], size: int, window: int=WINDOW):
+        """
+        並べて取ってきた範囲を、前から順に consumer に渡す。
+
+        範囲を取ってくる接続は WriteHandle と同じように write で渡し、
+        ここが順番どおりに並べ直して、一つのタスクから consumer を呼ぶ。
+        まだ渡せないものは、渡し終えたところから window バイト先までしか持たない。
+        それより後ろを渡そうとした接続は、前が埋まるまで待たされる。
+
+        :param Callable[[bytes], Awaitable[None]] consumer: 前から順にデータを受け取る関数
+        :param int size: 全体のバイト数
+        :param int window: 持っておくバイト数の上限
+        """
+        self.consumer = consumer
+        self.size = size
+        self.window = window
+        self.emitted = 0
+        self.position = 0  # consumer に渡し終えたか、渡している途中のところまで
+        self.buffered = 0
+        self.__chunks = {}  # type: Dict[int, Tuple[bytes, asyncio.Future]]
+        self.__waiters = []  # type: List[asyncio.Future]
+        self.__ready = None  # type: Optional[asyncio.Event]
+        self.__task = None  # type: Optional[asyncio.Future]
+        self.__error = None  # type: Optional[BaseException]
+
+    async def write(self, offset: int, data: bytes) -> asyncio.Future:
+        """
+        offset から始まる data を渡す。
+
+        :param int offset: 全体の中での位置
+        :param bytes data:
+        :return: consumer に渡し終えたら結果が入る Future
+        :rtype: asyncio.Future
+        """
+        loop = asyncio.get_event_loop()
+        # 一番前のものはいつでも受け取る (でないと誰も進めない)
+        while offset != self.position and offset + len(data) - self.position > self.window:
+            if self.__error is not None:
+                raise self.__error
+            waiter = loop.create_future()
+            self.__waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self.__waiters:
+                    self.__waiters.remove(waiter)
+        if self.__error is not None:
+            raise self.__error
+        future = loop.create_future()
+        self.__chunks[offset] = (data, future)
+        self.buffered += len(data)
+        if self.__task is None:
+            self.__ready = asyncio.Event()
+            self.__task = asyncio.ensure_future(self._drain())
+        if offset == self.position:
+            self.__ready.set()
+        return future
+
+    async def close(self) -> None:
+        """ 範囲ごとに呼ばれる。まだ渡していないものは finish まで持っておくので、何もしない。 """
+
+    async def finish(self) -> None:
+        """ 全部を consumer に渡し終えるまで待つ。 """
+        if self.__error is not None:
+            raise self.__error
+        if self.__task is not None:
+            await asyncio.shield(self.__task)
+        if self.__error is not None:
+            raise self.__error
+
+    def reset(self) -> None:
+        """
+        まだ consumer に渡していないものを捨てる。
+
+        やり直すときは、 position から後ろを取ってきて渡し直す。
+        渡している途中のものは、そのまま渡し終える。
+        """
+        for _, future in self.__chunks.values():
+            future.cancel()
+        self.__chunks.clear()
+        self.buffered = self.position - self.emitted
+        self.__wake()
+
+    async def abort(self) -> None:
+        """ 止める。 consumer にはもう何も渡さない。 """
+        self.reset()
+        if self.__task is not None:
+            self.__task.cancel()
+            await asyncio.gather(self.__task, return_exceptions=True)
+
+    async def _drain(self) -> None:
+        while self.emitted < self.size:
+            item = self.__chunks.pop(self.position, None)
+            if item is None:
+                self.__ready.clear()
+                await self.__ready.wait()
+                continue
+            data, future = item
+            self.position += len(data)
+            try:
+                await self.consumer(data)
+            except BaseException as error:
+                self.__error = error
+                if not future.done():
+                    future.set_exception(error)
+                self.reset()
+                raise
+            self.emitted += len(data)
+            self.buffered -= len(data)
+            if not future.done():
+                future.set_result(None)
+            self.__wake()
+
+    def __wake(self) -> None:
+        for waiter in self.__waiters:
+            if not waiter.done():
+                waiter.set_result(None)
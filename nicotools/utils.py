@@ -17,6 +17,7 @@ ALL_ITEM = "*"
 DEFAULT_NAME = "とりあえずマイリスト"
 DEFAULT_ID = 0
 LOG_FILE = "nicotools.log"
+CACHE_FILE = "nicotools_cache.sqlite3"
 IS_DEBUG = int(os.getenv("PYTHON_TEST", 0))
 if IS_DEBUG:
     __os_name = os.getenv("TRAVIS_OS_NAME", os.name)
@@ -232,6 +233,42 @@ def make_name(data: dict, save_dir: Path, extention: str=None):
     return Path(save_dir).resolve() / file_name
 
 
+async def run_bounded(source, worker, workers: int, logger=None):
+    """
+    決まった数の作業者で、イテラブルから引数を一つずつ取り出して worker に渡す。
+
+    作業者は自分の仕事が終わってから次の引数を読むので、
+    入力がどれだけ長くても同時に存在するタスクは workers 個だけになる。
+    一件が例外を送出しても、ログに残して次の引数に進む。
+
+    :param Iterable[tuple] source: worker に渡す引数のタプルのイテラブル
+    :param Callable[..., Awaitable] worker: コルーチン関数
+    :param int workers: 作業者の数
+    :param NTLogger | None logger: 失敗を書き出すロガー
+    :rtype: None
+    """
+    source = iter(source)
+
+    async def _work():
+        # イテレーターは全員で一つを共有するので、同じ引数を二度読むことはない
+        for args in source:
+            try:
+                await worker(*args)
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                # 一件の失敗で全体を止めない
+                (logger or NTLogger()).error(Err.worker_failed.format(args=args, reason=error))
+
+    tasks = [asyncio.ensure_future(_work()) for _ in range(max(1, workers))]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
 class Canopy:
     def __init__(self, loop: asyncio.AbstractEventLoop=None, logger=None):
         self.logger = self.get_logger(logger)  # type: NTLogger
@@ -390,13 +427,14 @@ class LogIn:
 
 
 class NTLogger(logging.Logger):
-    def __init__(self, file_name=LOG_FILE, name=__name__, log_level=logging.INFO):
+    def __init__(self, file_name=LOG_FILE, name=__name__, log_level=logging.INFO, console=None):
         """
         ログ出力のためのクラス。
 
         :param str | Path | None file_name:
         :param str name:
         :param str | int log_level:
+        :param IO | None console: 画面に出す先。省略すると標準出力
         """
         if not isinstance(log_level, (str, int)):
             raise ValueError("Invalid Logging Level: {}".format(log_level))
@@ -414,7 +452,7 @@ class NTLogger(logging.Logger):
         self.logger = logging.getLogger(name=name)
 
         # 標準出力用ハンドラー
-        log_stdout = logging.StreamHandler(sys.stdout)
+        log_stdout = logging.StreamHandler(console or sys.stdout)
         log_stdout.setLevel(log_level)
         formatter = self.get_formatter("stdout")
         log_stdout.setFormatter(formatter)
@@ -566,6 +604,30 @@ class Msg:
     nd_help_limit = ("サムネイルとコメントについては同時ダウンロードを、"
                      "動画については1つあたりの分割数をこの数に制限します。標準は 4 です。")
     nd_help_smile = "動画をsmileサーバー(いわゆる従来サーバー)からダウンロードします。"
+    nd_help_pool_size = "全体で同時に張る接続の最大数。標準は 100 です。"
+    nd_help_pool_per_host = "ひとつのサーバーに同時に張る接続の最大数。標準は 10 です。"
+    nd_help_parser = ("視聴ページなどの解析をどこで行うか。 inline (そのまま), thread (スレッドプール),"
+                      " process (プロセスプール) のいずれか。標準は thread です。")
+    nd_help_parser_workers = "解析に使うスレッドまたはプロセスの数。省略すると自動で決めます。"
+    nd_help_parts = ("動画を部分ファイルに分けて保存し、最後に結合します。"
+                     "指定しなければ完成品のファイルに直接書き込みます。")
+    nd_help_auto = ("動画の接続数と一度に読む大きさを、速さを測りながら自動で決めます。"
+                    "小さな動画は一本の接続で取ります。 --limit の動画への指定は無視します。")
+    nd_help_parallel = "動画を何本並べてダウンロードするか。標準は 1 です。"
+    nd_help_connections = ("動画のダウンロードで同時に張る接続の数の上限。"
+                           "並べて走らせている動画すべてを合わせた数です。標準は制限なしです。")
+    nd_help_in_flight = "動画のダウンロードで、頼んだまま受け取っていない量の上限 (MB)。標準は制限なしです。"
+    nd_help_fsync = ("ダウンロードしたものをいつディスクに同期 (fsync) するか。"
+                     "never: しない, close: ファイルを閉じるとき (標準), always: 書き込むたび")
+    nd_help_progress = ("動画のダウンロードの進み具合の出し方。"
+                        "bar: プログレスバー (標準), log: ログに一行ずつ, json: JSON Lines, none: 出さない")
+    nd_help_progress_file = "--progress json の書き込み先。標準は標準出力 (--stdout なら標準エラー出力) です。"
+    nd_help_stdout = ("動画を保存せず、ダウンロードしながら前から順に標準出力へ書き出します。"
+                      "ログと進み具合は標準エラー出力に出し、動画は一本ずつ取ります。")
+    nd_help_window = ("--stdout で、順番を並べ直すために持っておく量の上限 (MiB)。"
+                      "標準は 32 MiB です。")
+    nd_help_cache = ("動画の情報をホームフォルダーに保存しておき、"
+                     "有効期限内なら視聴ページを取りに行きません。")
 
     input_mail = "メールアドレスを入力してください。"
     input_pass = "パスワードを入力してください(画面には表示されません)。"
@@ -573,6 +635,11 @@ class Msg:
     ''' ログに書くメッセージ '''
     nd_start_download = "{count} 件の情報を取りに行きます。: {ids}"
     nd_download_done = "{path} に保存しました。"
+    nd_stream_done = "{video_id} を出力し終えました。"
+    nd_resume = "{path} を途中から再開します。 ({done}/{size} バイト取得済み)"
+    nd_segment_stalled = "{seconds} 秒間データが届かないので接続し直します。 範囲: {start}-{end}"
+    nd_renegotiate = "{video_id} のセッションが切れたので、作り直して続きからダウンロードします。 ({count} 回目)"
+    nd_progress = "{key}: {percent:.1f}% ({done}/{total}, {rate}, 接続 {connections} 本)"
     nd_download_video = "({0}/{1}) ID: {2} ({3}) の動画をダウンロードします。"
     nd_download_pict = "({0}/{1}) ID: {2} ({3}) のサムネイルをダウンロードします。"
     nd_download_comment = "({0}/{1}) ID: {2} ({3}) のコメントをダウンロードします。"
@@ -581,6 +648,7 @@ class Msg:
     nd_start_dl_comment = "{count} 件のコメントをダウンロードします。: {ids}"
     nd_file_name = "{vid}_{name}.{ext}"
     nd_deleted_or_private = "{0} は削除されているか、非公開です。"
+    circuit_closed = "{host} へのアクセスを再開します。"
 
     ml_exported = "{0} に出力しました。"
     ml_items_counts = "含まれる項目の数:"
@@ -616,6 +684,16 @@ class Err:
 
     failed_operation = "以下の理由により操作は失敗しました: {desc}"
     waiting_for_permission = "アクセス制限が解除されるのを待っています…"
+    circuit_opened = ("{host} が混み合っているようです。"
+                      " {cooldown:.0f} 秒間このサーバーへのアクセスを止めます。")
+    retrying = "{method} {url} が失敗しました ({reason})。 {delay:.1f} 秒後に再試行します。({now}/{all})"
+    invalid_executor = "[エラー] 解析の実行方法 {kind} は使えません。 {kinds} のいずれかを指定してください。"
+    stage_failed = "[エラー] {stage} の処理に失敗しました。 動画: {video_id}, 理由: {reason!r}"
+    worker_failed = "[エラー] 処理に失敗しました。 引数: {args}, 理由: {reason!r}"
+    heartbeat_failed = "[エラー] Heartbeat を送れませんでした。 セッション: {key}, 理由: {reason}"
+    session_lost = "[エラー] DMC のセッションが切れました。 セッション: {key}, 理由: {reason!r}"
+    incomplete_download = "[エラー] {video_id} の {missing} バイトを取れないまま接続が終わりました。"
+    invalid_fsync = "[エラー] fsync の方針 {policy} は使えません。 {policies} のいずれかを指定してください。"
     name_replaced = ("作成しようとした名前「{0}」は特殊文字を含むため、"
                      "「{1}」に置き換わっています。")
     cant_create = "この名前のマイリストは作成できません。"
@@ -802,6 +880,22 @@ class MKey:
     ITEM_DATA   = "item_data"
 
 
+class Endpoint:
+    """ 通信先の種類。再試行の方針を選ぶのに使う。 """
+    DEFAULT         = "default"
+    WATCH           = "watch"           # 動画視聴ページ
+    THUMBINFO       = "thumbinfo"       # getthumbinfo API
+    GETFLV          = "getflv"          # getflv API
+    THUMBNAIL       = "thumbnail"       # サムネイル画像
+    COMMENT         = "comment"         # コメントサーバー
+    FLAPI           = "flapi"           # getthreadkey, getwaybackkey
+    DMC_SESSION     = "dmc_session"     # DMCサーバーとのセッションの確立
+    HEARTBEAT       = "heartbeat"       # DMCサーバーへのハートビート
+    VIDEO           = "video"           # 動画本体
+    MYLIST          = "mylist"          # マイリストの読み出し
+    MYLIST_EDIT     = "mylist_edit"     # マイリストの編集 (冪等でない)
+
+
 class DataKey:
     CHUNK_SIZE      = "CHUNK_SIZE"
     DIVISION        = "DIVISION"
@@ -809,8 +903,17 @@ class DataKey:
     IS_SMILE        = "SMILE"
     LOGGER          = "LOGGER"
     LOOP            = "LOOP"
+    PREALLOCATE     = "PREALLOCATE"
+    PARALLEL        = "PARALLEL"
+    PREFETCH        = "PREFETCH"
+    HEARTBEAT       = "HEARTBEAT"
+    BUDGET          = "BUDGET"
     SAVE_DIR        = "SAVE_DIR"
     SESSION         = "SESSION"
+    WRITER          = "WRITER"
+    PROGRESS        = "PROGRESS"
+    STREAM          = "STREAM"
+    WINDOW          = "WINDOW"
 
 
 
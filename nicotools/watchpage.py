@@ -0,0 +1,182 @@
+# coding: UTF-8
+import html
+import re
+from typing import Optional, Tuple
+
+from bs4 import BeautifulSoup
+
+# 視聴ページから取り出すデータの種類
+DATA_API = "data_api"  # <div id="js-initial-watch-data" data-api-data="...">
+WATCH_API = "watch_api"  # <div id="watchAPIDataContainer">...</div>
+LOGIN = "login"  # ログインしていない (ログインページが返ってきた)
+
+ID_DATA_API = "js-initial-watch-data"
+ID_WATCH_API = "watchAPIDataContainer"
+ID_LOGIN = "Login_nico"
+
+# data-video-id="..." などに引っかからないように、直前が名前の一部でないことを確かめる
+_RE_ID_ATTR = "(?<![\\w-])id\\s*=\\s*[\"']{0}[\"']"
+_RE_DATA_API_ID = re.compile(_RE_ID_ATTR.format(ID_DATA_API))
+_RE_WATCH_API_ID = re.compile(_RE_ID_ATTR.format(ID_WATCH_API))
+_RE_LOGIN_ID = re.compile(_RE_ID_ATTR.format(ID_LOGIN))
+_RE_DATA_API_ATTR = re.compile("\\bdata-api-data\\s*=\\s*(?:\"([^\"]*)\"|'([^']*)')")
+
+
+def extract(content: str) -> Tuple[Optional[str], Optional[str]]:
+    """
+    視聴ページのHTMLから、動画の情報が入ったJSONの文字列を取り出す。
+
+    BeautifulSoup でページ全体を解析せず、目印のタグを直接探して取り出す。
+    目印はあるのに取り出せなかったときだけ BeautifulSoup に任せる。
+
+    :param str content: 視聴ページのHTML
+    :return: (DATA_API, WATCH_API, LOGIN のいずれか, JSONの文字列) か、何もなければ (None, None)
+    :rtype: Tuple[Optional[str], Optional[str]]
+    """
+    if find_tag(content, ID_LOGIN, _RE_LOGIN_ID):
+        return LOGIN, None
+    result = _scan_data_api(content) or _scan_watch_api(content)
+    if result:
+        return result
+    if ID_DATA_API in content or ID_WATCH_API in content or ID_LOGIN in content:
+        return extract_with_soup(content)
+    return None, None
+
+
+def find_tag(content: str, id_value: str, pattern) -> Optional[Tuple[int, int]]:
+    """
+    指定した id を持つ開始タグの位置を返す。
+
+    正規表現で全体を舐めるより、ただの文字列検索で当たりをつけるほうがずっと速い。
+    属性値の中の < や > は &lt; や &gt; になっている前提。
+
+    :param str content: HTML
+    :param str id_value: id 属性の値
+    :param pattern: id="..." に当たるコンパイル済みの正規表現
+    :return: 開始タグの (始まり, 終わりの次) の位置。見つからなければ None
+    :rtype: Optional[Tuple[int, int]]
+    """
+    pos = content.find(id_value)
+    while pos >= 0:
+        start = content.rfind("<", 0, pos)
+        end = content.find(">", pos)
+        if start >= 0 and end >= 0 and pattern.search(content, start, end):
+            return start, end + 1
+        pos = content.find(id_value, pos + 1)
+    return None
+
+
+def _scan_data_api(content: str) -> Optional[Tuple[str, str]]:
+    tag = find_tag(content, ID_DATA_API, _RE_DATA_API_ID)
+    if not tag:
+        return None
+    attr = _RE_DATA_API_ATTR.search(content, *tag)
+    if not attr:
+        return None
+    value = attr.group(1) if attr.group(1) is not None else attr.group(2)
+    return DATA_API, html.unescape(value)
+
+
+def _scan_watch_api(content: str) -> Optional[Tuple[str, str]]:
+    tag = find_tag(content, ID_WATCH_API, _RE_WATCH_API_ID)
+    if not tag:
+        return None
+    end = content.find("<", tag[1])
+    if end < 0:
+        return None
+    return WATCH_API, html.unescape(content[tag[1]:end])
+
+
+def extract_with_soup(content: str) -> Tuple[Optional[str], Optional[str]]:
+    """
+    extract と同じものを BeautifulSoup で取り出す。遅いが確実。
+
+    :param str content: 視聴ページのHTML
+    :rtype: Tuple[Optional[str], Optional[str]]
+    """
+    soup = BeautifulSoup(content, "html.parser")
+    if soup.select("#" + ID_LOGIN):
+        return LOGIN, None
+    _data_api = soup.select("#" + ID_DATA_API)
+    _watch_api = soup.select("#" + ID_WATCH_API)
+    if _data_api:
+        return DATA_API, _data_api[0]["data-api-data"]
+    elif _watch_api:
+        return WATCH_API, _watch_api[0].text
+    return None, None
+
+
+class Scanner:
+    def __init__(self):
+        """
+        視聴ページを少しずつ受け取りながら、目当てのデータを探す。
+
+        目当てのデータが揃った時点で done が True になるので、残りは読まずに
+        接続を閉じてよい。探し終えた部分は捨てるので、ページ全体は溜め込まない。
+
+            scanner = Scanner()
+            for chunk in chunks:
+                if scanner.feed(chunk):
+                    break
+            kind, payload = scanner.close()
+        """
+        self.__buffer = ""
+        self.__result = None  # type: Optional[Tuple[Optional[str], Optional[str]]]
+        self.received = 0
+
+    @property
+    def done(self) -> bool:
+        return self.__result is not None
+
+    @property
+    def buffered(self) -> int:
+        """ まだ捨てずに持っている文字数 """
+        return len(self.__buffer)
+
+    def feed(self, text: str) -> bool:
+        """
+        続きを渡す。
+
+        :param str text: 受け取ったHTMLの断片
+        :return: 目当てのデータが揃ったかどうか
+        :rtype: bool
+        """
+        if self.done:
+            return True
+        self.received += len(text)
+        self.__buffer += text
+        buffer = self.__buffer
+        if find_tag(buffer, ID_LOGIN, _RE_LOGIN_ID):
+            self.__result = LOGIN, None
+            return True
+        result = _scan_data_api(buffer) or _scan_watch_api(buffer)
+        if result:
+            self.__result = result
+            self.__buffer = ""
+            return True
+
+        # 目印のタグが途中まで来ていれば、その頭から残す
+        tags = [tag for tag in (find_tag(buffer, ID_DATA_API, _RE_DATA_API_ID),
+                                find_tag(buffer, ID_WATCH_API, _RE_WATCH_API_ID)) if tag]
+        if tags:
+            keep = min(start for start, _ in tags)
+        else:
+            # 閉じていないタグは、後から目印の id が来るかもしれない
+            keep = buffer.rfind("<")
+            if keep < 0:
+                keep = len(buffer)
+        self.__buffer = buffer[keep:]
+        return False
+
+    def close(self) -> Tuple[Optional[str], Optional[str]]:
+        """
+        読み終えた (または読むのをやめた) ときに呼ぶ。
+
+        :return: extract と同じ形の結果
+        :rtype: Tuple[Optional[str], Optional[str]]
+        """
+        if self.__result is None:
+            # 最後まで揃わなかったら、残っている分だけで確実な方法を試す
+            self.__result = extract(self.__buffer)
+            self.__buffer = ""
+        return self.__result
@@ -0,0 +1,127 @@
+# coding: UTF-8
+"""
+動画の本体を受け取ってディスクに書くまでの CPU 時間を比べる。
+
+    python -m tests.bench_receive [大きさ (MiB)] [一度に読む大きさ (KiB) ...]
+
+手元にサーバーを立て、一度に受け取る大きさごとに、 read(n) で受け取るやり方と、
+届いたものをコピーせずに memoryview で区切って書くやり方とで、 1 GB あたりの CPU 時間を測る。
+CPU 時間の多くは、コピーよりも受け取るたびの処理にかかる。
+"""
+import asyncio
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+import aiohttp
+from aiohttp import web
+
+from nicotools import fileio
+
+GB = 1024 ** 3
+
+
+def serve(size: int, ports: multiprocessing.Queue) -> None:
+    """ 別のプロセスでサーバーを動かす。サーバーの CPU 時間を測る側に含めないため。 """
+    body = os.urandom(size)
+
+    async def handler(request):
+        response = web.StreamResponse(headers={"Content-Length": str(len(body))})
+        await response.prepare(request)
+        view = memoryview(body)
+        # 実際の動画サーバーのように、少しずつ送る
+        for start in range(0, len(body), 256 * 1024):
+            await response.write(view[start:start + 256 * 1024])
+        return response
+
+    async def _run():
+        app = web.Application()
+        app.router.add_get("/video", handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        ports.put(site._server.sockets[0].getsockname()[1])
+        await asyncio.Event().wait()
+
+    asyncio.new_event_loop().run_until_complete(_run())
+
+
+async def with_read(content: aiohttp.StreamReader, handle: fileio.WriteHandle, chunk_size: int) -> int:
+    """ VideoDownloader と同じやり方。届いた分を chunk_size までつなげた bytes を受け取る。 """
+    offset = 0
+    while True:
+        data = await content.read(chunk_size)
+        if not data:
+            return offset
+        await handle.write(offset, data)
+        offset += len(data)
+
+
+async def with_views(content: aiohttp.StreamReader, handle: fileio.WriteHandle, chunk_size: int) -> int:
+    """ 比べるためのやり方。 aiohttp が受け取った bytes をつなげず、 memoryview で区切ってそのまま書く。 """
+    offset = 0
+    while True:
+        chunk, end_of_chunk = await content.readchunk()
+        if not chunk:
+            if end_of_chunk:
+                continue
+            return offset
+        view = memoryview(chunk)
+        for start in range(0, len(view), chunk_size):
+            await handle.write(offset, view[start:start + chunk_size])
+            offset += len(view[start:start + chunk_size])
+
+
+async def measure(receive, url: str, size: int, chunk_size: int) -> Tuple[float, float]:
+    """
+    一回ダウンロードして、かかった CPU 時間と経過時間を測る。
+
+    :rtype: Tuple[float, float]
+    """
+    writer = fileio.DiskWriter(fsync=fileio.DiskWriter.FSYNC_NEVER)
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            async with aiohttp.ClientSession() as session:
+                wall, cpu = time.perf_counter(), time.process_time()
+                handle = await writer.open(os.path.join(directory, "video.mp4"), truncate=True)
+                async with session.get(url) as response:
+                    received = await receive(response.content, handle, chunk_size)
+                await handle.close()
+                wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    finally:
+        writer.shutdown()
+    assert received == size
+    return cpu, wall
+
+
+async def main(size: int, chunk_sizes: List[int], rounds: int=5) -> None:
+    ports = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(size, ports), daemon=True)
+    server.start()
+    try:
+        url = f"http://127.0.0.1:{ports.get(timeout=60)}/video"
+        for chunk_size in chunk_sizes:
+            results = {}  # type: Dict[str, List[Tuple[float, float]]]
+            # 順番による偏りが出ないよう、交互に測る
+            for _ in range(rounds):
+                for name, receive in (("read(n)", with_read), ("memoryview", with_views)):
+                    results.setdefault(name, []).append(await measure(receive, url, size, chunk_size))
+            for name, measured in results.items():
+                cpu = statistics.median(cpu for cpu, _ in measured)
+                wall = statistics.median(wall for _, wall in measured)
+                print(f"{name} {chunk_size // 1024} KiB: CPU {cpu * GB / size:.2f} 秒/GB, "
+                      f"{size / wall / 1024 ** 2:.0f} MiB/秒")
+    finally:
+        server.terminate()
+
+
+if __name__ == "__main__":
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 128
+    # 以前の標準の 50 KiB と、今の標準の 1 MiB
+    chunk_sizes = [int(arg) * 1024 for arg in sys.argv[2:]] or [50 * 1024, 1024 * 1024]
+    asyncio.get_event_loop().run_until_complete(main(size * 1024 ** 2, chunk_sizes))
@@ -0,0 +1,59 @@
+# coding: UTF-8
+"""
+視聴ページから情報を取り出す速さを比べる。
+
+    python -m tests.bench_watchpage [保存した視聴ページ.html ...]
+
+ファイルを指定しなければ、実物に近い大きさのページを作って測る。
+"""
+import html
+import json
+import sys
+import timeit
+from pathlib import Path
+
+from nicotools import watchpage
+
+
+def make_page(kind: str=watchpage.DATA_API, filler: int=3000) -> str:
+    """
+    視聴ページに似せたHTMLを作る。
+
+    :param str kind: watchpage.DATA_API か watchpage.WATCH_API
+    :param int filler: 前後に詰めるタグの数
+    :rtype: str
+    """
+    data = {
+        "video": {"id": "sm9", "title": "<テスト> & \"動画\"", "description": "説明 " * 500,
+                  "tags": [{"name": f"タグ{i}"} for i in range(50)]},
+        "comments": [{"no": i, "body": f"コメント{i}"} for i in range(300)],
+    }
+    payload = html.escape(json.dumps(data, ensure_ascii=False))
+    noise = "".join(f'<li class="item"><a href="/watch/sm{i}">動画 {i}</a></li>' for i in range(filler))
+    if kind == watchpage.DATA_API:
+        body = f'<div id="js-initial-watch-data" data-api-data="{payload}" data-environment="{{}}"></div>'
+    else:
+        body = f'<div id="watchAPIDataContainer" style="display:none">{payload}</div>'
+    return (f'<!DOCTYPE html><html><head><title>test</title></head><body>'
+            f'<ul>{noise}</ul>{body}<ul>{noise}</ul></body></html>')
+
+
+def bench(name: str, content: str, number: int=20) -> None:
+    fast = min(timeit.repeat(lambda: watchpage.extract(content), number=number, repeat=3)) / number
+    slow = min(timeit.repeat(lambda: watchpage.extract_with_soup(content), number=number, repeat=3)) / number
+    assert watchpage.extract(content) == watchpage.extract_with_soup(content)
+    print(f"{name}: {len(content) / 1024:.0f} KiB, "
+          f"BeautifulSoup {slow * 1000:.2f} ms, 直接探索 {fast * 1000:.3f} ms, {slow / fast:.0f} 倍")
+
+
+def main(paths) -> None:
+    if paths:
+        for path in paths:
+            bench(path, Path(path).read_text(encoding="utf-8"))
+    else:
+        bench("data-api-data (生成)", make_page(watchpage.DATA_API))
+        bench("watchAPIDataContainer (生成)", make_page(watchpage.WATCH_API))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
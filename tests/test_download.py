@@ -1,15 +1,31 @@
 # coding: UTF-8
+import asyncio
+import html
+import io
+import json
 import os
 import random
 import shutil
 import time
+from pathlib import Path
 
 import aiohttp
 import pytest
+from aiohttp import web
 
 import nicotools
-from nicotools import utils
-from nicotools.download import Info, Video, Comment, Thumbnail
+from nicotools import utils, watchpage, fileio
+from nicotools.cache import InfoCache
+from nicotools.connection import (SessionManager, RateLimiter, TokenBucket, RetryPolicy, CircuitBreaker,
+                                  RETRY_POLICIES)
+from nicotools.executor import ParseExecutor
+from nicotools.heartbeat import Beat, HeartbeatManager, SessionLost
+from nicotools.manifest import RangeManifest
+from nicotools.progress import ProgressBus, JsonLinesSink
+from nicotools.segments import SegmentScheduler, ThroughputTuner, TransferBudget
+from nicotools.streaming import ReorderBuffer
+from nicotools.download import Info, Video, Comment, Thumbnail, Pipeline, InfoFailure, VideoSmile, VideoDmc
+from nicotools.utils import KeyDmc, DataKey, Endpoint
 
 Waiting = 5
 SAVE_DIR = "tests/downloads/"
@@ -20,6 +36,69 @@ AUTH_P = (os.getenv("addr_p"), os.getenv("pass_p"))
 LOGGER = utils.NTLogger(log_level=10)
 
 
+async def serve(handler, path="/{tail:.*}"):
+    """
+    テスト用にローカルでHTTPサーバーを立てる。
+
+    :param handler: aiohttp.web のハンドラー
+    :param str path: ハンドラーを割り当てるパス
+    :rtype: (web.AppRunner, str)
+    """
+    app = web.Application()
+    app.router.add_route("*", path, handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+def range_handler(body, requests=None):
+    """
+    Range ヘッダーに応えるハンドラーを作る。
+
+    :param bytes body: 配信する中身
+    :param list requests: 受け取った Range ヘッダーを記録するリスト
+    """
+    async def handler(request):
+        if request.method == "HEAD":
+            return web.Response(headers={"Content-Length": str(len(body))})
+        header = request.headers.get("Range")
+        if requests is not None:
+            requests.append(header)
+        if not header:
+            return web.Response(body=body)
+        start, end = header.replace("bytes=", "").split("-")
+        start, end = int(start), int(end or len(body) - 1)
+        return web.Response(status=206, body=body[start:end + 1], headers={
+            "Content-Range": f"bytes {start}-{end}/{len(body)}"})
+    return handler
+
+
+def video_commons(session, loop, save_dir, **kwargs):
+    """ VideoSmile などに渡す共通の設定を作る。 """
+    commons = {
+        DataKey.SESSION     : session,
+        DataKey.LOGGER      : LOGGER,
+        DataKey.LOOP        : loop,
+        DataKey.CHUNK_SIZE  : 1024,
+        DataKey.IS_MULTILINE: True,
+        DataKey.IS_SMILE    : True,
+        DataKey.DIVISION    : 4,
+        DataKey.SAVE_DIR    : save_dir,
+    }
+    commons.update(kwargs)
+    return commons
+
+
+def video_info(video_id, url, size=None):
+    """ 動画ひとつ分の情報を作る。 """
+    return {KeyDmc.VIDEO_ID: video_id, KeyDmc.TITLE: video_id, KeyDmc.FILE_NAME: video_id,
+            KeyDmc.MOVIE_TYPE: "mp4", KeyDmc.VIDEO_URL_SM: url, KeyDmc.FILE_SIZE: size,
+            KeyDmc.IS_DMC: False}
+
+
 def rand(num=1):
     """
     動画IDをランダムに取り出す。0を指定すると全てを返す。
@@ -63,6 +142,54 @@ class TestUtils:
              "so1234", "so123456",
              "123456", "1278053154"})
 
+    def test_run_bounded(self):
+        loop = asyncio.new_event_loop()
+        read, done = [], []
+        state = {"now": 0, "peak": 0}
+
+        def source():
+            for num in range(50):
+                read.append(num)
+                # 作業者の数を超えて先読みしない
+                assert len(read) - len(done) <= 3
+                yield num, num % 2
+
+        async def worker(num, parity):
+            state["now"] += 1
+            state["peak"] = max(state["peak"], state["now"])
+            await asyncio.sleep(0.001 * parity)
+            state["now"] -= 1
+            done.append(num)
+
+        try:
+            loop.run_until_complete(utils.run_bounded(source(), worker, 3))
+            assert sorted(done) == list(range(50))
+            assert state["peak"] == 3
+        finally:
+            loop.close()
+
+    def test_run_bounded_failure(self):
+        loop = asyncio.new_event_loop()
+        done = []
+
+        async def worker(num):
+            await asyncio.sleep(0.001 * num)
+            if num == 1:
+                raise ValueError(num)
+            done.append(num)
+
+        async def _run():
+            await utils.run_bounded(((num,) for num in range(6)), worker, 2, LOGGER)
+            # 後に残っている作業者はいない
+            return [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+
+        try:
+            # 一件が失敗しても、残りは最後まで処理する
+            assert loop.run_until_complete(_run()) == []
+            assert sorted(done) == [0, 2, 3, 4, 5]
+        finally:
+            loop.close()
+
     def test_make_dir(self):
         save_dir = ["test", "foo", "foo/bar", "some/thing/text.txt"]
         paths = [utils.get_dir(name) for name in save_dir]
@@ -234,5 +361,1403 @@ class TestVideo:
                 pass
 
 
+class TestSessionManager:
+    def test_pool_settings(self):
+        loop = asyncio.new_event_loop()
+        try:
+            manager = loop.run_until_complete(
+                SessionManager(limit=20, limit_per_host=5, loop=loop).open())
+            connector = manager.session.connector
+            assert connector.limit == 20
+            assert connector.limit_per_host == 5
+            assert connector.use_dns_cache
+            # 二度目の open では作り直さない
+            session = manager.session
+            loop.run_until_complete(manager.open())
+            assert manager.session is session
+            loop.run_until_complete(manager.close())
+            assert manager.closed
+        finally:
+            loop.close()
+
+    def test_borrowed_session_is_not_closed(self):
+        loop = asyncio.new_event_loop()
+        try:
+            owner = loop.run_until_complete(SessionManager(loop=loop).open())
+            assert SessionManager.wrap(owner) is owner
+            borrowed = SessionManager.wrap(owner.session)
+            loop.run_until_complete(borrowed.close())
+            assert not owner.closed
+            loop.run_until_complete(owner.close())
+        finally:
+            loop.close()
+
+
+class TestRateLimiter:
+    def test_rule_for_host(self):
+        limiter = RateLimiter(rules={"example.com": (1, 1.0)})
+        assert limiter.rule_for("www.nicovideo.jp") == RateLimiter.DEFAULT_RULES["www.nicovideo.jp"]
+        assert limiter.rule_for("smile-cls20.sl.nicovideo.jp") == RateLimiter.DEFAULT_RULES["nicovideo.jp"]
+        assert limiter.rule_for("pa0123.dmc.nico") == RateLimiter.DEFAULT_RULES["dmc.nico"]
+        assert limiter.rule_for("sub.example.com") == (1, 1.0)
+        assert limiter.rule_for("notexample.com") == RateLimiter.DEFAULT_LIMIT
+
+    def test_same_host_shares_limiter(self):
+        limiter = RateLimiter()
+        assert (limiter.get("http://www.nicovideo.jp/watch/sm9") is
+                limiter.get("http://www.nicovideo.jp/api/mylist/list"))
+        assert limiter.get("http://www.nicovideo.jp/") is not limiter.get("http://ext.nicovideo.jp/")
+
+    def test_token_bucket(self):
+        loop = asyncio.new_event_loop()
+        try:
+            async def _take(count):
+                bucket = TokenBucket(rate=20, capacity=1, loop=loop)
+                start = loop.time()
+                for _ in range(count):
+                    await bucket.acquire()
+                return loop.time() - start
+            # 最初の一つはすぐ、残りの5つは 1/20 秒ずつ待たされる
+            assert 0.2 <= loop.run_until_complete(_take(6)) < 1.0
+        finally:
+            loop.close()
+
+    def test_video_ranges_are_not_rated(self):
+        loop = asyncio.new_event_loop()
+
+        async def handler(request):
+            return web.Response(body=b"x")
+
+        async def _run():
+            runner, base = await serve(handler)
+            manager = await SessionManager(limiter=RateLimiter(rules={"127.0.0.1": (2, 1.0)}, loop=loop),
+                                           loop=loop).open()
+
+            async def get(endpoint):
+                async with manager.get(base, endpoint=endpoint) as response:
+                    return await response.read()
+
+            try:
+                start = loop.time()
+                # 動画本体は同時接続数だけを守り、毎秒 1 回には抑えない
+                await asyncio.gather(*[get(Endpoint.VIDEO) for _ in range(6)])
+                assert loop.time() - start < 1.0
+                start = loop.time()
+                await asyncio.gather(*[get(Endpoint.DEFAULT) for _ in range(3)])
+                assert loop.time() - start >= 1.0
+            finally:
+                await manager.close()
+                await runner.cleanup()
+
+        try:
+            loop.run_until_complete(_run())
+        finally:
+            loop.close()
+
+    def test_concurrency_is_capped(self):
+        loop = asyncio.new_event_loop()
+        state = {"now": 0, "peak": 0}
+
+        async def handler(request):
+            state["now"] += 1
+            state["peak"] = max(state["peak"], state["now"])
+            await asyncio.sleep(0.05)
+            state["now"] -= 1
+            return web.Response(text="ok")
+
+        async def _run():
+            runner, base = await serve(handler)
+            manager = await SessionManager(
+                limiter=RateLimiter(default=(2, 0), loop=loop), loop=loop).open()
+            try:
+                async def _one(i):
+                    async with manager.get(f"{base}/{i}") as resp:
+                        return await resp.text()
+                return await asyncio.gather(*[_one(i) for i in range(10)])
+            finally:
+                await manager.close()
+                await runner.cleanup()
+
+        try:
+            assert loop.run_until_complete(_run()) == ["ok"] * 10
+            assert state["peak"] == 2
+        finally:
+            loop.close()
+
+
+class TestRetryPolicy:
+    def test_backoff_is_jittered_and_capped(self):
+        policy = RetryPolicy(base=1, factor=2, cap=5)
+        for attempt in range(10):
+            assert 0 <= policy.backoff(attempt) <= min(5, 2 ** attempt)
+
+    def test_retry_after(self):
+        assert RetryPolicy.retry_after({"Retry-After": "12"}) == 12
+        assert RetryPolicy.retry_after({"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"}) == 0
+        assert RetryPolicy.retry_after({"Retry-After": "soon"}) is None
+        assert RetryPolicy.retry_after({}) is None
+
+    def test_idempotency(self):
+        policy = RetryPolicy()
+        assert policy.should_retry_status("GET", 502)
+        assert not policy.should_retry_status("POST", 502)
+        assert policy.should_retry_status("POST", 503)
+        assert not policy.should_retry_status("GET", 404)
+        assert RetryPolicy(idempotent=False).should_retry_status("GET", 429)
+        assert not RetryPolicy(idempotent=False).should_retry_status("GET", 500)
+        assert not policy.should_retry_error("POST", aiohttp.ServerDisconnectedError())
+        assert policy.should_retry_error("GET", aiohttp.ServerDisconnectedError())
+        # コメントの取得と Heartbeat は POST でも送り直してよい
+        for endpoint in (Endpoint.COMMENT, Endpoint.HEARTBEAT):
+            assert RETRY_POLICIES[endpoint].should_retry_status("POST", 502)
+            assert RETRY_POLICIES[endpoint].should_retry_error("POST", asyncio.TimeoutError())
+
+    def test_request_is_retried(self):
+        loop = asyncio.new_event_loop()
+        calls = []
+
+        async def handler(request):
+            calls.append(request.method)
+            if len(calls) < 3:
+                return web.Response(status=503, headers={"Retry-After": "0"})
+            return web.Response(text="ok")
+
+        async def _run():
+            runner, base = await serve(handler)
+            manager = await SessionManager(loop=loop).open()
+            try:
+                async with manager.get(base, retry=RetryPolicy(retries=5, base=0.01)) as resp:
+                    first = (resp.status, await resp.text())
+                del calls[:]
+                async with manager.get(base, retry=RetryPolicy(retries=1, base=0.01)) as resp:
+                    second = resp.status
+                return first, second
+            finally:
+                await manager.close()
+                await runner.cleanup()
+
+        try:
+            first, second = loop.run_until_complete(_run())
+            assert first == (200, "ok")
+            # 再試行し尽くしたら最後のレスポンスをそのまま返す
+            assert second == 503
+            assert len(calls) == 2
+        finally:
+            loop.close()
+
+
+class TestCircuitBreaker:
+    def test_open_probe_close(self):
+        loop = asyncio.new_event_loop()
+
+        async def _run():
+            breaker = CircuitBreaker(threshold=3, window=10, cooldown=0.1, loop=loop)
+            for _ in range(2):
+                breaker.record(503)
+            breaker.record(200)
+            assert breaker.state == CircuitBreaker.CLOSED
+            breaker.record(503)
+            assert breaker.state == CircuitBreaker.OPEN
+
+            waiters = [asyncio.ensure_future(breaker.wait()) for _ in range(2)]
+            done, pending = await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+            assert [task.result() for task in done] == [True]
+            await asyncio.sleep(0.05)
+            # 試しに通したものの結果が出るまでは誰も通さない
+            assert breaker.state == CircuitBreaker.HALF_OPEN
+            assert not pending.pop().done()
+            breaker.record(200, is_probe=True)
+            assert [await task for task in waiters].count(False) == 1
+            assert breaker.state == CircuitBreaker.CLOSED
+
+        try:
+            loop.run_until_complete(_run())
+        finally:
+            loop.close()
+
+    def test_failed_probe_reopens(self):
+        loop = asyncio.new_event_loop()
+
+        async def _run():
+            breaker = CircuitBreaker(threshold=1, cooldown=0.05, max_cooldown=0.08, loop=loop)
+            breaker.record(429)
+            assert await breaker.wait() is True
+            breaker.record(503, is_probe=True)
+            assert breaker.state == CircuitBreaker.OPEN
+            assert 0.05 < breaker.remaining <= 0.08
+            assert await breaker.wait() is True
+            breaker.abandon()
+            assert await breaker.wait() is True
+
+        try:
+            loop.run_until_complete(_run())
+        finally:
+            loop.close()
+
+    def test_queued_requests_pause(self):
+        loop = asyncio.new_event_loop()
+        served = []
+
+        async def _run():
+            release = asyncio.Event()
+
+            async def handler(request):
+                served.append(request.path)
+                await release.wait()
+                return web.Response(status=503)
+
+            runner, base = await serve(handler)
+            manager = await SessionManager(limiter=RateLimiter(rules={"127.0.0.1": (1, 0)}, loop=loop),
+                                           breaker_settings={"threshold": 1, "cooldown": 10},
+                                           loop=loop).open()
+
+            async def get(path):
+                async with manager.get(base + path, retry=RetryPolicy(retries=0)) as response:
+                    return response.status
+
+            try:
+                first = asyncio.ensure_future(get("/1"))
+                await asyncio.sleep(0.05)
+                # ブレーカーが閉じている間に通り、枠が空くのを待っている
+                queued = [asyncio.ensure_future(get(f"/{num}")) for num in range(2, 5)]
+                await asyncio.sleep(0.05)
+                release.set()
+                assert await first == 503
+                await asyncio.sleep(0.1)
+                # 枠が空いても、ブレーカーが開いたので誰も送らない
+                assert manager.breaker(base).state == CircuitBreaker.OPEN
+                assert served == ["/1"] and not any(task.done() for task in queued)
+                for task in queued:
+                    task.cancel()
+                await asyncio.gather(*queued, return_exceptions=True)
+            finally:
+                await manager.close()
+                await runner.cleanup()
+
+        try:
+            loop.run_until_complete(_run())
+        finally:
+            loop.close()
+
+
+class TestPipeline:
+    class SlowInfo(Info):
+        """ 視聴ページの代わりに、指定した秒数だけ待ってから情報を返す。 """
+        delays = {"sm1": 0.5, "sm2": 0, "sm3": 0}
+
+        async def _retrieve_info(self, video_id):
+            await asyncio.sleep(self.delays[video_id])
+            return {KeyDmc.VIDEO_ID: video_id, KeyDmc.IS_PUBLIC: video_id != "sm3", KeyDmc.IS_DELETED: False}
+
+    class Recorder:
+        def __init__(self, fail=()):
+            self.seen = []
+            self.fail = fail
+
+        async def fetch(self, video_id, info, idx, total):
+            if video_id in self.fail:
+                raise ValueError(video_id)
+            self.seen.append((video_id, idx, total))
+
+    def test_items_flow_as_they_arrive(self):
+        loop = asyncio.new_event_loop()
+        try:
+            info = self.SlowInfo(None, session=SessionManager(loop=loop), logger=LOGGER, loop=loop)
+            thumbnail, comment = self.Recorder(), self.Recorder(fail=("sm2",))
+            done = Pipeline(info, thumbnail=thumbnail, comment=comment, queue_size=1,
+                            logger=LOGGER, loop=loop).start(["sm1", "sm2", "sm3"])
+            # 遅い sm1 を待たずに sm2 が先に流れ、非公開の sm3 は流れない
+            assert thumbnail.seen == [("sm2", 0, 3), ("sm1", 1, 3)]
+            assert done == {"thumbnail": ["sm2", "sm1"], "comment": ["sm1"]}
+        finally:
+            loop.close()
+
+
+class TestInfoStream:
+    class FakeInfo(Info):
+        """ 動画IDの数字ぶんだけ待ってから情報を返す。 """
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.in_flight = 0
+            self.peak = 0
+
+        async def _retrieve_info(self, video_id):
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+            try:
+                await asyncio.sleep(int(video_id[2:]) / 100)
+                if video_id == "sm4":
+                    raise aiohttp.ClientConnectionError("boom")
+                if video_id == "sm5":
+                    return None
+                return {KeyDmc.VIDEO_ID: video_id, KeyDmc.IS_PUBLIC: video_id != "sm3",
+                        KeyDmc.IS_DELETED: False}
+            finally:
+                self.in_flight -= 1
+
+    def test_yields_records_and_failures_in_completion_order(self):
+        loop = asyncio.new_event_loop()
+
+        async def _run(info):
+            return [(video_id, item) async for video_id, item
+                    in info.stream(["sm5", "sm4", "sm3", "sm2", "sm1", "xx"], window=2)]
+
+        try:
+            info = self.FakeInfo(None, session=SessionManager(loop=loop), logger=LOGGER, loop=loop)
+            result = loop.run_until_complete(_run(info))
+            assert info.peak <= 2
+            order = [video_id for video_id, _ in result]
+            assert sorted(order) == ["sm1", "sm2", "sm3", "sm4", "sm5", "xx"]
+            # 入力の順ではなく、取れた順に返ってくる
+            assert order.index("sm4") < order.index("sm5")
+            reasons = {video_id: item.reason for video_id, item in result if isinstance(item, InfoFailure)}
+            assert reasons == {"sm4": InfoFailure.ERROR, "sm5": InfoFailure.NOT_FOUND,
+                               "sm3": InfoFailure.UNAVAILABLE, "xx": InfoFailure.INVALID}
+            assert dict(result)["sm1"][KeyDmc.VIDEO_ID] == "sm1"
+        finally:
+            loop.close()
+
+    def test_unparseable_page(self):
+        loop = asyncio.new_event_loop()
+
+        class BrokenInfo(self.FakeInfo):
+            async def _retrieve_info(self, video_id):
+                if video_id == "sm2":
+                    # 視聴ページの形が変わっていて読めない
+                    return self._read_from_data_api('<div id="js-initial-watch-data" data-api-data="{"></div>')
+                return await super()._retrieve_info(video_id)
+
+        async def _run(info):
+            return dict([item async for item in info.stream(["sm1", "sm2", "sm6"], window=3)])
+
+        try:
+            info = BrokenInfo(None, session=SessionManager(loop=loop), logger=LOGGER, loop=loop)
+            result = loop.run_until_complete(_run(info))
+            # 一件が読めなくても、他の動画は最後まで流れる
+            assert result["sm2"].reason == InfoFailure.ERROR and result["sm2"].error is not None
+            assert result["sm1"][KeyDmc.VIDEO_ID] == "sm1" and result["sm6"][KeyDmc.VIDEO_ID] == "sm6"
+        finally:
+            loop.close()
+
+    def test_stops_reading_ids_when_abandoned(self):
+        loop = asyncio.new_event_loop()
+        consumed = []
+
+        def ids():
+            for num in range(1, 100):
+                consumed.append(num)
+                yield f"sm{num}"
+
+        async def _run(info):
+            stream = info.stream(ids(), window=3)
+            async for video_id, _ in stream:
+                break
+            await stream.aclose()
+            return video_id
+
+        try:
+            info = self.FakeInfo(None, session=SessionManager(loop=loop), logger=LOGGER, loop=loop)
+            assert loop.run_until_complete(_run(info)) == "sm1"
+            assert len(consumed) == 4
+        finally:
+            loop.close()
+
+
+class TestWatchPage:
+    PAYLOAD = '{"video": {"title": "<a> & \\"b\\""}}'
+
+    def page(self, tag):
+        return ('<html><body><ul><li data-video-id="js-initial-watch-data">x</li></ul>'
+                + tag + '<p>js-initial-watch-data</p></body></html>')
+
+    def test_data_api(self):
+        escaped = html.escape(self.PAYLOAD)
+        for tag in (f'<div id="js-initial-watch-data" data-api-data="{escaped}" data-environment="{{}}"></div>',
+                    f"<div data-api-data='{escaped}' id='js-initial-watch-data'></div>"):
+            content = self.page(tag)
+            assert watchpage.extract(content) == (watchpage.DATA_API, self.PAYLOAD)
+            assert watchpage.extract(content) == watchpage.extract_with_soup(content)
+
+    def test_watch_api(self):
+        content = self.page(f'<div id="watchAPIDataContainer" style="display:none">'
+                            f'{html.escape(self.PAYLOAD)}</div>')
+        assert watchpage.extract(content) == (watchpage.WATCH_API, self.PAYLOAD)
+        assert watchpage.extract(content) == watchpage.extract_with_soup(content)
+
+    def test_scanner_matches_extract_in_small_pieces(self):
+        escaped = html.escape(self.PAYLOAD)
+        filler = "<li>filler</li>" * 200
+        for tag in (f'<div id="js-initial-watch-data" data-api-data="{escaped}"></div>',
+                    f'<div id="watchAPIDataContainer">{escaped}</div>',
+                    '<form id="Login_nico"></form>', ""):
+            content = self.page(filler + tag + filler)
+            scanner = watchpage.Scanner()
+            peak = 0
+            for pos in range(0, len(content), 7):
+                done = scanner.feed(content[pos:pos + 7])
+                peak = max(peak, scanner.buffered)
+                if done:
+                    break
+            assert scanner.close() == watchpage.extract(content)
+            # 読み終えた部分は捨てるので、ページ全体は溜め込まない
+            assert peak < len(tag) + 50
+            if tag:
+                assert scanner.received < len(content) - len(filler)
+
+    def test_streaming_read_stops_early(self):
+        loop = asyncio.new_event_loop()
+        sent = []
+        escaped = html.escape(self.PAYLOAD)
+
+        async def handler(request):
+            response = web.StreamResponse(headers={"Content-Type": "text/html; charset=utf-8"})
+            await response.prepare(request)
+            await response.write(self.page(f'<div id="js-initial-watch-data" data-api-data="{escaped}">')
+                                 .encode())
+            try:
+                for _ in range(200):
+                    await asyncio.sleep(0.01)
+                    await response.write(b"<li>filler</li>" * 1000)
+                    sent.append(1)
+            except (ConnectionError, RuntimeError):
+                pass
+            return response
+
+        async def _run():
+            runner, base = await serve(handler)
+            manager = await SessionManager(loop=loop).open()
+            try:
+                info = Info(None, session=manager, logger=LOGGER, loop=loop)
+                async with manager.get(base) as response:
+                    result = await info._scan_streaming(response)
+                await asyncio.sleep(0.2)
+                return result
+            finally:
+                await manager.close()
+                await runner.cleanup()
+
+        try:
+            assert loop.run_until_complete(_run()) == (watchpage.DATA_API, self.PAYLOAD)
+            assert len(sent) < 200
+        finally:
+            loop.close()
+
+    def test_login_and_unknown(self):
+        assert watchpage.extract('<form id="Login_nico"></form>') == (watchpage.LOGIN, None)
+        assert watchpage.extract(self.page("")) == (None, None)
+        # 目印はあるが直接は読めない形なら BeautifulSoup に任せる
+        content = self.page('<div id="js-initial-watch-data" data-api-data=unquoted></div>')
+        assert watchpage.extract(content) == (watchpage.DATA_API, "unquoted")
+
+
+class TestParseExecutor:
+    DATA = {
+        "video": {"id": "sm9", "smileInfo": {"url": "http://example.com/sm9"}, "title": "新・豪血寺一族",
+                  "thumbnailURL": "http://example.com/sm9.jpg", "movieType": "flv", "isDeleted": False,
+                  "isPublic": True, "isOfficial": False, "dmcInfo": None},
+        "context": {"isPeakTime": False, "userkey": "key"},
+        "viewer": {"id": 1, "isPremium": False},
+    }
+
+    def test_parse_everywhere(self):
+        content = ('<div id="js-initial-watch-data" data-api-data="'
+                   + html.escape(json.dumps(self.DATA)) + '"></div>')
+        expected = Info._parse_page(content)
+        assert expected[0] == watchpage.DATA_API
+        assert expected[1][KeyDmc.TITLE] == "新・豪血寺一族"
+        loop = asyncio.new_event_loop()
+        try:
+            for kind in ParseExecutor.KINDS:
+                executor = ParseExecutor(kind, workers=1, loop=loop)
+                try:
+                    assert loop.run_until_complete(executor.run(Info._parse_page, content)) == expected
+                finally:
+                    executor.shutdown()
+        finally:
+            loop.close()
+
+    def test_invalid_kind(self):
+        with pytest.raises(ValueError):
+            ParseExecutor("fiber")
+
+
+class TestInfoCache:
+    INFO = {KeyDmc.VIDEO_ID: "sm9", KeyDmc.TITLE: "新・豪血寺一族", KeyDmc.THREAD_ID: 1173108780,
+            KeyDmc.FILE_SIZE: 1234, KeyDmc.TOKEN: "token", KeyDmc.USER_KEY: "key",
+            KeyDmc.IS_PUBLIC: True, KeyDmc.IS_DELETED: False, KeyDmc.VIDEO_SRC_IDS: ["a", "b"]}
+
+    def test_separate_ttls(self):
+        cache = InfoCache()
+        try:
+            cache.put("sm9", self.INFO)
+            assert cache.get("sm9") == dict(self.INFO, **{KeyDmc.FILE_SIZE: None})
+            assert cache.get("sm8") is None
+            cache.volatile_ttl = -1
+            # 署名などが古くなっても、変わらない項目だけなら返せる
+            assert cache.get("sm9") is None
+            assert cache.get("sm9", volatile=False) == {
+                KeyDmc.VIDEO_ID: "sm9", KeyDmc.TITLE: "新・豪血寺一族",
+                KeyDmc.THREAD_ID: 1173108780, KeyDmc.FILE_SIZE: None}
+            cache.stable_ttl = -1
+            assert cache.get("sm9", volatile=False) is None
+            assert cache.prune() == 1
+        finally:
+            cache.close()
+
+    def test_info_skips_network_for_cached(self):
+        loop = asyncio.new_event_loop()
+        fetched = []
+
+        class CountingInfo(Info):
+            async def _retrieve_info(self, video_id):
+                fetched.append(video_id)
+                return {KeyDmc.VIDEO_ID: video_id, KeyDmc.IS_PUBLIC: True, KeyDmc.IS_DELETED: False}
+
+        cache = InfoCache()
+        try:
+            for _ in range(2):
+                info = CountingInfo(["sm1", "sm2"], session=SessionManager(loop=loop), logger=LOGGER,
+                                    loop=loop, cache=cache)
+                assert sorted(info.info) == ["sm1", "sm2"]
+            assert sorted(fetched) == ["sm1", "sm2"]
+            cache.volatile_ttl = -1
+            CountingInfo(["sm1"], session=SessionManager(loop=loop), logger=LOGGER, loop=loop, cache=cache)
+            assert sorted(fetched) == ["sm1", "sm1", "sm2"]
+        finally:
+            cache.close()
+            loop.close()
+
+
+class TestMetadataPlan:
+    THUMBINFO = ('<?xml version="1.0" encoding="UTF-8"?><nicovideo_thumb_response status="ok"><thumb>'
+                 '<video_id>sm9</video_id><title>新・豪血寺一族 &amp;</title>'
+                 '<thumbnail_url>http://tn.smilevideo.jp/smile?i=9</thumbnail_url>'
+                 '<movie_type>flv</movie_type></thumb></nicovideo_thumb_response>')
+    GETFLV = ("thread_id=1173108780&l=319&url=http%3A%2F%2Fsmile.example%2Fsmile%3Fv%3D9"
+              "&ms=http%3A%2F%2Fmsg.example%2Fapi%2F&ms_sub=http%3A%2F%2Fsub.example%2F"
+              "&user_id=1&is_premium=0&nickname=a&userkey=key")
+
+    def test_plan(self):
+        assert Info.plan(thumbnail=True) == Info.THUMBINFO
+        assert Info.plan(thumbnail=True, comment=True) == Info.GETFLV
+        assert Info.plan(video=True, smile=True) == Info.GETFLV
+        assert Info.plan(thumbnail=True, video=True) == Info.WATCH
+
+    def test_readers(self):
+        info = Info._read_from_thumbinfo("sm9", self.THUMBINFO)
+        assert info[KeyDmc.TITLE] == "新・豪血寺一族 &"
+        assert info[KeyDmc.MOVIE_TYPE] == "flv"
+        assert Info.is_available(info)
+        assert Info._read_from_thumbinfo("sm9", '<nicovideo_thumb_response status="fail">'
+                                                '</nicovideo_thumb_response>') is None
+        flv = Info._read_from_getflv(self.GETFLV)
+        assert flv[KeyDmc.THREAD_ID] == 1173108780
+        assert flv[KeyDmc.MSG_SERVER] == "http://msg.example/api/"
+        assert flv[KeyDmc.IS_OFFICIAL] is False
+        assert Info._read_from_getflv("error=invalid_v1") is None
+
+    def test_sources(self):
+        loop = asyncio.new_event_loop()
+        called = []
+        thumbinfo = self.THUMBINFO
+        getflv = self.GETFLV
+
+        class PlannedInfo(Info):
+            async def _retrieve_thumbinfo(self, video_id):
+                called.append("thumbinfo")
+                return self._read_from_thumbinfo(video_id, thumbinfo)
+
+            async def _retrieve_getflv(self, video_id):
+                called.append("getflv")
+                return self._read_from_getflv(getflv if video_id == "sm9" else "error=1")
+
+            async def _retrieve_watch(self, video_id):
+                called.append("watch")
+                return {}
+
+        try:
+            for source, video_id, expected in ((Info.THUMBINFO, "sm9", ["thumbinfo"]),
+                                               (Info.GETFLV, "sm9", ["thumbinfo", "getflv"]),
+                                               (Info.GETFLV, "sm1", ["thumbinfo", "getflv", "watch"]),
+                                               (Info.WATCH, "sm9", ["watch"])):
+                del called[:]
+                info = PlannedInfo(None, session=SessionManager(loop=loop), logger=LOGGER,
+                                   loop=loop, source=source)
+                result = loop.run_until_complete(info._retrieve_info(video_id))
+                assert called == expected
+                if expected == ["thumbinfo", "getflv"]:
+                    assert result[KeyDmc.USER_KEY] == "key"
+                    assert result[KeyDmc.TITLE] == "新・豪血寺一族 &"
+        finally:
+            loop.close()
+
+
+class TestRangeDownload:
+    BODY = bytes(range(256)) * 397
+
+    def download(self, tmpdir, requests=None, handler=None, **kwargs):
+        loop = asyncio.new_event_loop()
+
+        async def _run():
+            runner, base = await serve(handler or range_handler(self.BODY, requests))
+            manager = await SessionManager(loop=loop).open()
+            try:
+                commons = video_commons(manager, loop, Path(str(tmpdir)), **kwargs)
+                smile = VideoSmile({"sm1": video_info("sm1", base + "/sm1")}, commons)
+                await smile.fetch(0, "sm1")
+            finally:
+                await manager.close()
+                await runner.cleanup()
+
+        try:
+            loop.run_until_complete(_run())
+        finally:
+            loop.close()
+        return sorted(path.name for path in Path(str(tmpdir)).iterdir())
+
+    def test_preallocated_file(self, tmpdir):
+        names = self.download(tmpdir)
+        # 部分ファイルを作らず、直接ひとつのファイルに書き込む
+        assert len(names) == 1
+        assert (Path(str(tmpdir)) / names[0]).read_bytes() == self.BODY
+
+    def test_progress_events(self, tmpdir):
+        stream = io.StringIO()
+        self.download(tmpdir, **{DataKey.PROGRESS: ProgressBus([JsonLinesSink(stream)], interval=0.01)})
+        events = [json.loads(line) for line in stream.getvalue().splitlines()]
+        assert events[0]["event"] == "start" and events[0]["done"] == 0
+        assert events[-1]["event"] == "done"
+        assert events[-1]["done"] == events[-1]["total"] == len(self.BODY)
+
+    def test_stream(self, tmpdir):
+        received = []
+
+        async def consumer(video_id, data):
+            assert video_id == "sm1"
+            # 遅い受け手でも、順番どおりに全部届く
+            await asyncio.sleep(random.random() / 1000)
+            received.append(data)
+
+        names = self.download(tmpdir, **{DataKey.STREAM: consumer, DataKey.WINDOW: 4096})
+        assert b"".join(received) == self.BODY
+        # ファイルも記録も残さない
+        assert names == []
+
+    def test_part_files(self, tmpdir):
+        names = self.download(tmpdir, **{DataKey.PREALLOCATE: False})
+        assert len(names) == 1
+        assert (Path(str(tmpdir)) / names[0]).read_bytes() == self.BODY
+
+    def prepare_resume(self, tmpdir, layout):
+        """ 4分割のうち、0番目を半分、2番目を全部取ってきたところで止まった状態を作る。 """
+        file_path = utils.make_name(video_info("sm1", ""), Path(str(tmpdir)))
+        # 識別子には URL が入るが、テストのサーバーはポートが毎回変わるので後から書き換える
+        manifest = RangeManifest.plan(file_path, "", len(self.BODY), 4, layout)
+        segments = manifest.segments
+        manifest.advance(0, (segments[0][1] - segments[0][0]) // 2)
+        manifest.advance(2, segments[2][1] - segments[2][0])
+        if layout == RangeManifest.PREALLOCATED:
+            data = bytearray(len(self.BODY))
+            for start, end, done in segments:
+                data[start:start + done] = self.BODY[start:start + done]
+            file_path.write_bytes(bytes(data))
+        else:
+            for order, (start, end, done) in enumerate(segments):
+                if done:
+                    # 記録より後ろのごみは捨てられるはず
+                    Path(f"{file_path}.{order:03}").write_bytes(self.BODY[start:start + done] + b"junk")
+        manifest.save()
+        return manifest
+
+    @pytest.mark.parametrize("preallocate", [True, False])
+    def test_resume(self, tmpdir, preallocate, monkeypatch):
+        layout = RangeManifest.PREALLOCATED if preallocate else RangeManifest.PARTS
+        manifest = self.prepare_resume(tmpdir, layout)
+        monkeypatch.setattr(VideoSmile, "_identity", lambda self, video_id, video_url: "")
+        requests = []
+        names = self.download(tmpdir, requests, **{DataKey.PREALLOCATE: preallocate})
+        # 足りない部分だけを取り直す
+        assert sorted(requests) == sorted(f"bytes={start}-{end - 1}" for _, start, end in manifest.missing())
+        assert len(names) == 1
+        assert (Path(str(tmpdir)) / names[0]).read_bytes() == self.BODY
+
+    def test_resume_other_video(self, tmpdir):
+        # 識別子が違えば記録は使わず、最初から取り直す
+        self.prepare_resume(tmpdir, RangeManifest.PREALLOCATED)
+        requests = []
+        names = self.download(tmpdir, requests)
+        assert len(requests) == 4
+        assert len(names) == 1
+        assert (Path(str(tmpdir)) / names[0]).read_bytes() == self.BODY
+
+    def slow_handler(self, requests, delay):
+        """ 最初に受けた Range のリクエストにだけ、1KB ごとに delay 秒待ちながら応える。 """
+        slow = []
+
+        async def handler(request):
+            if request.method == "HEAD":
+                return web.Response(headers={"Content-Length": str(len(self.BODY))})
+            header = request.headers["Range"]
+            requests.append(header)
+            start, end = map(int, header.replace("bytes=", "").split("-"))
+            response = web.StreamResponse(status=206, headers={
+                "Content-Range": f"bytes {start}-{end}/{len(self.BODY)}",
+                "Content-Length": str(end - start + 1)})
+            await response.prepare(request)
+            is_slow = not slow
+            slow.append(header)
+            for pos in range(start, end + 1, 1024):
+                await response.write(self.BODY[pos:min(pos + 1024, end + 1)])
+                if is_slow:
+                    await asyncio.sleep(delay)
+            return response
+        return handler
+
+    @pytest.mark.parametrize("preallocate", [True, False])
+    def test_work_stealing(self, tmpdir, preallocate, monkeypatch):
+        # 手の空いた接続が遅い接続の残りを切り分けて引き受ける
+        monkeypatch.setattr(VideoSmile, "MIN_SPLIT", 2048)
+        requests = []
+        names = self.download(tmpdir, requests, self.slow_handler(requests, 0.02),
+                              **{DataKey.PREALLOCATE: preallocate})
+        assert len(requests) > 4
+        assert len(names) == 1
+        assert (Path(str(tmpdir)) / names[0]).read_bytes() == self.BODY
+
+    def test_stalled_segment(self, tmpdir, monkeypatch):
+        # データが届かなくなった範囲は手放して、続きから取り直す
+        monkeypatch.setattr(VideoSmile, "STALL_TIMEOUT", 0.2)
+        requests = []
+        names = self.download(tmpdir, requests, self.slow_handler(requests, 3))
+        assert len(requests) == 5
+        assert len(names) == 1
+        assert (Path(str(tmpdir)) / names[0]).read_bytes() == self.BODY
+
+    def test_auto_small_file(self, tmpdir):
+        # 小さな動画は一本の接続で取る
+        requests = []
+        names = self.download(tmpdir, requests, **{DataKey.DIVISION: None})
+        assert requests == [f"bytes=0-{len(self.BODY) - 1}"]
+        assert (Path(str(tmpdir)) / names[0]).read_bytes() == self.BODY
+
+    def test_auto_large_file(self, tmpdir, monkeypatch):
+        monkeypatch.setattr(ThroughputTuner, "SMALL_FILE", 1024)
+        monkeypatch.setattr(VideoSmile, "MIN_SPLIT", 2048)
+        requests = []
+        names = self.download(tmpdir, requests, self.slow_handler(requests, 0.02), **{DataKey.DIVISION: None})
+        # 二本から始めて、片方が遅いので残りを切り分けて取る
+        assert len(requests) > 2
+        assert (Path(str(tmpdir)) / names[0]).read_bytes() == self.BODY
+
+    def test_incomplete_is_resumable(self, tmpdir, monkeypatch):
+        async def _download_worker(self, transfer, worker):
+            # それぞれ一つだけ範囲を引き受け、最後の接続は何も取らずに抜けてしまう
+            order = transfer.scheduler.claim()
+            try:
+                if worker < 3:
+                    await self._download_segment(transfer, worker, order)
+            finally:
+                transfer.scheduler.release(order)
+
+        monkeypatch.setattr(VideoSmile, "_download_worker", _download_worker)
+        with pytest.raises(IOError):
+            self.download(tmpdir)
+        # 完成したことにせず、続きから取れるように記録を残す
+        names = sorted(path.name for path in Path(str(tmpdir)).iterdir())
+        assert len(names) == 2 and names[1].endswith(RangeManifest.SUFFIX)
+
+    def test_auto_retire_after_others_finished(self, tmpdir, monkeypatch):
+        monkeypatch.setattr(ThroughputTuner, "SMALL_FILE", 1024)
+        monkeypatch.setattr(ThroughputTuner, "adjust", lambda self, total, now=None: self.target)
+        # 二つの範囲に分け、切り分けはさせない
+        monkeypatch.setattr(VideoSmile, "SEGMENT_SIZE", 64 * 1024)
+        monkeypatch.setattr(VideoSmile, "MIN_SPLIT", len(self.BODY))
+        original = VideoSmile._download_segment
+        retired = []
+
+        async def _download_segment(self, transfer, worker, order):
+            if worker == 1 and not retired:
+                # 0 番が自分の範囲を終えて抜けてから、接続を減らす
+                while transfer.scheduler.remaining(0) > 0:
+                    await asyncio.sleep(0.01)
+                await asyncio.sleep(0.05)
+                transfer.tuner.target = 1
+                retired.append(order)
+            await original(self, transfer, worker, order)
+
+        monkeypatch.setattr(VideoSmile, "_download_segment", _download_segment)
+        names = self.download(tmpdir, **{DataKey.DIVISION: None})
+        # 手放された範囲を誰かが取り直す
+        assert retired == [1]
+        assert len(names) == 1
+        assert (Path(str(tmpdir)) / names[0]).read_bytes() == self.BODY
+
+    def test_tuner(self):
+        tuner = ThroughputTuner(100 * 1024 * 1024, max_workers=4, start_workers=2, interval=1)
+        assert tuner.target == 2
+        assert tuner.adjust(0, now=0) == 2
+        # 増やすたびに速くなるうちは増やす
+        assert tuner.adjust(1000000, now=1) == 3
+        assert tuner.adjust(2500000, now=2) == 4
+        # 速くならなければ一本戻して落ち着く
+        assert tuner.adjust(4000000, now=3) == 3
+        assert tuner.adjust(5500000, now=4) == 3
+        # 一本あたりの速さに合わせて読む大きさを決める
+        assert tuner.chunk_size == int(1500000 / 3 * tuner.read_time)
+        # 大きく遅くなったら、また増やしてみる
+        assert tuner.adjust(5600000, now=5) == 3
+        assert tuner.adjust(6000000, now=6) == 4
+
+        small = ThroughputTuner(1024)
+        assert small.target == 1
+        small.adjust(0, now=0)
+        assert small.adjust(10 ** 9, now=1) == 1
+        assert small.chunk_size == small.max_chunk
+
+    def test_parallel_videos_share_budget(self, tmpdir):
+        # 3本を並べて取っても、同時に張る接続は全体で budget の数まで
+        loop = asyncio.new_event_loop()
+        inner = range_handler(self.BODY)
+        state = {"open": 0, "peak": 0, "videos": set()}
+
+        async def handler(request):
+            if request.method == "GET":
+                state["open"] += 1
+                state["peak"] = max(state["peak"], state["open"])
+                state["videos"].add(request.path)
+                await asyncio.sleep(0.05)
+            try:
+                return await inner(request)
+            finally:
+                if request.method == "GET":
+                    state["open"] -= 1
+
+        async def _run():
+            runner, base = await serve(handler)
+            manager = await SessionManager(loop=loop).open()
+            try:
+                commons = video_commons(manager, loop, Path(str(tmpdir)), **{
+                    DataKey.PARALLEL: 3, DataKey.BUDGET: TransferBudget(connections=2)})
+                glossary = {f"sm{i}": video_info(f"sm{i}", f"{base}/sm{i}") for i in range(1, 4)}
+                await VideoSmile(glossary, commons)._broker()
+            finally:
+                await manager.close()
+                await runner.cleanup()
+
+        try:
+            loop.run_until_complete(_run())
+        finally:
+            loop.close()
+        assert state["peak"] == 2
+        assert len(state["videos"]) == 3
+        for path in Path(str(tmpdir)).iterdir():
+            assert path.read_bytes() == self.BODY
+
+    def test_dmc_prefetch(self, tmpdir):
+        # 前の動画を取っている間に、次の動画のセッションを作っておく
+        loop = asyncio.new_event_loop()
+        events = []
+        heartbeats = []
+
+        class FakeDmc(VideoDmc):
+            async def _open_session(self, video_id, xml=True):
+                events.append(("nego", video_id))
+                await asyncio.sleep(0.05)
+                beat = self.heartbeats.register(Beat(video_id, "http://localhost/", "", 3600))
+                heartbeats.append(beat)
+                return self.glossary[video_id][KeyDmc.VIDEO_URL_SM], beat
+
+            async def _download(self, idx, video_id, video_url, total=None):
+                events.append(("start", video_id))
+                await super()._download(idx, video_id, video_url, total)
+                events.append(("done", video_id))
+
+        async def _run():
+            runner, base = await serve(range_handler(self.BODY))
+            manager = await SessionManager(loop=loop).open()
+            try:
+                commons = video_commons(manager, loop, Path(str(tmpdir)))
+                glossary = {}
+                for i in range(1, 4):
+                    info = video_info(f"sm{i}", f"{base}/sm{i}")
+                    info.update({KeyDmc.IS_DMC: True, KeyDmc.VIDEO_SRC_IDS: ["v"], KeyDmc.AUDIO_SRC_IDS: ["a"]})
+                    glossary[f"sm{i}"] = info
+                dmc = FakeDmc(glossary, commons)
+                await dmc._broker()
+                # 終わったセッションは HeartbeatManager から外れている
+                assert len(dmc.heartbeats) == 0
+                await dmc.heartbeats.close()
+            finally:
+                await manager.close()
+                await runner.cleanup()
+
+        try:
+            loop.run_until_complete(_run())
+        finally:
+            loop.close()
+        assert [event for event in events if event[0] == "nego"] == [("nego", "sm1"), ("nego", "sm2"), ("nego", "sm3")]
+        # sm2 のセッションは sm1 を取り終える前に作り始めている
+        assert events.index(("nego", "sm2")) < events.index(("done", "sm1"))
+        assert events.index(("nego", "sm3")) < events.index(("done", "sm2"))
+        assert len(heartbeats) == 3 and not any(beat.active for beat in heartbeats)
+
+    @pytest.mark.parametrize("streamed", [False, True])
+    def test_dmc_renegotiate(self, tmpdir, streamed):
+        # 動画のサーバーに 410 で断られたら、セッションを作り直して続きから取る
+        loop = asyncio.new_event_loop()
+        received = []
+
+        async def consumer(video_id, data):
+            received.append(data)
+        inner = range_handler(self.BODY)
+        requests = {"/s1": [], "/s2": []}
+        refreshed = []
+
+        async def handler(request):
+            if request.method == "GET":
+                served = requests[request.path]
+                served.append(request.headers["Range"])
+                if request.path == "/s1" and len(served) > 2:
+                    return web.Response(status=410)
+            return await inner(request)
+
+        class FakeDmc(VideoDmc):
+            async def _open_session(self, video_id, xml=True):
+                url = f"{self.base}/s{len(refreshed) + 1}"
+                return url, self.heartbeats.register(Beat(video_id, url, "", 3600))
+
+            async def _refresh(self, video_id):
+                refreshed.append(video_id)
+
+        async def _run():
+            runner, base = await serve(handler)
+            manager = await SessionManager(loop=loop).open()
+            try:
+                info = video_info("sm1", "")
+                info.update({KeyDmc.IS_DMC: True, KeyDmc.VIDEO_SRC_IDS: ["v"], KeyDmc.AUDIO_SRC_IDS: ["a"]})
+                commons = video_commons(manager, loop, Path(str(tmpdir)))
+                if streamed:
+                    commons[DataKey.STREAM] = consumer
+                dmc = FakeDmc({"sm1": info}, commons)
+                dmc.base = base
+                await dmc.fetch(0, "sm1")
+                await dmc.heartbeats.close()
+            finally:
+                await manager.close()
+                await runner.cleanup()
+
+        try:
+            loop.run_until_complete(_run())
+        finally:
+            loop.close()
+        assert refreshed == ["sm1"]
+        if streamed:
+            # 渡し終えていなかった分だけを取り直すので、重なりも抜けもない
+            assert b"".join(received) == self.BODY
+            assert list(Path(str(tmpdir)).iterdir()) == []
+            return
+        # 前のセッションで取れた分は取り直さない
+        requested = 0
+        for header in requests["/s2"]:
+            start, end = map(int, header.replace("bytes=", "").split("-"))
+            requested += end - start + 1
+        assert 0 < requested < len(self.BODY)
+        names = [path.name for path in Path(str(tmpdir)).iterdir()]
+        assert len(names) == 1
+        assert (Path(str(tmpdir)) / names[0]).read_bytes() == self.BODY
+
+    def test_budget(self):
+        loop = asyncio.new_event_loop()
+
+        async def _run():
+            budget = TransferBudget(connections=2, bytes_in_flight=100)
+            # 上限より大きくは頼めない
+            assert await budget.acquire(150) == 100
+            waiting = asyncio.ensure_future(budget.acquire(30))
+            await asyncio.sleep(0)
+            # 枠が埋まっているので待つ
+            assert not waiting.done()
+            budget.consume(80)
+            await asyncio.sleep(0)
+            assert await waiting == 30
+            assert (budget.open, budget.reserved) == (2, 50)
+            # 接続の数も埋まっている
+            third = asyncio.ensure_future(budget.acquire(1))
+            await asyncio.sleep(0)
+            assert not third.done()
+            budget.release(20)
+            assert await third == 1
+            assert (budget.open, budget.reserved) == (2, 31)
+
+        try:
+            loop.run_until_complete(_run())
+        finally:
+            loop.close()
+
+    def test_scheduler(self):
+        segments = [[0, 100, 0], [100, 200, 0]]
+        scheduler = SegmentScheduler(segments, min_split=10)
+        assert scheduler.claim() == 0
+        assert scheduler.claim() == 1
+        segments[1][2] = 90
+        # 残りの多い 0 番の後ろ半分を切り分ける
+        assert scheduler.claim() == 2
+        assert segments == [[0, 50, 0], [100, 200, 90], [50, 100, 0]]
+        segments[0][2] = 40
+        segments[2][2] = 35
+        # どれも切り分けるほど残っていない
+        assert scheduler.claim() is None
+        scheduler.release(2)
+        assert scheduler.claim() == 2
+
+    def test_manifest_roundtrip(self, tmpdir):
+        file_path = Path(str(tmpdir)) / "sm1.mp4"
+        manifest = RangeManifest.plan(file_path, "id", 10, 3, RangeManifest.PARTS)
+        assert manifest.segments == [[0, 3, 0], [3, 6, 0], [6, 10, 0]]
+        manifest.advance(1, 2)
+        manifest.save()
+        loaded = RangeManifest.load(file_path, "id", 10, RangeManifest.PARTS)
+        assert loaded.segments == manifest.segments
+        assert loaded.missing() == [(0, 0, 3), (1, 5, 6), (2, 6, 10)]
+        assert RangeManifest.load(file_path, "other", 10, RangeManifest.PARTS) is None
+        assert RangeManifest.load(file_path, "id", 11, RangeManifest.PARTS) is None
+        assert RangeManifest.load(file_path, "id", 10, RangeManifest.PREALLOCATED) is None
+        manifest.remove()
+        assert RangeManifest.load(file_path, "id", 10, RangeManifest.PARTS) is None
+
+    def test_manifest_pending(self, tmpdir):
+        file_path = Path(str(tmpdir)) / "sm1.mp4"
+        manifest = RangeManifest.plan(file_path, "id", 10, 2, RangeManifest.PARTS)
+        manifest.advance(0, 2)
+        manifest.advance(0, 3, written=False)
+        # 書き込みを頼んだだけの分は、切り分けには数えるが保存はしない
+        assert manifest.segments[0][2] == 5 and manifest.committed == 2
+        manifest.save()
+        assert RangeManifest.load(file_path, "id", 10, RangeManifest.PARTS).segments[0][2] == 2
+        manifest.commit(0, 3)
+        manifest.save()
+        assert manifest.committed == 5
+        assert RangeManifest.load(file_path, "id", 10, RangeManifest.PARTS).segments[0][2] == 5
+
+
+class TestHeartbeat:
+    def run(self, statuses, beats, **kwargs):
+        """
+        statuses の順に応えるサーバーに Heartbeat を送らせる。
+
+        :return: サーバーが受け取った中身のリスト
+        """
+        loop = asyncio.new_event_loop()
+        received = []
+        statuses = list(statuses)
+
+        async def handler(request):
+            received.append((request.path, await request.text()))
+            status = statuses.pop(0) if statuses else 200
+            return web.Response(status=status, text=f"<x><session>{len(received)}</session></x>")
+
+        async def _run():
+            runner, base = await serve(handler)
+            manager = await SessionManager(loop=loop).open()
+            heartbeats = HeartbeatManager(manager, LOGGER, retry_interval=0.01, **kwargs)
+            try:
+                for beat in beats:
+                    beat.url = base + beat.url
+                    heartbeats.register(beat)
+                await asyncio.sleep(0.37)
+            finally:
+                await heartbeats.close()
+                await manager.close()
+                await runner.cleanup()
+
+        try:
+            loop.run_until_complete(_run())
+        finally:
+            loop.close()
+        return received
+
+    def test_beats_and_renews(self):
+        renew = lambda text: text[text.find("<session>"):text.find("</session>") + 10]
+        beats = [Beat("sm1", "/sm1", "<session>0</session>", 0.1, renew=renew),
+                 Beat("sm2", "/sm2", "two", 0.15)]
+        received = self.run([], beats)
+        sm1 = [body for path, body in received if path == "/sm1"]
+        sm2 = [body for path, body in received if path == "/sm2"]
+        assert len(sm1) == 3 and len(sm2) == 2
+        # 次に送る中身は返事から作る
+        assert sm1[0] == "<session>0</session>"
+        assert sm1[1].startswith("<session>") and sm1[1] != sm1[0]
+        assert sm2 == ["two", "two"]
+
+    def test_retry_then_lost(self):
+        lost = []
+        beat = Beat("sm1", "/sm1", "", 0.05)
+        beat.on_lost = lost.append
+        # 400 は送り直し、 410 はセッションがもうないので諦める
+        received = self.run([400, 200, 410], [beat], retries=2)
+        assert len(received) == 3
+        assert len(lost) == 1 and isinstance(lost[0], SessionLost)
+        assert beat.lost is lost[0] and not beat.active
+
+    def test_retries_do_not_stack(self):
+        lost = []
+        beat = Beat("sm1", "/sm1", "", 0.05)
+        beat.on_lost = lost.append
+        # 502 は SessionManager では送り直さず、 HeartbeatManager が retries 回だけ送り直す
+        received = self.run([502] * 10, [beat], retries=2)
+        assert len(received) == 3 and len(lost) == 1
+
+    def test_timeout_covers_breaker(self):
+        loop = asyncio.new_event_loop()
+        lost = []
+
+        async def _run():
+            manager = await SessionManager(loop=loop).open()
+            heartbeats = HeartbeatManager(manager, LOGGER, retries=1, retry_interval=0.01, timeout=0.05, loop=loop)
+            beat = Beat("sm1", "http://127.0.0.1:9/sm1", "", 0.01)
+            beat.on_lost = lost.append
+            # ブレーカーが開いて待たされても、期限のうちに諦めて知らせる
+            manager.breaker(beat.url)._open(60)
+            try:
+                heartbeats.register(beat)
+                await asyncio.sleep(0.5)
+            finally:
+                await heartbeats.close()
+                await manager.close()
+
+        try:
+            loop.run_until_complete(_run())
+        finally:
+            loop.close()
+        assert len(lost) == 1
+
+    def test_video_discard_sessions(self):
+        loop = asyncio.new_event_loop()
+
+        async def _run():
+            manager = await SessionManager(loop=loop).open()
+            video = Video({}, session=manager, loop=loop, logger=LOGGER, progress=ProgressBus([]))
+            heartbeats = video.commons[DataKey.HEARTBEAT]
+            heartbeats.register(Beat("sm1", "http://127.0.0.1:9/sm1", "", 60))
+            try:
+                # パイプラインが途中で止まっても、借りたセッションを閉じる前に Heartbeat を止められる
+                await video.discard_sessions()
+                assert len(heartbeats) == 0 and not manager.closed
+            finally:
+                video.commons[DataKey.WRITER].shutdown()
+                await manager.close()
+
+        try:
+            loop.run_until_complete(_run())
+        finally:
+            loop.close()
+
+    def test_interval_fits_retries(self):
+        loop = asyncio.new_event_loop()
+        try:
+            heartbeats = HeartbeatManager(None, LOGGER, retries=3, retry_interval=2.0, timeout=5.0, loop=loop)
+            # 送り直しを全部終えても期限に間に合う
+            for lifetime in (40, 50, 60, 120):
+                assert heartbeats.interval_for(lifetime) + heartbeats.retry_window < lifetime
+            # 寿命が短すぎれば、半分で送る
+            assert heartbeats.interval_for(30) == 15
+        finally:
+            loop.close()
+
+
+class TestProgress:
+    def test_bus(self):
+        loop = asyncio.new_event_loop()
+        stream = io.StringIO()
+        bus = ProgressBus([JsonLinesSink(stream)], interval=0.01)
+
+        async def _run():
+            parts = [0, 0]
+            progress = bus.track("sm1", 100, initial=10, parts=parts)
+            # 取ってくる側は数を足すだけ
+            parts[0] += 30
+            await asyncio.sleep(0.05)
+            parts[1] += 60
+            bus.finish(progress)
+            await bus.close()
+
+        try:
+            loop.run_until_complete(_run())
+        finally:
+            loop.close()
+        events = [json.loads(line) for line in stream.getvalue().splitlines()]
+        assert [event["event"] for event in events[:2]] == ["start", "progress"]
+        assert events[1]["done"] == 40 and events[1]["connections"] == 1
+        assert events[-1]["event"] == "done" and events[-1]["done"] == 100
+        assert events[-1]["connections"] == 2
+
+    def test_headless(self):
+        loop = asyncio.new_event_loop()
+        bus = ProgressBus([])
+
+        async def _run():
+            before = len(asyncio.all_tasks())
+            progress = bus.track("sm1", 100)
+            progress.advance(100)
+            # 出す先がなければタスクも作らない
+            assert len(asyncio.all_tasks()) == before
+            bus.finish(progress, succeeded=False)
+            assert progress.state == progress.FAILED and progress.done == 100
+
+        try:
+            loop.run_until_complete(_run())
+        finally:
+            loop.close()
+
+class TestCombine:
+    def test_combine(self, tmpdir):
+        base = Path(str(tmpdir))
+        parts = []
+        for order in range(3):
+            part = base / f"video.mp4.{order:03}"
+            part.write_bytes(bytes([order]) * (1000 + order))
+            parts.append(part)
+        expected = b"".join(part.read_bytes() for part in parts)
+        for zero_copy in (True, False):
+            destination = base / f"video-{zero_copy}.mp4"
+            assert fileio.combine(destination, parts, remove=False, zero_copy=zero_copy,
+                                  buffer_size=100) == len(expected)
+            assert destination.read_bytes() == expected
+        fileio.combine(base / "video.mp4", parts)
+        assert not any(part.exists() for part in parts)
+
+
+
+class TestReorderBuffer:
+    def test_in_order(self):
+        loop = asyncio.new_event_loop()
+        received = []
+
+        async def _run():
+            gate = asyncio.Event()
+
+            async def consumer(data):
+                await gate.wait()
+                received.append(data)
+
+            buffer = ReorderBuffer(consumer, 16, window=8)
+            first = await buffer.write(0, b"abcd")
+            await asyncio.sleep(0)
+            # 先頭を渡している間も、 window に収まる分は受け取る
+            await buffer.write(8, b"ijkl")
+            blocked = asyncio.ensure_future(buffer.write(12, b"mnop"))
+            await asyncio.sleep(0.01)
+            assert not blocked.done() and buffer.position == 4
+            # 先頭はいつでも受け取る
+            await buffer.write(4, b"efgh")
+            gate.set()
+            await blocked
+            await buffer.finish()
+            assert first.done() and buffer.emitted == 16 and buffer.buffered == 0
+
+        try:
+            loop.run_until_complete(_run())
+        finally:
+            loop.close()
+        assert b"".join(received) == b"abcdefghijklmnop"
+
+    def test_rewind(self, tmpdir):
+        manifest = RangeManifest.plan(Path(str(tmpdir)) / "sm1.mp4", "id", 30, 3, RangeManifest.PREALLOCATED)
+        for order in range(3):
+            manifest.advance(order, 7, written=False)
+        # 先頭から 14 バイトまで渡し終えていたら、それより後ろは取り直す
+        manifest.rewind(14)
+        assert [done for _, _, done in manifest.segments] == [7, 4, 0]
+        assert manifest.committed == 11
+
+
+class TestDiskWriter:
+    def run(self, coroutine):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    def test_ordered_writes(self, tmpdir):
+        base = Path(str(tmpdir))
+        writer = fileio.DiskWriter(threads=2, batch_size=64)
+
+        async def _run():
+            handles = [await writer.open(base / f"{number}.bin", truncate=True) for number in range(2)]
+            for offset in range(0, 3000, 3):
+                for number, handle in enumerate(handles):
+                    await handle.write(offset, bytes([number, offset % 251, 7]))
+            for handle in handles:
+                await handle.close()
+            await writer.write_file(base / "comment.xml", "コメント\n")
+
+        try:
+            self.run(_run())
+        finally:
+            writer.shutdown()
+        for number in range(2):
+            expected = b"".join(bytes([number, offset % 251, 7]) for offset in range(0, 3000, 3))
+            assert (base / f"{number}.bin").read_bytes() == expected
+        assert (base / "comment.xml").read_text(encoding="utf-8") == "コメント\n"
+        assert writer.pending == 0
+
+    def test_backpressure(self, tmpdir):
+        writer = fileio.DiskWriter(max_pending=10)
+        seen = []
+
+        async def _run():
+            handle = await writer.open(Path(str(tmpdir)) / "video.mp4", truncate=True)
+            # 何も待っていなければ上限より大きくても通す
+            await handle.write(0, b"x" * 100)
+            for offset in range(100, 200, 4):
+                await handle.write(offset, b"abcd")
+                seen.append(writer.pending)
+            await handle.close()
+
+        try:
+            self.run(_run())
+        finally:
+            writer.shutdown()
+        assert max(seen) <= 10
+        assert (Path(str(tmpdir)) / "video.mp4").read_bytes() == b"x" * 100 + b"abcd" * 25
+
+    def test_write_error(self, tmpdir):
+        writer = fileio.DiskWriter(fsync=fileio.DiskWriter.FSYNC_NEVER)
+
+        async def _run():
+            handle = await writer.open(Path(str(tmpdir)) / "video.mp4")
+            os.close(handle.fd)
+            written = await handle.write(0, b"abc")
+            with pytest.raises(OSError):
+                await written
+            with pytest.raises(OSError):
+                await handle.close()
+
+        try:
+            self.run(_run())
+        finally:
+            writer.shutdown()
+        with pytest.raises(ValueError):
+            fileio.DiskWriter(fsync="sometimes")
+
+    @pytest.mark.parametrize("policy,synced", [
+        (fileio.DiskWriter.FSYNC_NEVER, 0),
+        (fileio.DiskWriter.FSYNC_CLOSE, 1),
+        (fileio.DiskWriter.FSYNC_ALWAYS, 1),
+    ])
+    def test_write_file_fsync(self, tmpdir, monkeypatch, policy, synced):
+        calls = []
+        fsync = os.fsync
+        monkeypatch.setattr(os, "fsync", lambda fd: calls.append(fd) or fsync(fd))
+        writer = fileio.DiskWriter(fsync=policy)
+        try:
+            # サムネイルやコメントも、動画と同じ方針で同期する
+            self.run(writer.write_file(Path(str(tmpdir)) / "sm1.jpg", b"jpeg"))
+        finally:
+            writer.shutdown()
+        assert len(calls) == synced
+
+
 def test_okatadsuke():
     shutil.rmtree(str(utils.get_dir(SAVE_DIR)))